@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+import os
+import uuid
+import shutil
+import hashlib
+import logging
+import threading
+from pathlib import Path
+from collections import OrderedDict
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class AudioFileCache:
+    """Скачанные аудиофайлы на диске с ограничением по объему и вытеснением LRU.
+
+    Файл хранится под именем sha256(ключ трека) + расширение. Запись атомарна:
+    файл сначала появляется под временным именем и затем переименовывается.
+    Наружу отдается жесткая ссылка (или копия) во временную папку вызова,
+    поэтому вытеснение не мешает отправке, а удаление папки - кэшу.
+    Порядок LRU хранится в mtime файлов и переживает перезапуск."""
+
+    def __init__(self, directory: Path, max_bytes: int = 512 * 1024 * 1024):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.total_bytes = 0
+        self._lock = threading.Lock()
+        # sha256 ключа -> (имя файла, размер), от давно использованных к недавним
+        self._entries = OrderedDict()
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        files = []
+        for path in self.directory.iterdir():
+            if path.name.startswith('.tmp-'):
+                path.unlink(missing_ok=True)
+                continue
+            if path.is_file():
+                stat = path.stat()
+                files.append((stat.st_mtime, path.name, stat.st_size))
+
+        for _, name, size in sorted(files):
+            self._entries[os.path.splitext(name)[0]] = (name, size)
+            self.total_bytes += size
+        self._evict()
+
+    @staticmethod
+    def _digest(key: str) -> str:
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def contains(self, key: str) -> bool:
+        return self._digest(key) in self._entries
+
+    def fetch(self, key: str, dest_dir: str) -> Optional[str]:
+        """Кладет закэшированный файл в dest_dir; возвращает путь или None при промахе"""
+        digest = self._digest(key)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(digest)
+            self.hits += 1
+
+        name = entry[0]
+        source = self.directory / name
+        target = os.path.join(dest_dir, name)
+        try:
+            os.utime(source)
+            self._link_or_copy(source, target)
+        except FileNotFoundError:
+            # Файл вытеснили или удалили снаружи между поиском и копированием
+            with self._lock:
+                if self._entries.get(digest) == entry:
+                    self.total_bytes -= self._entries.pop(digest)[1]
+            return None
+        return target
+
+    def store(self, key: str, file_path: str) -> Optional[str]:
+        """Атомарно добавляет файл в кэш; возвращает путь в кэше"""
+        size = os.path.getsize(file_path)
+        if size > self.max_bytes:
+            return None
+
+        digest = self._digest(key)
+        name = digest + os.path.splitext(file_path)[1].lower()
+        tmp_path = self.directory / f'.tmp-{uuid.uuid4().hex}'
+        try:
+            self._link_or_copy(file_path, tmp_path)
+            os.replace(tmp_path, self.directory / name)
+        except OSError as e:
+            logger.warning(f"Не удалось сохранить файл в аудиокэш: {e}")
+            tmp_path.unlink(missing_ok=True)
+            return None
+
+        with self._lock:
+            old = self._entries.pop(digest, None)
+            if old:
+                self.total_bytes -= old[1]
+                if old[0] != name:
+                    (self.directory / old[0]).unlink(missing_ok=True)
+            self._entries[digest] = (name, size)
+            self.total_bytes += size
+            self.stores += 1
+            self._evict()
+        return str(self.directory / name)
+
+    @staticmethod
+    def _link_or_copy(source, target):
+        try:
+            os.link(source, target)
+        except OSError:
+            # Разные файловые системы или ФС без жестких ссылок
+            shutil.copyfile(source, target)
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self._entries:
+            _, (name, size) = self._entries.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+            (self.directory / name).unlink(missing_ok=True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+                'stores': self.stores,
+                'evictions': self.evictions,
+            }
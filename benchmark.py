@@ -0,0 +1,482 @@
+# -*- coding: utf-8 -*-
+"""Офлайн-бенчмарк бота: поиск -> выбор -> скачивание -> отправка без сети.
+
+Гоняет настоящие обработчики (handle_text/handle_callback из mainerror.py,
+handle_find_command из main.py) на синтетических Update против поддельных
+SoundCloud (FakeSearchBackend), yt-dlp и Telegram с настраиваемыми задержками.
+Печатает p50/p95/p99 по этапам и пропускную способность для каждого уровня параллельности.
+
+    python benchmark.py --bot mainerror --concurrency 1,8,32 --requests 200
+    python benchmark.py --bot main --search-latency 0.2 --download-latency 0.5
+    python benchmark.py --redis --replicas 2   # L2-кэш на InMemoryRedis, общий для реплик
+"""
+import os
+import io
+import sys
+import time
+import json
+import random
+import shutil
+import asyncio
+import argparse
+import logging
+import tempfile
+import threading
+import contextlib
+from types import SimpleNamespace
+from pathlib import Path
+
+# Бенчмарк не должен трогать рабочие данные, Redis и диск кэша
+os.environ.setdefault('BOT_TOKEN', 'benchmark')
+os.environ['SEARCH_BACKEND'] = 'fake'
+os.environ['SEARCH_CACHE_DB'] = ''
+os.environ['FILE_ID_CACHE_DB'] = ''
+# Относительный путь: у каждого уровня своя рабочая папка и свой аудиокэш
+os.environ['AUDIO_CACHE_DIR'] = 'audio_cache'
+os.environ.pop('REDIS_URL', None)
+os.environ.pop('DATABASE_URL', None)
+os.environ.pop('HEALTH_PORT', None)
+
+import yt_dlp
+
+from search_backend import FakeSearchBackend
+from redis_client import InMemoryRedis, redis_client
+from query_normalizer import normalize_query
+from ydl_pool import ydl_pool
+
+QUERIES = [
+    'lo fi beats', 'chillhop', 'deep house', 'synthwave', 'indie rock',
+    'electronic music', 'jazz lounge', 'ambient', 'study music', 'focus music',
+    'relaxing music', 'instrumental', 'acoustic', 'drum and bass', 'techno',
+]
+
+
+# ==================== ЗАМЕРЫ ====================
+
+class StageRecorder:
+    """Длительности по этапам; пишется и из event loop, и из потоков yt-dlp"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {}
+        self.errors = {}
+        self.cancelled = {}
+
+    def add(self, stage: str, seconds: float, ok: bool = True, cancelled: bool = False):
+        with self._lock:
+            self.samples.setdefault(stage, []).append(seconds)
+            if cancelled:
+                self.cancelled[stage] = self.cancelled.get(stage, 0) + 1
+            elif not ok:
+                self.errors[stage] = self.errors.get(stage, 0) + 1
+
+    @staticmethod
+    def percentile(values: list, p: float) -> float:
+        ordered = sorted(values)
+        index = min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered) + 0.5)) - 1))
+        return ordered[index]
+
+    def summary(self) -> dict:
+        return {
+            stage: {
+                'count': len(values),
+                'errors': self.errors.get(stage, 0),
+                'cancelled': self.cancelled.get(stage, 0),
+                'p50_ms': round(self.percentile(values, 50) * 1000, 1),
+                'p95_ms': round(self.percentile(values, 95) * 1000, 1),
+                'p99_ms': round(self.percentile(values, 99) * 1000, 1),
+            }
+            for stage, values in self.samples.items()
+        }
+
+
+def instrument(obj, name: str, stage: str, recorder: StageRecorder):
+    """Оборачивает асинхронный метод объекта замером времени; исключение или False - ошибка,
+    отмена (например, лишние подзапросы deep_search) считается отдельно"""
+    original = getattr(obj, name)
+
+    async def timed(*args, **kwargs):
+        start = time.perf_counter()
+        ok = cancelled = False
+        try:
+            result = await original(*args, **kwargs)
+            # None - обычный результат обработчика, False - неудача (скачивание и т.п.)
+            ok = result is not False
+            return result
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        finally:
+            recorder.add(stage, time.perf_counter() - start, ok, cancelled)
+
+    setattr(obj, name, timed)
+
+
+# ==================== ПОДДЕЛЬНЫЙ YT-DLP ====================
+
+class FakeYoutubeDL:
+    """Заменяет yt_dlp.YoutubeDL: получение метаданных и скачивание
+    с заданной задержкой, в outtmpl пишется файл нужного размера"""
+
+    latency = 0.05
+    download_latency = 0.2
+    file_size = 64 * 1024
+    error_rate = 0.0
+    recorder: StageRecorder = None
+    _rng = random.Random(0)
+    _rng_lock = threading.Lock()
+
+    def __init__(self, params: dict = None, *args, **kwargs):
+        self.params = params or {}
+        self._progress_hooks = list(self.params.get('progress_hooks') or [])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def close(self):
+        pass
+
+    @staticmethod
+    def sanitize_info(info_dict, remove_private_keys=False):
+        return dict(info_dict) if info_dict is not None else None
+
+    def add_progress_hook(self, hook):
+        self._progress_hooks.append(hook)
+
+    def _transfer(self, seconds: float, chunks: int = 10):
+        """Имитация скачивания по частям: progress hooks вызываются на каждую часть"""
+        for i in range(chunks):
+            time.sleep(seconds / chunks)
+            for hook in self._progress_hooks:
+                hook({'status': 'downloading', 'downloaded_bytes': self.file_size * (i + 1) // chunks,
+                      'total_bytes': self.file_size})
+
+    def extract_info(self, url: str, download: bool = True, **kwargs) -> dict:
+        stage = 'ytdlp_download' if download else 'ytdlp_probe'
+        start = time.perf_counter()
+        with self._rng_lock:
+            fail = self._rng.random() < self.error_rate
+        try:
+            if download:
+                self._transfer(self.download_latency)
+            else:
+                time.sleep(self.latency)
+            if fail:
+                raise yt_dlp.utils.DownloadError(f"Fake download error: {url}")
+
+            slug = url.rstrip('/').rsplit('/', 1)[-1] or 'track'
+            info = {
+                'id': slug,
+                'title': slug.replace('-', ' '),
+                'ext': 'm4a',
+                'webpage_url': url,
+                'duration': 200,
+                'filesize': self.file_size,
+                'formats': [{'format_id': 'aac', 'ext': 'm4a', 'vcodec': 'none', 'filesize': self.file_size}],
+            }
+            if download:
+                outtmpl = self.params.get('outtmpl') or '%(id)s.%(ext)s'
+                if isinstance(outtmpl, dict):
+                    outtmpl = outtmpl.get('default', '%(id)s.%(ext)s')
+                path = os.path.join((self.params.get('paths') or {}).get('home', ''), outtmpl % info)
+                os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+                with open(path, 'wb') as f:
+                    f.write(os.urandom(self.file_size))
+                info['requested_downloads'] = [{'filepath': path}]
+                info['filepath'] = path
+            return info
+        except yt_dlp.utils.DownloadCancelled:
+            fail = True
+            raise
+        finally:
+            if self.recorder:
+                self.recorder.add(stage, time.perf_counter() - start, not fail)
+
+    def process_ie_result(self, ie_result: dict, download: bool = True, **kwargs) -> dict:
+        return self.extract_info(ie_result.get('webpage_url'), download=download)
+
+
+# ==================== ПОДДЕЛЬНЫЙ TELEGRAM ====================
+
+class FakeTelegram:
+    """Имитация Bot API: задержка на каждый вызов, send_audio читает файл целиком"""
+
+    def __init__(self, latency: float, recorder: StageRecorder):
+        self.latency = latency
+        self.recorder = recorder
+        self.sent_audio = 0
+        self._file_ids = 0
+
+    async def call(self, method: str):
+        await asyncio.sleep(self.latency)
+        return FakeMessage(self)
+
+    async def send_audio(self, chat_id=None, audio=None, **kwargs):
+        start = time.perf_counter()
+        size = len(audio.read()) if hasattr(audio, 'read') else None
+        message = await self.call('send_audio')
+        self._file_ids += 1
+        message.audio = SimpleNamespace(file_id=f"fake-file-{self._file_ids}", file_unique_id=str(self._file_ids),
+                                        file_size=size)
+        self.sent_audio += 1
+        self.recorder.add('telegram_send_audio', time.perf_counter() - start)
+        return message
+
+    async def send_message(self, chat_id=None, text=None, **kwargs):
+        return await self.call('send_message')
+
+    async def send_chat_action(self, *args, **kwargs):
+        return True
+
+
+class FakeMessage:
+    def __init__(self, telegram: FakeTelegram, text: str = ''):
+        self.telegram = telegram
+        self.text = text
+        self.message_id = random.randint(1, 10 ** 9)
+        self.audio = None
+
+    async def reply_text(self, text, **kwargs):
+        return await self.telegram.call('reply_text')
+
+    async def edit_text(self, text, **kwargs):
+        return await self.telegram.call('edit_text')
+
+    async def delete(self):
+        return await self.telegram.call('delete')
+
+
+class FakeCallbackQuery:
+    def __init__(self, telegram: FakeTelegram, data: str, user):
+        self.data = data
+        self.from_user = user
+        self.message = FakeMessage(telegram)
+        self.telegram = telegram
+
+    async def answer(self, *args, **kwargs):
+        return await self.telegram.call('answer')
+
+    async def edit_message_text(self, text, **kwargs):
+        return await self.telegram.call('edit_message_text')
+
+
+def make_user(user_id: int):
+    return SimpleNamespace(
+        id=user_id, first_name=f'bench{user_id}', username=f'bench{user_id}', is_bot=False,
+        mention_html=lambda: f'<a href="tg://user?id={user_id}">bench{user_id}</a>',
+    )
+
+
+def make_update(telegram: FakeTelegram, user_id: int, text: str = None, callback_data: str = None):
+    user = make_user(user_id)
+    return SimpleNamespace(
+        effective_user=user,
+        effective_chat=SimpleNamespace(id=user_id, type='private'),
+        message=FakeMessage(telegram, text) if text is not None else None,
+        callback_query=FakeCallbackQuery(telegram, callback_data, user) if callback_data else None,
+    )
+
+
+def make_context(telegram: FakeTelegram):
+    return SimpleNamespace(bot=telegram, args=[], user_data={}, chat_data={})
+
+
+# ==================== СЦЕНАРИИ ====================
+
+def pick_query(rng: random.Random, distinct: int) -> str:
+    """Запросы с распределением Ципфа: популярные повторяются, хвост уникален"""
+    index = min(int(rng.paretovariate(1.2)) - 1, distinct - 1)
+    return QUERIES[index] if index < len(QUERIES) else f'{QUERIES[index % len(QUERIES)]} {index}'
+
+
+async def scenario_mainerror(bot, telegram, user_id: int, query: str, recorder: StageRecorder):
+    start = time.perf_counter()
+    await bot.handle_text(make_update(telegram, user_id, text=query), make_context(telegram))
+    await bot.handle_callback(make_update(telegram, user_id, callback_data='download:0:0'), make_context(telegram))
+    recorder.add('scenario_total', time.perf_counter() - start)
+
+
+async def scenario_main(bot, telegram, user_id: int, query: str, recorder: StageRecorder):
+    start = time.perf_counter()
+    text = f'найди {query}'
+    await bot.handle_find_command(make_update(telegram, user_id, text=text), make_context(telegram), text)
+    recorder.add('scenario_total', time.perf_counter() - start)
+
+
+def create_bot(name: str, args, recorder: StageRecorder):
+    backend = FakeSearchBackend(latency=args.search_latency, jitter=args.search_jitter,
+                                error_rate=args.error_rate, seed=args.seed)
+    instrument(backend, 'search', 'backend_search', recorder)
+
+    if name == 'mainerror':
+        import mainerror
+        bot = mainerror.StableMusicBot(search_backend=backend)
+        instrument(bot, 'handle_text', 'handle_text', recorder)
+        instrument(bot, 'handle_callback', 'handle_callback', recorder)
+        instrument(bot, 'search_soundcloud', 'search', recorder)
+        instrument(bot, 'download_and_send_track', 'download_and_send', recorder)
+        return bot, scenario_mainerror
+
+    import main
+    bot = main.AdvancedMusicBot(search_backend=backend)
+    instrument(bot, 'handle_find_command', 'handle_find_command', recorder)
+    instrument(bot, 'deep_search', 'search', recorder)
+    instrument(bot.ai_engine, 'smart_track_selection', 'select', recorder)
+    instrument(bot, 'download_track', 'download', recorder)
+    # Лимит запросов в минуту не должен искажать замер
+    bot.rate_limiter.is_limited = lambda *a, **kw: False
+    return bot, scenario_main
+
+
+def reset_bot_state(name: str, level_dir: str):
+    """Сбрасывает кэши уровня модуля, чтобы уровни параллельности не грели друг другу кэш.
+
+    Кэши экземпляра бота (поиск, file_id, метаданные, аудио, ответы ИИ)
+    создаются заново вместе с ботом в рабочей папке уровня."""
+    ydl_pool.clear()
+    normalize_query.cache_clear()
+    if name != 'mainerror':
+        return
+
+    import mainerror
+    mainerror.POPULAR_QUERIES_CACHE.clear()
+    mainerror.SEARCH_CACHE.clear()
+    mainerror.sessions = mainerror.SessionStore(ttl=mainerror.SESSION_TTL)
+    mainerror.user_repository = mainerror.create_user_repository(None, Path(level_dir) / 'user_data.db')
+    mainerror.user_saver = mainerror.WriteBehindSaver(mainerror.user_repository, delay=mainerror.USER_SAVE_DELAY)
+    mainerror.load_data()
+
+
+async def run_level(name: str, concurrency: int, args, workdir: str) -> dict:
+    level_dir = tempfile.mkdtemp(prefix=f'level_{concurrency}_', dir=workdir)
+    os.chdir(level_dir)
+    reset_bot_state(name, level_dir)
+
+    recorder = StageRecorder()
+    FakeYoutubeDL.recorder = recorder
+    telegram = FakeTelegram(args.telegram_latency, recorder)
+    bot, scenario = create_bot(name, args, recorder)
+    # Реплики бота в одном процессе делят только Redis (L2), как на нескольких серверах
+    redis_client.redis = InMemoryRedis(latency=args.redis_latency) if args.redis else None
+    replicas = [(bot, scenario)] + [create_bot(name, args, recorder) for _ in range(args.replicas - 1)]
+    rng = random.Random(args.seed)
+    jobs = [(i + 1, pick_query(rng, args.distinct)) for i in range(args.requests)]
+    queue = asyncio.Queue()
+    for job in jobs:
+        queue.put_nowait(job)
+
+    async def worker():
+        while not queue.empty():
+            user_id, query = queue.get_nowait()
+            replica, run_scenario = replicas[user_id % len(replicas)]
+            await run_scenario(replica, telegram, user_id, query, recorder)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    if name == 'mainerror':
+        # Отложенная запись user_data привязана к этому event loop
+        import mainerror
+        mainerror.flush_data()
+
+    return {
+        'bot': name,
+        'concurrency': concurrency,
+        'requests': len(jobs),
+        'elapsed_s': round(elapsed, 3),
+        'throughput_rps': round(len(jobs) / elapsed, 2) if elapsed else 0.0,
+        'audio_sent': telegram.sent_audio,
+        'replicas': len(replicas),
+        'l2_cache': l2_stats([replica for replica, _ in replicas]) if args.redis else None,
+        'stages': recorder.summary(),
+    }
+
+
+def l2_stats(bots: list) -> dict:
+    """Суммарные попадания в Redis по всем TwoTierCache реплик"""
+    caches = [getattr(bot, 'shared_cache', None) for bot in bots]
+    caches += [getattr(getattr(bot, 'ai_engine', None), 'llm_cache', None) for bot in bots]
+    hits = sum(cache.l2_hits for cache in caches if cache is not None)
+    misses = sum(cache.l2_misses for cache in caches if cache is not None)
+    return {'hits': hits, 'misses': misses, 'hit_rate': round(hits / (hits + misses), 3) if hits + misses else 0.0}
+
+
+def print_report(report: dict):
+    print(f"\n=== {report['bot']} | concurrency={report['concurrency']} | "
+          f"{report['requests']} req за {report['elapsed_s']} с | "
+          f"{report['throughput_rps']} req/s | отправлено аудио: {report['audio_sent']}")
+    if report['l2_cache']:
+        l2 = report['l2_cache']
+        print(f"реплик: {report['replicas']} | Redis L2: {l2['hits']} попаданий, "
+              f"{l2['misses']} промахов, hit rate {l2['hit_rate']}")
+    print(f"{'этап':<24}{'n':>7}{'ошибки':>8}{'отмены':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for stage, row in sorted(report['stages'].items()):
+        print(f"{stage:<24}{row['count']:>7}{row['errors']:>8}{row['cancelled']:>8}"
+              f"{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Офлайн-бенчмарк обработчиков бота')
+    parser.add_argument('--bot', choices=['mainerror', 'main'], default='mainerror')
+    parser.add_argument('--concurrency', default='1,8,32', help='уровни параллельности через запятую')
+    parser.add_argument('--requests', type=int, default=100, help='сценариев на уровень')
+    parser.add_argument('--distinct', type=int, default=50, help='число разных запросов')
+    parser.add_argument('--search-latency', type=float, default=0.05)
+    parser.add_argument('--search-jitter', type=float, default=0.02)
+    parser.add_argument('--probe-latency', type=float, default=0.05)
+    parser.add_argument('--download-latency', type=float, default=0.2)
+    parser.add_argument('--file-kb', type=int, default=64)
+    parser.add_argument('--telegram-latency', type=float, default=0.01)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--redis', action='store_true', help='L2-кэш на InMemoryRedis вместо сервера Redis')
+    parser.add_argument('--redis-latency', type=float, default=0.001)
+    parser.add_argument('--replicas', type=int, default=1, help='экземпляров бота с общим Redis')
+    parser.add_argument('--json', action='store_true', help='вывести отчет в JSON')
+    parser.add_argument('--verbose', action='store_true', help='не глушить логи и print бота')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    # Данные бота (user_data, чарты, аудиокэш) пишутся во временную папку,
+    # у каждого уровня параллельности - своя
+    workdir = tempfile.mkdtemp(prefix='music_bot_bench_')
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(workdir)
+
+    FakeYoutubeDL.latency = args.probe_latency
+    FakeYoutubeDL.download_latency = args.download_latency
+    FakeYoutubeDL.file_size = args.file_kb * 1024
+    FakeYoutubeDL.error_rate = args.error_rate
+    FakeYoutubeDL._rng = random.Random(args.seed)
+    yt_dlp.YoutubeDL = FakeYoutubeDL
+
+    quiet = not args.verbose
+    reports = []
+    try:
+        for concurrency in [int(level) for level in args.concurrency.split(',') if level.strip()]:
+            output = io.StringIO() if quiet else sys.stdout
+            with contextlib.redirect_stdout(output):
+                if quiet:
+                    logging.disable(logging.WARNING)
+                reports.append(asyncio.run(run_level(args.bot, concurrency, args, workdir)))
+                logging.disable(logging.NOTSET)
+    finally:
+        os.chdir(tempfile.gettempdir())
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(reports, ensure_ascii=False, indent=2))
+    else:
+        for report in reports:
+            print_report(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import asyncio
+import threading
+import concurrent.futures
+from typing import Any, Callable
+
+# Отдельные пулы потоков, чтобы долгие скачивания не занимали потоки поиска
+SEARCH_WORKERS = int(os.environ.get('SEARCH_WORKERS', 8))
+SEARCH_QUEUE = int(os.environ.get('SEARCH_QUEUE', 32))
+METADATA_WORKERS = int(os.environ.get('METADATA_WORKERS', 4))
+METADATA_QUEUE = int(os.environ.get('METADATA_QUEUE', 32))
+DOWNLOAD_WORKERS = int(os.environ.get('DOWNLOAD_WORKERS', 4))
+DOWNLOAD_QUEUE = int(os.environ.get('DOWNLOAD_QUEUE', 16))
+DISK_WORKERS = int(os.environ.get('DISK_WORKERS', 2))
+DISK_QUEUE = int(os.environ.get('DISK_QUEUE', 64))
+
+
+class ExecutorBusy(RuntimeError):
+    """Очередь пула заполнена - задача не принята"""
+
+
+class TaskOverdue(asyncio.TimeoutError):
+    """Таймаут, после которого задача не остановилась за grace и еще выполняется.
+
+    Ее поток и файлы заняты: повтор в той же папке или параллельный повтор
+    дал бы второе скачивание того же трека."""
+
+
+class BoundedExecutor:
+    """Пул потоков с ограниченной очередью.
+
+    Если задач в работе и в очереди уже max_workers + max_queue, новая
+    отклоняется сразу с ExecutorBusy, а не ждет неограниченно долго.
+    Задача, отмененная до начала выполнения, освобождает место в очереди."""
+
+    def __init__(self, name: str, max_workers: int, max_queue: int):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.active = 0
+        self.submitted = 0
+        self.completed = 0
+        self.rejected = 0
+        self.cancelled = 0
+        self.cancel_overdue = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    @property
+    def saturated(self) -> bool:
+        return self.pending >= self.max_workers + self.max_queue
+
+    def submit(self, func: Callable, *args) -> concurrent.futures.Future:
+        with self._lock:
+            if self.saturated:
+                self.rejected += 1
+                raise ExecutorBusy(f"Пул {self.name} перегружен: {self.pending} задач")
+            self.pending += 1
+            self.submitted += 1
+        queued_at = time.monotonic()
+
+        def call():
+            waited = time.monotonic() - queued_at
+            with self._lock:
+                self.active += 1
+                self._wait_total += waited
+                self._wait_max = max(self._wait_max, waited)
+            try:
+                return func(*args)
+            finally:
+                with self._lock:
+                    self.active -= 1
+                    self.pending -= 1
+                    self.completed += 1
+
+        future = self._executor.submit(call)
+        future.add_done_callback(self._release_cancelled)
+        return future
+
+    def _release_cancelled(self, future: concurrent.futures.Future):
+        # call() не запускался - счетчик очереди уменьшаем здесь
+        if future.cancelled():
+            with self._lock:
+                self.pending -= 1
+
+    async def run(self, func: Callable, *args) -> Any:
+        """Аналог loop.run_in_executor для этого пула"""
+        return await asyncio.wrap_future(self.submit(func, *args))
+
+    async def run_cancellable(self, func: Callable, *args, timeout: float, grace: float = 15.0) -> Any:
+        """run с таймаутом, который действительно останавливает задачу.
+
+        func получает threading.Event последним аргументом и должна завершиться,
+        когда он установлен (для yt-dlp - через progress hook). По таймауту задача
+        снимается с очереди, а запущенная ожидается до grace секунд, чтобы поток
+        и файлы освободились до повтора или очистки. Затем - asyncio.TimeoutError,
+        а если задача так и не остановилась - TaskOverdue (его подкласс)."""
+        cancel_event = threading.Event()
+        future = self.submit(func, *args, cancel_event)
+        wrapped = asyncio.wrap_future(future)
+        try:
+            return await asyncio.wait_for(asyncio.shield(wrapped), timeout)
+        except asyncio.TimeoutError:
+            cancel_event.set()
+            self.cancelled += 1
+            # Результат брошенной задачи (обычно DownloadCancelled) никто не ждет
+            wrapped.add_done_callback(lambda f: f.cancelled() or f.exception())
+            if not future.cancel():
+                done, _ = await asyncio.wait({wrapped}, timeout=grace)
+                if not done:
+                    self.cancel_overdue += 1
+                    raise TaskOverdue(f"Задача пула {self.name} не остановилась за {grace} с")
+            raise
+        except asyncio.CancelledError:
+            cancel_event.set()
+            future.cancel()
+            raise
+
+    def stats(self) -> dict:
+        with self._lock:
+            started = self.completed + self.active
+            return {
+                'workers': self.max_workers,
+                'active': self.active,
+                'queued': self.pending - self.active,
+                'max_queue': self.max_queue,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'cancelled': self.cancelled,
+                'cancel_overdue': self.cancel_overdue,
+                'wait_ms_avg': round(self._wait_total / started * 1000, 1) if started else 0.0,
+                'wait_ms_max': round(self._wait_max * 1000, 1),
+            }
+
+
+search_executor = BoundedExecutor('search', SEARCH_WORKERS, SEARCH_QUEUE)
+metadata_executor = BoundedExecutor('metadata', METADATA_WORKERS, METADATA_QUEUE)
+download_executor = BoundedExecutor('download', DOWNLOAD_WORKERS, DOWNLOAD_QUEUE)
+disk_executor = BoundedExecutor('disk', DISK_WORKERS, DISK_QUEUE)
+
+EXECUTORS = {
+    executor.name: executor
+    for executor in (search_executor, metadata_executor, download_executor, disk_executor)
+}
+
+
+def executor_stats() -> dict:
+    return {name: executor.stats() for name, executor in EXECUTORS.items()}
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+import time
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Optional
+
+FILE_ID_SCHEMA = """
+CREATE TABLE IF NOT EXISTS telegram_files (
+    url TEXT PRIMARY KEY,
+    file_id TEXT NOT NULL,
+    file_unique_id TEXT,
+    size_bytes INTEGER,
+    created_at REAL NOT NULL
+);
+"""
+
+
+class TelegramFileIdCache:
+    """URL трека -> file_id уже загруженного в Telegram аудио.
+
+    Повторная отправка по file_id не требует ни скачивания, ни загрузки файла.
+    Индекс хранится в SQLite и целиком держится в памяти (строка - десятки байт),
+    поэтому get не обращается к диску. Без db_file работает только в памяти."""
+
+    def __init__(self, db_file: Path = None):
+        self.db_file = Path(db_file) if db_file else None
+        self.hits = 0
+        self.misses = 0
+        self.invalidated = 0
+        self._lock = threading.Lock()
+        self._conn = None
+        self._files = {}
+
+        if self.db_file:
+            self._conn = sqlite3.connect(str(self.db_file), check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.executescript(FILE_ID_SCHEMA)
+            self._files = {
+                url: (file_id, size_bytes)
+                for url, file_id, size_bytes in self._conn.execute(
+                    "SELECT url, file_id, size_bytes FROM telegram_files"
+                )
+            }
+
+    def get(self, url: str) -> Optional[tuple]:
+        """Возвращает (file_id, размер в байтах или None) или None"""
+        entry = self._files.get(url) if url else None
+        if entry:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return entry
+
+    def remember(self, url: str, message) -> Optional[str]:
+        """Сохраняет file_id из ответа send_audio; возвращает его или None"""
+        audio = getattr(message, 'audio', None)
+        file_id = getattr(audio, 'file_id', None)
+        if not url or not file_id:
+            return None
+
+        size_bytes = getattr(audio, 'file_size', None)
+        with self._lock:
+            self._files[url] = (file_id, size_bytes)
+            if self._conn:
+                with self._conn:
+                    self._conn.execute(
+                        "INSERT INTO telegram_files (url, file_id, file_unique_id, size_bytes, created_at) "
+                        "VALUES (?, ?, ?, ?, ?) ON CONFLICT(url) DO UPDATE SET "
+                        "file_id = excluded.file_id, file_unique_id = excluded.file_unique_id, "
+                        "size_bytes = excluded.size_bytes, created_at = excluded.created_at",
+                        (url, file_id, getattr(audio, 'file_unique_id', None), size_bytes, time.time())
+                    )
+        return file_id
+
+    def discard(self, url: str):
+        """Убирает file_id, который Telegram больше не принимает"""
+        with self._lock:
+            if self._files.pop(url, None) is None:
+                return
+            self.invalidated += 1
+            if self._conn:
+                with self._conn:
+                    self._conn.execute("DELETE FROM telegram_files WHERE url = ?", (url,))
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._files),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+            'invalidated': self.invalidated,
+            'file_bytes': self.db_file.stat().st_size if self.db_file and self.db_file.exists() else 0,
+        }
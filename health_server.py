@@ -4,6 +4,9 @@ import asyncio
 import psutil
 import time
 
+from executors import executor_stats
+from ydl_pool import ydl_pool
+
 class HealthServer:
     def __init__(self, bot_instance=None, port=8080):
         self.bot = bot_instance
@@ -19,11 +22,17 @@ class HealthServer:
     
     async def health_check(self, request):
         """Простая проверка здоровья"""
-        return web.json_response({
+        health = {
             "status": "healthy",
             "timestamp": time.time(),
             "uptime": round(time.time() - self.start_time, 2)
-        })
+        }
+
+        warmup = getattr(self.bot, 'warmup', None)
+        if warmup is not None:
+            health["warmup"] = warmup.stats()
+
+        return web.json_response(health)
     
     async def metrics(self, request):
         """Метрики для мониторинга"""
@@ -37,6 +46,41 @@ class HealthServer:
             "active_threads": process.num_threads(),
             "uptime_seconds": round(time.time() - self.start_time, 2)
         }
+
+        search_cache = getattr(self.bot, 'search_cache', None)
+        if search_cache is not None:
+            metrics["search_cache"] = search_cache.stats()
+
+        shared_cache = getattr(self.bot, 'shared_cache', None)
+        if shared_cache is not None:
+            metrics["search_cache_l2"] = shared_cache.stats()
+
+        query_stats = getattr(self.bot, 'query_stats', None)
+        if query_stats is not None:
+            metrics["query_normalization"] = query_stats.stats()
+
+        search_flight = getattr(self.bot, 'search_flight', None)
+        if search_flight is not None:
+            metrics["search_single_flight"] = search_flight.stats()
+
+        warmup = getattr(self.bot, 'warmup', None)
+        if warmup is not None:
+            metrics["warmup"] = warmup.stats()
+
+        refresher = getattr(self.bot, 'refresher', None)
+        if refresher is not None:
+            metrics["background_refresh"] = refresher.stats()
+
+        file_id_cache = getattr(self.bot, 'file_id_cache', None)
+        if file_id_cache is not None:
+            metrics["telegram_file_ids"] = file_id_cache.stats()
+
+        audio_cache = getattr(self.bot, 'audio_cache', None)
+        if audio_cache is not None:
+            metrics["audio_cache"] = audio_cache.stats()
+
+        metrics["ydl_pool"] = ydl_pool.stats()
+        metrics["executors"] = executor_stats()
         
         return web.json_response(metrics)
     
@@ -49,7 +93,8 @@ class HealthServer:
         def run_server():
             loop = asyncio.new_event_loop()
             asyncio.set_event_loop(loop)
-            web.run_app(self.app, port=self.port, host='0.0.0.0')
+            # Сигналы можно перехватывать только в главном потоке, их обрабатывает бот
+            web.run_app(self.app, port=self.port, host='0.0.0.0', handle_signals=False)
         
         thread = threading.Thread(target=run_server, daemon=True)
         thread.start()
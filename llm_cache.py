@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+import json
+import hashlib
+
+from search_cache import SearchCache, TwoTierCache
+
+
+def llm_cache_key(template: str, version: int, **inputs) -> str:
+    """Ключ ответа LLM по содержимому: имя и версия шаблона промпта + входные данные.
+
+    При изменении текста промпта нужно поднять version, чтобы старые ответы не использовались."""
+    payload = json.dumps([template, version, inputs], ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    return f"{template}:v{version}:{hashlib.sha256(payload.encode('utf-8')).hexdigest()}"
+
+
+class LLMResponseCache(TwoTierCache):
+    """Кэш ответов LLM: LRU в памяти с TTL и, если подключен Redis, общий L2"""
+
+    def __init__(self, max_bytes: int = 8 * 1024 * 1024, ttl: float = 24 * 3600, redis_client=None):
+        super().__init__(SearchCache(max_bytes=max_bytes, ttl=ttl), redis_client, prefix='llm:')
+
+    def stats(self) -> dict:
+        stats = self.local.stats()
+        stats.update(super().stats())
+        return stats
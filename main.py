@@ -13,6 +13,11 @@ import aiohttp
 from datetime import datetime, timedelta
 from pathlib import Path
 from collections import defaultdict
+from file_id_cache import TelegramFileIdCache
+from llm_cache import LLMResponseCache, llm_cache_key
+from query_normalizer import normalize_query
+from redis_client import redis_client
+from track_ranker import LinearTrackRanker
 
 # ==================== CONFIG ====================
 BOT_TOKEN = os.environ.get('BOT_TOKEN')
@@ -28,7 +33,46 @@ print("🔧 Music Bot с РЕАЛЬНО умным поиском запуска
 MAX_FILE_SIZE_MB = int(os.environ.get('MAX_FILE_SIZE_MB', 50))
 DOWNLOAD_TIMEOUT = int(os.environ.get('DOWNLOAD_TIMEOUT', 90))
 SEARCH_TIMEOUT = int(os.environ.get('SEARCH_TIMEOUT', 30))
+# Сколько поисков SoundCloud идет одновременно во всем боте
+SEARCH_CONCURRENCY = int(os.environ.get('SEARCH_CONCURRENCY', 12))
+# Сколько из них может занять один глубокий поиск (он делает до 6 подзапросов),
+# чтобы один пользователь не забирал все слоты
+DEEP_SEARCH_CONCURRENCY = int(os.environ.get('DEEP_SEARCH_CONCURRENCY', 3))
+# Глубокий поиск останавливается, набрав столько уникальных треков
+DEEP_SEARCH_TARGET = 15
+# Источник поиска: ytdlp - SoundCloud через yt-dlp, fake - локальная имитация для бенчмарков
+SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND', 'ytdlp')
 REQUESTS_PER_MINUTE = int(os.environ.get('REQUESTS_PER_MINUTE', 8))
+# Как ИИ оценивает кандидатов: batch - один запрос на всех, sequential - по запросу на трек,
+# concurrent - запросы на треки параллельно с общим дедлайном
+AI_SCORING_MODE = os.environ.get('AI_SCORING_MODE', 'batch')
+AI_ANALYSIS_CONCURRENCY = int(os.environ.get('AI_ANALYSIS_CONCURRENCY', 4))
+AI_ANALYSIS_DEADLINE = float(os.environ.get('AI_ANALYSIS_DEADLINE', 10))
+AI_MAX_CANDIDATES = 12
+SCORE_KEYS = ('relevance', 'genre_match', 'mood_match', 'quality', 'overall')
+# Кэш ответов ИИ (профили запросов и оценки треков); при REDIS_URL - общий для реплик
+LLM_CACHE_TTL = int(os.environ.get('LLM_CACHE_TTL', 24 * 3600))
+LLM_CACHE_MAX_BYTES = int(os.environ.get('LLM_CACHE_MAX_BYTES', 8 * 1024 * 1024))
+# Версии промптов входят в ключ кэша: поднимать при изменении текста промпта
+PROFILE_PROMPT_VERSION = 1
+TRACK_SCORE_PROMPT_VERSION = 1
+# Локальный ранжировщик решает сам, если лидер опережает второй трек на RANKER_MARGIN
+# (в логитах); веса можно подменить JSON-файлом RANKER_WEIGHTS_FILE
+RANKER_MARGIN = float(os.environ.get('RANKER_MARGIN', 0.5))
+RANKER_WEIGHTS_FILE = os.environ.get('RANKER_WEIGHTS_FILE')
+# URL трека -> file_id в Telegram: повторные запросы трека отправляются без скачивания
+FILE_ID_CACHE_DB = os.environ.get('FILE_ID_CACHE_DB', 'telegram_files.db')
+
+# Профиль скачивания для пула YoutubeDL: временная папка задается на вызов через paths
+DOWNLOAD_OPTS = {
+    'format': 'bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio/best',
+    'outtmpl': '%(title).100s.%(ext)s',
+    'quiet': True,
+    'no_warnings': True,
+    'retries': 2,
+    'max_filesize': MAX_FILE_SIZE_MB * 1024 * 1024,
+    'ignoreerrors': True,
+}
 
 # ==================== RATE LIMITER ====================
 class RateLimiter:
@@ -61,8 +105,7 @@ try:
         Application, CommandHandler, MessageHandler, 
         filters, ContextTypes
     )
-    from telegram.error import Conflict, TimedOut, NetworkError
-    import yt_dlp
+    from telegram.error import Conflict, TimedOut, NetworkError, TelegramError
     print("✅ Все зависимости загружены")
 except ImportError as exc:
     print(f"❌ Ошибка импорта: {exc}")
@@ -73,13 +116,16 @@ except ImportError as exc:
             Application, CommandHandler, MessageHandler,
             filters, ContextTypes
         )
-        from telegram.error import Conflict, TimedOut, NetworkError
-        import yt_dlp
+        from telegram.error import Conflict, TimedOut, NetworkError, TelegramError
         print("✅ Зависимости успешно установлены")
     except ImportError as exc2:
         print(f"❌ Ошибка импорта после установки: {exc2}")
         sys.exit(1)
 
+from search_backend import SEARCH_OPTS, create_search_backend
+from ydl_pool import ydl_pool
+from executors import disk_executor, download_executor
+
 # Настройка логирования
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -89,17 +135,38 @@ logger = logging.getLogger(__name__)
 
 # ==================== REAL AI SEARCH ENGINE ====================
 class RealAISearchEngine:
-    def __init__(self, api_key: str = None):
+    def __init__(self, api_key: str = None, ranker=None):
         self.api_key = api_key or DEEPSEEK_API_KEY
+        # Быстрый путь до ИИ: любой объект с rank(tracks, query) и is_confident(ranked);
+        # record_outcome(track, success) необязателен - через него ранжировщик учится на скачиваниях
+        self.ranker = ranker or self._create_ranker()
         self.base_url = "https://api.deepseek.com/v1/chat/completions"
         self.enabled = bool(self.api_key)
         self.session = None
+        self.llm_cache = LLMResponseCache(
+            max_bytes=LLM_CACHE_MAX_BYTES, ttl=LLM_CACHE_TTL, redis_client=redis_client
+        )
         
         if self.enabled:
             print("✅ Реальный ИИ-поиск активирован")
         else:
             print("❌ ИИ недоступен, используется улучшенный стандартный поиск")
     
+    @staticmethod
+    def _create_ranker():
+        if RANKER_WEIGHTS_FILE:
+            try:
+                return LinearTrackRanker.from_file(Path(RANKER_WEIGHTS_FILE), margin=RANKER_MARGIN)
+            except Exception as e:
+                print(f"⚠️ Не удалось загрузить веса ранжировщика: {e}")
+        return LinearTrackRanker(margin=RANKER_MARGIN)
+
+    def record_outcome(self, track: dict, success: bool):
+        """Передает ранжировщику итог скачивания, если он это поддерживает"""
+        record_outcome = getattr(self.ranker, 'record_outcome', None)
+        if record_outcome is not None:
+            record_outcome(track, success)
+
     async def get_session(self):
         if self.session is None:
             self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=20))
@@ -109,18 +176,28 @@ class RealAISearchEngine:
         """
         РЕАЛЬНЫЙ умный выбор трека на основе глубокого анализа
         """
-        if not self.enabled or len(search_results) == 0:
+        if len(search_results) == 0:
             return self._fallback_selection(search_results)
+
+        # Шаг 0: Локальная оценка; к ИИ идут только неоднозначные случаи.
+        # Без ИИ выбирать не из чего - is_confident не вызываем, чтобы не искажать его счетчики
+        ranked = self.ranker.rank(search_results, user_query)
+        if not self.enabled or self.ranker.is_confident(ranked):
+            score, best_track = ranked[0]
+            best_track["fallback_analysis"] = {"method": "local_ranker", "score": round(score * 100)}
+            return best_track
         
         # Шаг 1: Анализ музыкальных предпочтений пользователя
         music_profile = await self._analyze_music_preferences(user_query)
         
-        # Шаг 2: Глубокий анализ каждого трека
-        analyzed_tracks = []
-        for track in search_results[:12]:  # Анализируем больше треков
-            analysis = await self._analyze_single_track(track, user_query, music_profile)
-            if analysis:
-                analyzed_tracks.append(analysis)
+        # Шаг 2: Глубокий анализ лучших по локальной оценке треков
+        candidates = [track for _, track in ranked[:AI_MAX_CANDIDATES]]
+        if AI_SCORING_MODE == 'batch':
+            analyzed_tracks = await self._analyze_tracks_batch(candidates, user_query, music_profile)
+        elif AI_SCORING_MODE == 'concurrent':
+            analyzed_tracks = await self._analyze_tracks_concurrent(candidates, user_query, music_profile)
+        else:
+            analyzed_tracks = await self._analyze_tracks_sequential(candidates, user_query, music_profile)
         
         # Шаг 3: Выбор лучшего трека
         best_track = self._select_best_track(analyzed_tracks, music_profile)
@@ -129,6 +206,11 @@ class RealAISearchEngine:
     
     async def _analyze_music_preferences(self, user_query: str) -> dict:
         """Анализирует музыкальные предпочтения из запроса"""
+        cache_key = llm_cache_key('music_profile', PROFILE_PROMPT_VERSION, query=normalize_query(user_query))
+        cached_profile = await self.llm_cache.get(cache_key)
+        if cached_profile:
+            return cached_profile
+
         prompt = f"""
         Пользователь ищет музыку по запросу: "{user_query}"
         
@@ -150,21 +232,11 @@ class RealAISearchEngine:
         """
         
         try:
-            session = await self.get_session()
-            async with session.post(
-                self.base_url,
-                headers={"Authorization": f"Bearer {self.api_key}", "Content-Type": "application/json"},
-                json={
-                    "model": "deepseek-chat",
-                    "messages": [{"role": "user", "content": prompt}],
-                    "max_tokens": 500,
-                    "temperature": 0.3
-                }
-            ) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    profile_text = data['choices'][0]['message']['content'].strip()
-                    return json.loads(profile_text)
+            profile_text = await self._ask_llm(prompt, max_tokens=500, temperature=0.3)
+            if profile_text:
+                profile = json.loads(profile_text)
+                await self.llm_cache.set(cache_key, profile)
+                return profile
         except Exception as e:
             print(f"❌ Ошибка анализа предпочтений: {e}")
         
@@ -178,8 +250,187 @@ class RealAISearchEngine:
             "priority_factors": ["качество", "релевантность"]
         }
     
+    async def _analyze_tracks_sequential(self, tracks: list, user_query: str, music_profile: dict) -> list:
+        """Анализ по одному запросу к ИИ на каждый трек"""
+        analyzed_tracks = []
+        for track in tracks:
+            analysis = await self._analyze_single_track(track, user_query, music_profile)
+            if analysis:
+                analyzed_tracks.append(analysis)
+        return analyzed_tracks
+
+    async def _analyze_tracks_concurrent(self, tracks: list, user_query: str, music_profile: dict) -> list:
+        """Анализ по треку, не больше AI_ANALYSIS_CONCURRENCY запросов одновременно.
+
+        Все запросы укладываются в общий AI_ANALYSIS_DEADLINE; треки, которые
+        не успели (или не разобрались), оцениваются по _calculate_quality_metrics."""
+        semaphore = asyncio.Semaphore(AI_ANALYSIS_CONCURRENCY)
+
+        async def analyze(track):
+            async with semaphore:
+                return await self._analyze_single_track(track, user_query, music_profile)
+
+        tasks = [asyncio.create_task(analyze(track)) for track in tracks]
+        done, pending = await asyncio.wait(tasks, timeout=AI_ANALYSIS_DEADLINE)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+        analyzed_tracks = []
+        for track, task in zip(tracks, tasks):
+            analysis = None
+            if task in done and task.exception() is None:
+                analysis = task.result()
+            analyzed_tracks.append(analysis or self._heuristic_analysis(track))
+
+        if pending:
+            print(f"⏱️ ИИ не успел оценить {len(pending)} из {len(tracks)} треков за {AI_ANALYSIS_DEADLINE} сек")
+        return analyzed_tracks
+
+    def _heuristic_analysis(self, track: dict) -> dict:
+        """Анализ без ИИ: только автоматические метрики качества"""
+        return self._build_analysis(track, {}, "Оценка по качеству без ИИ")
+
+    def _build_analysis(self, track: dict, scores: dict, reason: str) -> dict:
+        return {
+            "track_data": track,
+            "scores": scores,
+            "reason": reason or "Лучшее соответствие запросу",
+            "quality_metrics": self._calculate_quality_metrics(track),
+        }
+
+    @staticmethod
+    def _track_score_key(track: dict, user_query: str, music_profile: dict) -> str:
+        """Ключ кэша оценки трека: общий для пакетного и поштучного анализа"""
+        return llm_cache_key(
+            'track_score', TRACK_SCORE_PROMPT_VERSION,
+            query=normalize_query(user_query),
+            profile=music_profile,
+            url=track.get('webpage_url'),
+            title=track.get('title'),
+            artist=track.get('artist'),
+            duration=track.get('duration'),
+        )
+
+    async def _analyze_tracks_batch(self, tracks: list, user_query: str, music_profile: dict) -> list:
+        """Оценивает всех кандидатов одним запросом к ИИ.
+
+        Треки с оценкой в кэше в запрос не попадают. Треки, которых нет в ответе
+        (или весь ответ, если он не разобрался), анализируются по одному, как в режиме sequential."""
+        analyzed_tracks = []
+        uncached = []
+        for track in tracks:
+            cached = await self.llm_cache.get(self._track_score_key(track, user_query, music_profile))
+            if cached:
+                analyzed_tracks.append(self._build_analysis(track, cached['scores'], cached.get('reason')))
+            else:
+                uncached.append(track)
+        if not uncached:
+            return analyzed_tracks
+        tracks = uncached
+
+        candidates = "\n".join(
+            f"{i}. {track.get('title', 'N/A')} | {track.get('artist', 'N/A')} | {track.get('duration', 0)} сек"
+            for i, track in enumerate(tracks, 1)
+        )
+        prompt = f"""
+        Запрос пользователя: "{user_query}"
+        Музыкальный профиль: {json.dumps(music_profile, ensure_ascii=False)}
+        
+        Кандидаты (номер. название | исполнитель | длительность):
+        {candidates}
+        
+        Оцени КАЖДОГО кандидата по критериям (целые числа 0-10):
+        relevance - релевантность запросу, genre_match - соответствие жанру,
+        mood_match - соответствие настроению, quality - официальный/оригинальный/кавер,
+        overall - общее впечатление.
+        
+        Верни ТОЛЬКО JSON:
+        {{
+            "tracks": [
+                {{"id": номер, "relevance": 0, "genre_match": 0, "mood_match": 0, "quality": 0, "overall": 0, "reason": "до 10 слов"}}
+            ]
+        }}
+        """
+
+        scored = {}
+        try:
+            content = await self._ask_llm(
+                prompt, max_tokens=80 * len(tracks) + 200, temperature=0.3, json_mode=True
+            )
+            if content:
+                scored = self._parse_batch_scores(content, len(tracks))
+        except Exception as e:
+            print(f"❌ Ошибка пакетного анализа треков: {e}")
+
+        missing = []
+        for i, track in enumerate(tracks, 1):
+            if i not in scored:
+                missing.append(track)
+                continue
+            scores, reason = scored[i]
+            await self.llm_cache.set(
+                self._track_score_key(track, user_query, music_profile), {'scores': scores, 'reason': reason}
+            )
+            analyzed_tracks.append(self._build_analysis(track, scores, reason))
+
+        if missing:
+            print(f"⚠️ Пакетный анализ не оценил {len(missing)} из {len(tracks)} треков, анализирую по одному")
+            analyzed_tracks.extend(await self._analyze_tracks_sequential(missing, user_query, music_profile))
+
+        return analyzed_tracks
+
+    @staticmethod
+    def _parse_batch_scores(content: str, count: int) -> dict:
+        """Разбирает ответ пакетной оценки: {номер: (оценки, причина)}.
+
+        Записи с неверным номером или без числовых оценок отбрасываются."""
+        content = content.strip()
+        if content.startswith('```'):
+            content = content.strip('`')
+            content = content[content.find('{'):]
+        data = json.loads(content)
+
+        scored = {}
+        for item in data.get('tracks', []) if isinstance(data, dict) else []:
+            try:
+                track_id = int(item['id'])
+                scores = {key: min(10.0, max(0.0, float(item[key]))) for key in SCORE_KEYS}
+            except (KeyError, TypeError, ValueError):
+                continue
+            if 1 <= track_id <= count:
+                scored[track_id] = (scores, str(item.get('reason') or 'Лучшее соответствие запросу'))
+        return scored
+
+    async def _ask_llm(self, prompt: str, max_tokens: int, temperature: float, json_mode: bool = False) -> str:
+        """Один запрос к DeepSeek; возвращает текст ответа или None при ошибке HTTP"""
+        payload = {
+            "model": "deepseek-chat",
+            "messages": [{"role": "user", "content": prompt}],
+            "max_tokens": max_tokens,
+            "temperature": temperature
+        }
+        if json_mode:
+            payload["response_format"] = {"type": "json_object"}
+
+        session = await self.get_session()
+        async with session.post(
+            self.base_url,
+            headers={"Authorization": f"Bearer {self.api_key}", "Content-Type": "application/json"},
+            json=payload
+        ) as response:
+            if response.status != 200:
+                return None
+            data = await response.json()
+            return data['choices'][0]['message']['content'].strip()
+
     async def _analyze_single_track(self, track: dict, user_query: str, music_profile: dict) -> dict:
         """Глубокий анализ одного трека"""
+        cache_key = self._track_score_key(track, user_query, music_profile)
+        cached = await self.llm_cache.get(cache_key)
+        if cached:
+            return self._build_analysis(track, cached['scores'], cached.get('reason'))
+
         prompt = f"""
         Запрос пользователя: "{user_query}"
         Музыкальный профиль: {json.dumps(music_profile, ensure_ascii=False)}
@@ -212,26 +463,18 @@ class RealAISearchEngine:
         """
         
         try:
-            session = await self.get_session()
-            async with session.post(
-                self.base_url,
-                headers={"Authorization": f"Bearer {self.api_key}", "Content-Type": "application/json"},
-                json={
-                    "model": "deepseek-chat",
-                    "messages": [{"role": "user", "content": prompt}],
-                    "max_tokens": 600,
-                    "temperature": 0.4
-                }
-            ) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    analysis_text = data['choices'][0]['message']['content'].strip()
-                    analysis = json.loads(analysis_text)
-                    
-                    # Добавляем базовые метрики качества
-                    analysis["quality_metrics"] = self._calculate_quality_metrics(track)
-                    
-                    return analysis
+            analysis_text = await self._ask_llm(prompt, max_tokens=600, temperature=0.4)
+            if analysis_text:
+                analysis = json.loads(analysis_text)
+                
+                # Добавляем базовые метрики качества
+                analysis["quality_metrics"] = self._calculate_quality_metrics(track)
+                
+                await self.llm_cache.set(cache_key, {
+                    'scores': analysis.get('scores', {}),
+                    'reason': analysis.get('reason')
+                })
+                return analysis
         except Exception as e:
             print(f"❌ Ошибка анализа трека: {e}")
         
@@ -340,11 +583,15 @@ class RealAISearchEngine:
 
 # ==================== ADVANCED MUSIC BOT ====================
 class AdvancedMusicBot:
-    def __init__(self):
+    def __init__(self, search_backend=None):
         self.download_semaphore = asyncio.Semaphore(2)
-        self.search_semaphore = asyncio.Semaphore(2)
+        self.search_semaphore = asyncio.Semaphore(SEARCH_CONCURRENCY)
+        self.search_backend = search_backend or create_search_backend(
+            SEARCH_BACKEND, dict(SEARCH_OPTS, socket_timeout=15)
+        )
         self.rate_limiter = RateLimiter()
         self.ai_engine = RealAISearchEngine()
+        self.file_id_cache = TelegramFileIdCache(Path(FILE_ID_CACHE_DB) if FILE_ID_CACHE_DB else None)
         self.app = None
         logger.info('✅ Продвинутый музыкальный бот инициализирован')
 
@@ -365,63 +612,86 @@ class AdvancedMusicBot:
         return ' '.join(title.split()).strip()
 
     async def deep_search(self, query: str) -> list:
-        """Глубокий поиск с множественными стратегиями"""
-        strategies = [
-            self._search_soundcloud_basic,
-            self._search_soundcloud_extended, 
-            self._search_alternative_queries
-        ]
-        
-        all_results = []
-        seen_urls = set()
-        
-        for strategy in strategies:
-            try:
-                results = await strategy(query)
-                for track in results:
-                    if track.get('webpage_url') not in seen_urls:
-                        seen_urls.add(track.get('webpage_url'))
-                        all_results.append(track)
-                
-                if len(all_results) >= 15:  # Достаточно результатов
-                    break
-                    
-            except Exception as e:
-                print(f"⚠️ Ошибка в стратегии поиска: {e}")
-                continue
-        
-        print(f"🔍 Всего найдено уникальных треков: {len(all_results)}")
+        """Глубокий поиск с множественными стратегиями.
+
+        Подзапросы стратегий идут параллельно, но не больше DEEP_SEARCH_CONCURRENCY
+        от одного запроса (и не больше search_semaphore на весь бот); оставшиеся
+        отменяются, как только базовый поиск готов и набралось DEEP_SEARCH_TARGET
+        уникальных треков. Порядок результатов - по стратегиям."""
+        plan = self._plan_search_queries(query)
+        request_limit = asyncio.Semaphore(DEEP_SEARCH_CONCURRENCY)
+
+        async def limited_search(search_query: str) -> list:
+            # Слот запроса берется раньше общего: лишние подзапросы ждут здесь,
+            # а не в общей очереди перед поисками других пользователей
+            async with request_limit:
+                return await self._search_soundcloud(search_query)
+
+        tasks = [asyncio.create_task(limited_search(search_query)) for search_query in plan]
+        results = {}
+        pending = set(tasks)
+
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    try:
+                        results[task] = task.result()
+                    except Exception as e:
+                        print(f"⚠️ Ошибка в стратегии поиска: {e}")
+                        results[task] = []
+
+                if tasks[0] in results and len(self._merge_unique(tasks, results)) >= DEEP_SEARCH_TARGET:
+                    break  # Достаточно результатов
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+        all_results = self._merge_unique(tasks, results)
+        print(f"🔍 Всего найдено уникальных треков: {len(all_results)} "
+              f"(подзапросов: {len(results)}/{len(plan)})")
         return all_results
 
-    async def _search_soundcloud_basic(self, query: str, limit: int = 8) -> list:
+    @staticmethod
+    def _merge_unique(tasks: list, results: dict) -> list:
+        """Склеивает готовые результаты в порядке плана без повторов по URL"""
+        merged = []
+        seen_urls = set()
+        for task in tasks:
+            for track in results.get(task, []):
+                if track.get('webpage_url') not in seen_urls:
+                    seen_urls.add(track.get('webpage_url'))
+                    merged.append(track)
+        return merged
+
+    def _plan_search_queries(self, query: str) -> list:
+        """Подзапросы всех стратегий в порядке приоритета"""
+        return (
+            self._basic_search_queries(query)
+            + self._extended_search_queries(query)
+            + self._alternative_search_queries(query)
+        )
+
+    @staticmethod
+    def _basic_search_queries(query: str, limit: int = 8) -> list:
         """Базовый поиск в SoundCloud"""
-        return await self._search_soundcloud(f"scsearch{limit}:{query}")
+        return [f"scsearch{limit}:{query}"]
 
-    async def _search_soundcloud_extended(self, query: str, limit: int = 12) -> list:
+    @staticmethod
+    def _extended_search_queries(query: str, limit: int = 12) -> list:
         """Расширенный поиск с разными модификаторами"""
-        searches = [
+        return [
             f"scsearch{limit}:{query}",
             f"scsearch{limit//2}:{query} 2024",
             f"scsearch{limit//2}:{query} official"
         ]
-        
-        all_results = []
-        for search_query in searches:
-            results = await self._search_soundcloud(search_query)
-            all_results.extend(results)
-        
-        return all_results
 
-    async def _search_alternative_queries(self, original_query: str) -> list:
+    def _alternative_search_queries(self, original_query: str) -> list:
         """Поиск по альтернативным формулировкам"""
-        alternatives = self._generate_alternative_queries(original_query)
-        all_results = []
-        
-        for alt_query in alternatives[:3]:
-            results = await self._search_soundcloud(f"scsearch4:{alt_query}")
-            all_results.extend(results)
-        
-        return all_results
+        alternatives = self._generate_alternative_queries(original_query)[:3]
+        # Первая альтернатива совпадает с исходным запросом и уже покрыта базовым поиском
+        return [f"scsearch4:{alt_query}" for alt_query in alternatives if alt_query != original_query]
 
     def _generate_alternative_queries(self, query: str) -> list:
         """Генерирует альтернативные поисковые запросы"""
@@ -441,26 +711,12 @@ class AdvancedMusicBot:
 
     async def _search_soundcloud(self, search_query: str) -> list:
         """Базовый метод поиска в SoundCloud"""
-        ydl_opts = {
-            'format': 'bestaudio/best',
-            'quiet': True,
-            'no_warnings': True,
-            'extract_flat': True,
-            'ignoreerrors': True,
-            'noplaylist': True,
-            'socket_timeout': 15,
-        }
-
         try:
-            def perform_search():
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    return ydl.extract_info(search_query, download=False)
-
-            loop = asyncio.get_event_loop()
-            info = await asyncio.wait_for(
-                loop.run_in_executor(None, perform_search),
-                timeout=SEARCH_TIMEOUT
-            )
+            async with self.search_semaphore:
+                info = await asyncio.wait_for(
+                    self.search_backend.search(search_query),
+                    timeout=SEARCH_TIMEOUT
+                )
 
             if not info:
                 return []
@@ -557,27 +813,12 @@ class AdvancedMusicBot:
             # Этап 3: Скачивание
             await status_msg.edit_text(f"🔍 Ищу: <code>{query}</code>\n⏬ Этап 3/3: Скачивание...", parse_mode='HTML')
             
-            file_path = await self.download_track(best_track.get('webpage_url'))
-            if not file_path:
+            caption = self._create_result_caption(best_track, query)
+            if not await self.send_track(update, context, best_track, caption):
                 await status_msg.edit_text("❌ Ошибка скачивания")
                 return
 
-            # Отправка результата
-            caption = self._create_result_caption(best_track, query)
-            
-            with open(file_path, 'rb') as audio_file:
-                await context.bot.send_audio(
-                    chat_id=update.effective_chat.id,
-                    audio=audio_file,
-                    title=best_track.get('title', 'Трек')[:64],
-                    performer=best_track.get('artist', 'Исполнитель')[:64],
-                    caption=caption,
-                    parse_mode='HTML'
-                )
-
-            # Очистка
             try:
-                os.remove(file_path)
                 await status_msg.delete()
             except:
                 pass
@@ -587,6 +828,51 @@ class AdvancedMusicBot:
             if status_msg:
                 await status_msg.edit_text("❌ Ошибка поиска")
 
+    @staticmethod
+    async def _update_file_id_cache(method, *args):
+        """Запись в индекс file_id (SQLite) в пуле disk, а не в event loop"""
+        try:
+            await disk_executor.run(method, *args)
+        except Exception as e:
+            logger.warning(f"Не удалось обновить кэш file_id: {e}")
+
+    async def send_track(self, update: Update, context: ContextTypes.DEFAULT_TYPE, track: dict, caption: str) -> bool:
+        """Отправляет трек по file_id, если он уже загружался в Telegram, иначе скачивает и загружает"""
+        url = track.get('webpage_url')
+        audio_fields = {
+            'chat_id': update.effective_chat.id,
+            'title': track.get('title', 'Трек')[:64],
+            'performer': track.get('artist', 'Исполнитель')[:64],
+            'caption': caption,
+            'parse_mode': 'HTML',
+        }
+
+        cached = self.file_id_cache.get(url)
+        if cached:
+            try:
+                await context.bot.send_audio(audio=cached[0], **audio_fields)
+                return True
+            except TelegramError as e:
+                # file_id мог устареть, а сеть - подвести; забываем его и скачиваем трек заново
+                logger.warning(f"Не удалось отправить по file_id {url}: {e}")
+                await self._update_file_id_cache(self.file_id_cache.discard, url)
+
+        file_path = await self.download_track(url)
+        self.ai_engine.record_outcome(track, bool(file_path))
+        if not file_path:
+            return False
+
+        try:
+            with open(file_path, 'rb') as audio_file:
+                message = await context.bot.send_audio(audio=audio_file, **audio_fields)
+            await self._update_file_id_cache(self.file_id_cache.remember, url, message)
+        finally:
+            try:
+                os.remove(file_path)
+            except:
+                pass
+        return True
+
     def _create_result_caption(self, track: dict, query: str) -> str:
         """Создает информативное описание результата"""
         caption = f"🎵 <b>{track.get('title', 'Трек')}</b>\n"
@@ -617,30 +903,16 @@ class AdvancedMusicBot:
         if not self.is_valid_url(url):
             return None
 
-        ydl_opts = {
-            'format': 'bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio/best',
-            'outtmpl': os.path.join(tempfile.gettempdir(), '%(id)s.%(ext)s'),
-            'quiet': True,
-            'no_warnings': True,
-            'retries': 2,
-            'max_filesize': MAX_FILE_SIZE_MB * 1024 * 1024,
-            'ignoreerrors': True,
-        }
-
-        loop = asyncio.get_event_loop()
         tmpdir = tempfile.mkdtemp()
         
         try:
-            ydl_opts['outtmpl'] = os.path.join(tmpdir, '%(title).100s.%(ext)s')
-
-            def download_track():
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    return ydl.extract_info(url, download=True)
+            def download_track(cancel_event):
+                return ydl_pool.extract_info(
+                    DOWNLOAD_OPTS, url, download=True, cancel_event=cancel_event, paths={'home': tmpdir}
+                )
 
-            info = await asyncio.wait_for(
-                loop.run_in_executor(None, download_track),
-                timeout=DOWNLOAD_TIMEOUT
-            )
+            # По таймауту скачивание останавливается, а не продолжается в фоне
+            info = await download_executor.run_cancellable(download_track, timeout=DOWNLOAD_TIMEOUT)
 
             if not info:
                 return None
@@ -691,6 +963,12 @@ class AdvancedMusicBot:
         self.app.add_handler(CommandHandler('start', self.start_command))
         self.app.add_handler(CommandHandler('find', self.handle_find_short))
         self.app.add_handler(CommandHandler('random', self.handle_random_short))
+        self.app.post_init = self._post_init
+
+    async def _post_init(self, application):
+        # Redis нужен только для общего кэша ответов ИИ между репликами
+        if os.environ.get('REDIS_URL'):
+            await redis_client.connect()
 
     async def handle_all_messages(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
@@ -730,22 +1008,10 @@ class AdvancedMusicBot:
             
             if search_results:
                 track = random.choice(search_results[:5])
-                file_path = await self.download_track(track.get('webpage_url'))
-                
-                if file_path:
-                    with open(file_path, 'rb') as audio_file:
-                        await context.bot.send_audio(
-                            chat_id=update.effective_chat.id,
-                            audio=audio_file,
-                            title=track.get('title', 'Трек')[:64],
-                            performer=track.get('artist', 'Исполнитель')[:64],
-                            caption=f"🎵 <b>{track.get('title', 'Трек')}</b>\n🎤 {track.get('artist', 'Исполнитель')}\n🎲 Случайная находка!",
-                            parse_mode='HTML'
-                        )
-                    try:
-                        os.remove(file_path)
-                    except:
-                        pass
+                await self.send_track(
+                    update, context, track,
+                    f"🎵 <b>{track.get('title', 'Трек')}</b>\n🎤 {track.get('artist', 'Исполнитель')}\n🎲 Случайная находка!"
+                )
         except Exception as e:
             print(f"❌ Ошибка случайного трека: {e}")
 
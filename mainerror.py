@@ -12,6 +12,20 @@ from datetime import datetime, timedelta
 from pathlib import Path
 import concurrent.futures
 
+from user_store import WriteBehindSaver
+from user_repository import LazyUserData, create_user_repository
+from session_store import SessionStore, SESSION_KEYS
+from file_id_cache import TelegramFileIdCache
+from audio_cache import AudioFileCache
+from search_cache import SearchCache, DiskSearchCache, TwoTierCache, SingleFlight, BackgroundRefresher
+from redis_client import redis_client
+from query_normalizer import normalize_query, QueryNormalizationStats
+from warmup import WarmupScheduler
+from search_backend import SEARCH_OPTS, create_search_backend
+from ydl_pool import DownloadCancelled, ydl_pool
+from executors import ExecutorBusy, TaskOverdue, metadata_executor, download_executor, disk_executor
+from health_server import HealthServer
+
 # ==================== CONFIG ====================
 BOT_TOKEN = os.environ.get('BOT_TOKEN')
 ADMIN_IDS = os.environ.get('ADMIN_IDS', '').split(',')
@@ -31,12 +45,23 @@ else:
 RESULTS_PER_PAGE = 10
 DATA_FILE = Path('user_data.json')
 CHARTS_FILE = Path('charts_cache.json')
+# Окно, в котором изменения пользователей копятся перед записью на диск
+USER_SAVE_DELAY = float(os.environ.get('USER_SAVE_DELAY', 2))
+# Пользователи хранятся в SQLite, либо в Postgres при заданном DATABASE_URL
+USER_DB_FILE = Path(os.environ.get('USER_DB_FILE', 'user_data.db'))
+DATABASE_URL = os.environ.get('DATABASE_URL')
+# Сколько пользователей держать в памяти одновременно
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 2000))
+# Сколько секунд хранить результаты поиска и страницы неактивного пользователя
+SESSION_TTL = int(os.environ.get('SESSION_TTL', 3600))
 MAX_FILE_SIZE_MB = 45
 
 # Увеличиваем параллелизм для скорости
 MAX_CONCURRENT_DOWNLOADS = 5
 DOWNLOAD_TIMEOUT = 300
 SEARCH_TIMEOUT = 18  # Увеличили таймаут поиска
+# Источник поиска: ytdlp - SoundCloud через yt-dlp, fake - локальная имитация для бенчмарков
+SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND', 'ytdlp')
 
 # Ускоренные таймауты
 DYNAMIC_TIMEOUTS = {
@@ -50,10 +75,38 @@ DYNAMIC_TIMEOUTS = {
 # Кэш для поисковых запросов (в памяти)
 SEARCH_CACHE = {}
 SEARCH_CACHE_TTL = 600  # 10 минут
+# Объем кэша поиска в байтах (по JSON-представлению результатов)
+SEARCH_CACHE_MAX_BYTES = int(os.environ.get('SEARCH_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+# Кэш поиска на диске переживает перезапуск; пустое значение отключает его
+SEARCH_CACHE_DB = os.environ.get('SEARCH_CACHE_DB', 'search_cache.db')
+SEARCH_CACHE_DISK_TTL = int(os.environ.get('SEARCH_CACHE_DISK_TTL', 6 * 3600))
+# URL трека -> file_id в Telegram: повторные запросы трека отправляются без скачивания
+FILE_ID_CACHE_DB = os.environ.get('FILE_ID_CACHE_DB', 'telegram_files.db')
+# Скачанные треки на диске: популярные треки не скачиваются повторно; пустое значение отключает
+AUDIO_CACHE_DIR = os.environ.get('AUDIO_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'music_bot_audio_cache'))
+AUDIO_CACHE_MAX_MB = int(os.environ.get('AUDIO_CACHE_MAX_MB', 512))
+# Сколько живут метаданные трека для скачивания; ссылки на поток SoundCloud подписаны и быстро истекают
+PROBE_CACHE_TTL = int(os.environ.get('PROBE_CACHE_TTL', 300))
+# Сколько помнить, что метаданные трека получить не удалось (без повторного запроса)
+PROBE_FAILURE_TTL = int(os.environ.get('PROBE_FAILURE_TTL', 30))
 
 # Предзагрузка популярных запросов
 POPULAR_QUERIES_CACHE = {}
 POPULAR_CACHE_TTL = 3600  # 1 час
+# После TTL запись еще отдается, пока обновляется в фоне, но не дольше этого срока
+POPULAR_CACHE_MAX_STALE = 24 * 3600
+# Чарты пересобираются в фоне раз в 6 часов
+CHARTS_CACHE_TTL = timedelta(hours=6)
+# Прогрев при запуске: параллельных поисков (search_semaphore = 5, один слот остается
+# пользователям) и запусков в секунду
+WARMUP_CONCURRENCY = int(os.environ.get('WARMUP_CONCURRENCY', 4))
+WARMUP_RATE = float(os.environ.get('WARMUP_RATE', 2))
+# Как часто счетчики запросов (приоритет прогрева) сохраняются в SEARCH_CACHE_DB, секунд
+QUERY_COUNTS_SAVE_INTERVAL = int(os.environ.get('QUERY_COUNTS_SAVE_INTERVAL', 60))
+# Сколько экземпляров YoutubeDL на профиль создать заранее при старте
+YDL_POOL_PREWARM = int(os.environ.get('YDL_POOL_PREWARM', 2))
+# Порт health-сервера (/health, /metrics); без него сервер не запускается
+HEALTH_PORT = os.environ.get('HEALTH_PORT')
 
 # Ускоренные настройки для скачивания
 FAST_DOWNLOAD_OPTS = {
@@ -101,18 +154,24 @@ LARGE_FILE_OPTS = {
     'concurrent_fragment_downloads': 2,
 }
 
+# Единственный запрос метаданных перед скачиванием: формат тот же, что у загрузчика,
+# чтобы размер совпадал со скачиваемым файлом
 FAST_INFO_OPTS = {
     'quiet': True,
     'no_warnings': True,
     'simulate': True,
-    'format': 'bestaudio/best',
+    'format': FAST_DOWNLOAD_OPTS['format'],
     'skip_download': True,
     'noplaylist': True,
-    'extract_flat': True,
     'socket_timeout': 12,  # Увеличили таймаут
     'ignoreerrors': True,
 }
 
+# Профили пула YoutubeDL для скачивания: имя файла относительное,
+# временная папка задается на каждый вызов через paths
+POOLED_FAST_DOWNLOAD_OPTS = dict(FAST_DOWNLOAD_OPTS, outtmpl='%(title).80s.%(ext)s')
+POOLED_LARGE_FILE_OPTS = dict(LARGE_FILE_OPTS, outtmpl='%(title).80s.%(ext)s')
+
 DURATION_FILTERS = {
     'no_filter': 'Без фильтра',
     'up_to_5min': 'До 5 минут',
@@ -234,10 +293,10 @@ POPULAR_SEARCHES = [
 try:
     from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
     from telegram.ext import (
-        Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, 
+        Application, CommandHandler, MessageHandler, CallbackQueryHandler, TypeHandler, filters, 
         ContextTypes
     )
-    import yt_dlp
+    from telegram.error import TelegramError
     print("✅ Все зависимости загружены")
 except ImportError as exc:
     print(f"❌ Ошибка импорта: {exc}")
@@ -249,7 +308,7 @@ except ImportError as exc:
             Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, 
             ContextTypes
         )
-        import yt_dlp
+        from telegram.error import TelegramError
         print("✅ Зависимости успешно установлены")
     except ImportError as exc2:
         print(f"❌ Ошибка импорта после установки: {exc2}")
@@ -267,20 +326,16 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # ==================== USER DATA STORAGE ====================
+user_repository = create_user_repository(DATABASE_URL, USER_DB_FILE, legacy_file=DATA_FILE)
+user_saver = WriteBehindSaver(user_repository, delay=USER_SAVE_DELAY)
+sessions = SessionStore(ttl=SESSION_TTL)
 user_data = {}
 charts_cache = {}
 
 def load_data():
     global user_data, charts_cache
-    if DATA_FILE.exists():
-        try:
-            with open(DATA_FILE, 'r', encoding='utf-8') as f:
-                user_data = json.load(f)
-        except Exception as e:
-            logger.warning(f"Не удалось загрузить {DATA_FILE}: {e}")
-            user_data = {}
-    else:
-        user_data = {}
+    # Пользователи подгружаются из репозитория при первом обращении
+    user_data = LazyUserData(user_repository, max_cached=USER_CACHE_SIZE, saver=user_saver)
 
     if CHARTS_FILE.exists():
         try:
@@ -292,10 +347,25 @@ def load_data():
     else:
         charts_cache = {}
 
-def save_data():
+def save_data(*user_ids):
+    """Помечает изменения user_data для отложенной записи в журнал.
+
+    С user_ids проверяются только записи этих пользователей,
+    без аргументов - весь user_data."""
+    try:
+        user_saver.mark_dirty(user_data, user_ids or None)
+    except Exception as e:
+        logger.error(f"Ошибка сохранения данных: {e}")
+
+async def preload_user_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Подгружает запись пользователя до обработчиков, чтобы они не читали базу в event loop"""
+    if update.effective_user and isinstance(user_data, LazyUserData):
+        await user_data.preload_user(str(update.effective_user.id))
+
+def flush_data():
+    """Дописывает все отложенные изменения (при остановке бота)"""
     try:
-        with open(DATA_FILE, 'w', encoding='utf-8') as f:
-            json.dump(user_data, f, ensure_ascii=False, indent=2)
+        user_saver.flush()
     except Exception as e:
         logger.error(f"Ошибка сохранения данных: {e}")
 
@@ -324,16 +394,16 @@ async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await require_admin(update, context):
         return
 
-    user_count = len([k for k in user_data.keys() if not k.startswith('_')])
-    total_downloads = sum(stats.get('downloads', 0) for stats in user_data.get('_user_stats', {}).values())
-    total_searches = sum(stats.get('searches', 0) for stats in user_data.get('_user_stats', {}).values())
+    user_count = await disk_executor.run(user_repository.count_users)
+    totals = await disk_executor.run(user_repository.stats_totals)
+    total_downloads = totals['downloads']
+    total_searches = totals['searches']
 
     text = f"""📊 <b>Админ статистика</b>
 
 👥 Пользователей: {user_count}
 📥 Всего скачиваний: {total_downloads}
 🔍 Всего поисков: {total_searches}
-💾 Размер user_data: {len(str(user_data))} символов
 📈 Кэш чартов: {len(charts_cache.get('data', {}))} запросов
 🔧 Админов: {len(ADMIN_IDS)}"""
 
@@ -346,26 +416,30 @@ async def admin_cleanup(update: Update, context: ContextTypes.DEFAULT_TYPE):
     cleared_users = 0
     current_time = datetime.now()
 
-    for user_id in list(user_data.keys()):
-        if user_id.startswith('_') or user_id in ADMIN_IDS:
+    # Список пользователей и их статистика читаются из базы в пуле disk, а не в event loop
+    user_ids = await user_data.all_keys()
+    all_stats = await user_data['_user_stats'].load_all()
+
+    for user_id in user_ids:
+        if user_id in ADMIN_IDS:
             continue
 
-        user_stats = user_data.get('_user_stats', {}).get(user_id, {})
+        user_stats = all_stats.get(user_id, {})
         last_search = user_stats.get('last_search')
 
         if last_search:
             try:
                 last_active = datetime.strptime(last_search, '%d.%m.%Y %H:%M')
                 if (current_time - last_active).days > 30:
-                    del user_data[user_id]
-                    if user_id in user_data.get('_user_stats', {}):
-                        del user_data['_user_stats'][user_id]
+                    user_data.discard(user_id)
+                    if user_id in all_stats:
+                        user_data['_user_stats'].discard(user_id)
                     cleared_users += 1
             except ValueError:
-                del user_data[user_id]
+                user_data.discard(user_id)
                 cleared_users += 1
         else:
-            del user_data[user_id]
+            user_data.discard(user_id)
             cleared_users += 1
 
     save_data()
@@ -373,7 +447,7 @@ async def admin_cleanup(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         f"✅ Очистка завершена!\n"
         f"🗑 Удалено неактивных пользователей: {cleared_users}\n"
-        f"👥 Осталось пользователей: {len([k for k in user_data.keys() if not k.startswith('_')])}"
+        f"👥 Осталось пользователей: {len(user_ids) - cleared_users}"
     )
 
 async def admin_files(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -381,14 +455,18 @@ async def admin_files(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     try:
-        user_data_size = os.path.getsize('user_data.json') if os.path.exists('user_data.json') else 0
+        user_data_size = os.path.getsize(USER_DB_FILE) if USER_DB_FILE.exists() else 0
         charts_cache_size = os.path.getsize('charts_cache.json') if os.path.exists('charts_cache.json') else 0
+        search_cache_size = os.path.getsize(SEARCH_CACHE_DB) if SEARCH_CACHE_DB and os.path.exists(SEARCH_CACHE_DB) else 0
+        file_id_cache_size = os.path.getsize(FILE_ID_CACHE_DB) if FILE_ID_CACHE_DB and os.path.exists(FILE_ID_CACHE_DB) else 0
 
         text = f"""📁 <b>Информация о файлах</b>
 
-user_data.json: {user_data_size / 1024:.1f} KB
+{USER_DB_FILE.name}: {user_data_size / 1024:.1f} KB
 charts_cache.json: {charts_cache_size / 1024:.1f} KB
-Всего пользователей: {len(user_data)}"""
+{SEARCH_CACHE_DB or 'кэш поиска на диске отключен'}: {search_cache_size / 1024:.1f} KB
+{FILE_ID_CACHE_DB or 'file_id хранятся только в памяти'}: {file_id_cache_size / 1024:.1f} KB
+Всего пользователей: {await disk_executor.run(user_repository.count_users)}"""
 
         await update.message.reply_text(text, parse_mode='HTML')
 
@@ -418,28 +496,6 @@ def setup_admin_commands(app):
     else:
         print("⚠️  Админ-команды отключены (ADMIN_IDS не настроен)")
 
-# ==================== УЛУЧШЕННАЯ СИСТЕМА КЭШИРОВАНИЯ ====================
-
-class SearchCache:
-    def __init__(self):
-        self.cache = {}
-        self.max_size = 100
-        
-    def get(self, query: str):
-        if query in self.cache:
-            data, timestamp = self.cache[query]
-            if datetime.now().timestamp() - timestamp < SEARCH_CACHE_TTL:
-                return data
-            else:
-                del self.cache[query]
-        return None
-        
-    def set(self, query: str, data):
-        if len(self.cache) >= self.max_size:
-            oldest_key = min(self.cache.keys(), key=lambda k: self.cache[k][1])
-            del self.cache[oldest_key]
-        self.cache[query] = (data, datetime.now().timestamp())
-
 # ==================== ЧЕРНЫЙ СПИСОК ТРЕКОВ ====================
 
 class TrackBlacklist:
@@ -458,54 +514,96 @@ class TrackBlacklist:
 # ==================== ОСНОВНОЙ КЛАСС БОТА ====================
 
 class StableMusicBot:
-    def __init__(self):
+    def __init__(self, search_backend=None):
         self.user_stats = user_data.get('_user_stats', {})
         self.track_info_cache = {}
         self.download_semaphore = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
         self.search_semaphore = asyncio.Semaphore(5)
-        self.search_cache = SearchCache()
+        self.search_backend = search_backend or create_search_backend(SEARCH_BACKEND, SEARCH_OPTS)
+        self.search_cache = SearchCache(max_bytes=SEARCH_CACHE_MAX_BYTES, ttl=SEARCH_CACHE_TTL)
+        self.disk_search_cache = (
+            DiskSearchCache(Path(SEARCH_CACHE_DB), ttl=SEARCH_CACHE_DISK_TTL) if SEARCH_CACHE_DB else None
+        )
+        # L1 в памяти + L2 в Redis (если задан REDIS_URL), общий для всех реплик бота
+        self.shared_cache = TwoTierCache(self.search_cache, redis_client, disk=self.disk_search_cache)
+        self.query_stats = QueryNormalizationStats()
+        self.search_flight = SingleFlight()
+        self.warmup = WarmupScheduler(concurrency=WARMUP_CONCURRENCY, rate=WARMUP_RATE)
+        self.refresher = BackgroundRefresher()
         self.track_blacklist = TrackBlacklist()
+        self.file_id_cache = TelegramFileIdCache(Path(FILE_ID_CACHE_DB) if FILE_ID_CACHE_DB else None)
+        self.probe_cache = SearchCache(max_bytes=8 * 1024 * 1024, ttl=PROBE_CACHE_TTL)
+        self.probe_flight = SingleFlight()
+        self.audio_cache = (
+            AudioFileCache(Path(AUDIO_CACHE_DIR), max_bytes=AUDIO_CACHE_MAX_MB * 1024 * 1024) if AUDIO_CACHE_DIR else None
+        )
         
         logger.info('✅ Бот инициализирован')
 
     async def preload_popular_queries(self):
         """Фоновая предзагрузка популярных запросов"""
+        # Популярность запросов с прошлых запусков, чтобы прогрев начинался с них
+        if self.disk_search_cache is not None:
+            try:
+                self.query_stats.restore(await disk_executor.run(self.disk_search_cache.top_queries, 100))
+            except Exception as e:
+                logger.warning(f"Не удалось загрузить счетчики запросов: {e}")
+
         await asyncio.sleep(10)  # Ждем запуск бота
         logger.info("🔄 Начинаю предзагрузку популярных запросов...")
-        
-        for query in POPULAR_SEARCHES[:10] + RANDOM_SEARCHES[:20]:
+
+        # Сначала то, что пользователи уже спрашивали, затем статические списки
+        queries = {}
+        for query in self.query_stats.top_queries(20) + POPULAR_SEARCHES[:10] + RANDOM_SEARCHES[:20]:
+            queries.setdefault(normalize_query(query), query)
+
+        async def warm(query: str) -> bool:
+            results = await self.search_soundcloud(query, track_stats=False)
+            if results:
+                POPULAR_QUERIES_CACHE[normalize_query(query)] = {
+                    'results': results[:5],
+                    'timestamp': datetime.now().timestamp()
+                }
+            return bool(results)
+
+        await self.warmup.run(
+            queries.values(), warm,
+            priority=lambda query: self.query_stats.count(normalize_query(query))
+        )
+
+        logger.info(f"✅ Предзагружено {len(POPULAR_QUERIES_CACHE)} популярных запросов")
+
+    def save_query_counts(self):
+        """Дописывает накопленные счетчики запросов в SEARCH_CACHE_DB (вызывать вне event loop)"""
+        if self.disk_search_cache is not None:
+            self.disk_search_cache.add_query_counts(self.query_stats.take_pending())
+
+    async def save_query_counts_periodically(self):
+        while True:
+            await asyncio.sleep(QUERY_COUNTS_SAVE_INTERVAL)
             try:
-                results = await self.search_soundcloud(query)
-                if results:
-                    POPULAR_QUERIES_CACHE[query] = {
-                        'results': results[:5],
-                        'timestamp': datetime.now().timestamp()
-                    }
-                await asyncio.sleep(1)  # Задержка между запросами
+                await disk_executor.run(self.save_query_counts)
             except Exception as e:
-                logger.warning(f"Ошибка предзагрузки {query}: {e}")
-        
-        logger.info(f"✅ Предзагружено {len(POPULAR_QUERIES_CACHE)} популярных запросов")
+                logger.warning(f"Не удалось сохранить счетчики запросов: {e}")
 
     def ensure_user(self, user_id: str):
         if str(user_id) not in user_data:
             user_data[str(user_id)] = {
                 'filters': {'duration': 'no_filter', 'music_only': False},
-                'search_results': [],
-                'search_query': '',
-                'current_page': 0,
-                'total_pages': 0,
                 'favorites': [],
                 'search_history': [],
                 'download_history': [],
                 'download_queue': [],
-                'random_track_result': [],
                 'achievements': {},
                 'preferences': {
                     'favorite_genres': [],
                     'disliked_genres': []
                 }
             }
+        else:
+            # Временные данные теперь живут в sessions и не сохраняются на диск
+            for key in SESSION_KEYS:
+                user_data[str(user_id)].pop(key, None)
         if '_user_stats' not in user_data:
             user_data['_user_stats'] = {}
         if str(user_id) not in user_data['_user_stats']:
@@ -577,7 +675,7 @@ class StableMusicBot:
             
         user_entry = user_data.get(str(user_id), {})
         if not user_entry:
-            return tracks
+            return list(tracks)
             
         filters = user_entry.get('filters', {})
         duration_filter = filters.get('duration', 'no_filter')
@@ -598,27 +696,50 @@ class StableMusicBot:
         
         return filtered_tracks
 
-    async def check_file_size_before_download(self, url: str, track: dict) -> tuple:
+    async def probe_track(self, url: str) -> dict:
+        """Метаданные трека одним запросом: форматы, размер, доступность.
+
+        Результат кэшируется на PROBE_CACHE_TTL и используется проверками
+        перед скачиванием и самим загрузчиком (без повторного extract_info).
+        Неудача запоминается на PROBE_FAILURE_TTL: проверка размера и проверка
+        форматов не запрашивают недоступный трек дважды."""
+        info = self.probe_cache.get(url)
+        if info is not None:
+            # Пустой dict - запомненная неудача
+            return info or None
+        return await self.probe_flight.run(url, lambda: self._fetch_probe(url))
+
+    async def _fetch_probe(self, url: str) -> dict:
         try:
-            with yt_dlp.YoutubeDL(FAST_INFO_OPTS) as ydl:
-                info = await asyncio.get_event_loop().run_in_executor(
-                    None, lambda: ydl.extract_info(url, download=False)
-                )
+            info = await metadata_executor.run(ydl_pool.probe, FAST_INFO_OPTS, url)
+        except ExecutorBusy as e:
+            # Перегрузка пула - не свойство трека, неудачу не запоминаем
+            logger.warning(f"Не удалось получить информацию о треке: {e}")
+            return None
+        except Exception as e:
+            logger.warning(f"Не удалось получить информацию о треке: {e}")
+            info = None
 
-                file_size = 0
-                if info and 'filesize' in info and info['filesize']:
-                    file_size = info['filesize'] / (1024 * 1024)
-                elif info and 'filesize_approx' in info and info['filesize_approx']:
-                    file_size = info['filesize_approx'] / (1024 * 1024)
+        if info:
+            self.probe_cache.set(url, info)
+        else:
+            self.probe_cache.set(url, {}, ttl=PROBE_FAILURE_TTL)
+            return None
+        return info
+
+    async def check_file_size_before_download(self, url: str, track: dict) -> tuple:
+        info = await self.probe_track(url)
 
-                # Жесткое ограничение для бесплатного Railway
-                can_download = file_size <= MAX_FILE_SIZE_MB if file_size > 0 else True
+        file_size = 0
+        if info and 'filesize' in info and info['filesize']:
+            file_size = info['filesize'] / (1024 * 1024)
+        elif info and 'filesize_approx' in info and info['filesize_approx']:
+            file_size = info['filesize_approx'] / (1024 * 1024)
 
-                return file_size, can_download
+        # Жесткое ограничение для бесплатного Railway
+        can_download = file_size <= MAX_FILE_SIZE_MB if file_size > 0 else True
 
-        except Exception as e:
-            logger.warning(f"Не удалось получить размер файла: {e}")
-            return 0, True
+        return file_size, can_download
 
     def _get_dynamic_timeout(self, track: dict) -> int:
         duration = track.get('duration', 0)
@@ -700,19 +821,97 @@ class StableMusicBot:
                 return False
             
             with open(fpath, 'rb') as f:
-                await context.bot.send_audio(
+                message = await context.bot.send_audio(
                     chat_id=update.effective_chat.id,
                     audio=f,
-                    title=(track.get('title') or 'Неизвестный трек')[:64],
-                    performer=(track.get('artist') or 'Неизвестный исполнитель')[:64],
-                    caption=f"🎵 <b>{track.get('title', 'Неизвестный трек')}</b>\n🎤 {track.get('artist', 'Неизвестный исполнитель')}\n⏱️ {self.format_duration(track.get('duration'))}\n💾 {actual_size_mb:.1f} MB",
-                    parse_mode='HTML',
+                    **self._audio_fields(track, actual_size_mb),
                 )
+            await self._remember_file_id(track.get('webpage_url') or track.get('url'), message)
             return True
         except Exception as e:
             logger.error(f"Ошибка отправки файла: {e}")
             return False
 
+    def _audio_fields(self, track: dict, size_mb: float = None) -> dict:
+        caption = (
+            f"🎵 <b>{track.get('title', 'Неизвестный трек')}</b>\n"
+            f"🎤 {track.get('artist', 'Неизвестный исполнитель')}\n"
+            f"⏱️ {self.format_duration(track.get('duration'))}"
+        )
+        if size_mb:
+            caption += f"\n💾 {size_mb:.1f} MB"
+        return {
+            'title': (track.get('title') or 'Неизвестный трек')[:64],
+            'performer': (track.get('artist') or 'Неизвестный исполнитель')[:64],
+            'caption': caption,
+            'parse_mode': 'HTML',
+        }
+
+    async def _send_cached_audio(self, update: Update, context: ContextTypes.DEFAULT_TYPE,
+                                 track: dict, url: str, status_message=None) -> bool:
+        """Отправляет трек по file_id, если он уже загружался в Telegram"""
+        cached = self.file_id_cache.get(url)
+        if not cached:
+            return False
+
+        file_id, size_bytes = cached
+        try:
+            await context.bot.send_audio(
+                chat_id=update.effective_chat.id,
+                audio=file_id,
+                **self._audio_fields(track, size_bytes / (1024 * 1024) if size_bytes else None),
+            )
+        except TelegramError as e:
+            # file_id мог устареть, а сеть - подвести; забываем его и скачиваем трек заново
+            logger.warning(f"Не удалось отправить по file_id {url}: {e}")
+            await self._discard_file_id(url)
+            return False
+
+        logger.info(f"⚡ Отправлен по file_id: {track.get('title')}")
+        if status_message:
+            try:
+                await status_message.edit_text(f"✅ Готово!\n🎵 {track.get('title', 'Неизвестный трек')[:30]}")
+            except TelegramError as e:
+                logger.warning(f"Не удалось обновить статус: {e}")
+        return True
+
+    async def _remember_file_id(self, url: str, message):
+        """Сохраняет file_id отправленного аудио; запись в SQLite идет в пуле disk"""
+        try:
+            await disk_executor.run(self.file_id_cache.remember, url, message)
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить file_id для {url}: {e}")
+
+    async def _discard_file_id(self, url: str):
+        try:
+            await disk_executor.run(self.file_id_cache.discard, url)
+        except Exception as e:
+            logger.warning(f"Не удалось удалить file_id для {url}: {e}")
+
+    @staticmethod
+    def _audio_cache_key(track: dict) -> str:
+        track_id = track.get('id')
+        return f"id:{track_id}" if track_id else f"url:{track.get('webpage_url') or track.get('url')}"
+
+    async def _fetch_cached_audio(self, cache_key: str, tmpdir: str) -> bool:
+        """Кладет трек из аудиокэша в tmpdir вместо скачивания"""
+        if not self.audio_cache:
+            return False
+        try:
+            path = await disk_executor.run(self.audio_cache.fetch, cache_key, tmpdir)
+        except ExecutorBusy:
+            return False
+        if path:
+            logger.info(f"💾 Трек взят из аудиокэша: {cache_key}")
+        return bool(path)
+
+    async def _store_cached_audio(self, cache_key: str, fpath: str):
+        if self.audio_cache:
+            try:
+                await disk_executor.run(self.audio_cache.store, cache_key, fpath)
+            except ExecutorBusy as e:
+                logger.warning(f"Трек не сохранен в аудиокэш: {e}")
+
     async def _cleanup_temp_dir(self, tmpdir: str):
         max_retries = 2
         for attempt in range(max_retries):
@@ -729,41 +928,38 @@ class StableMusicBot:
                     await asyncio.sleep(0.5)
 
     async def _pre_check_track(self, url: str, track: dict) -> bool:
-        try:
-            # Предварительная проверка размера
-            file_size_mb, can_download = await self.check_file_size_before_download(url, track)
-            if not can_download:
-                logger.info(f"🚫 Файл слишком большой: {file_size_mb:.1f} MB")
-                return False
-                
-            with yt_dlp.YoutubeDL({
-                'quiet': True,
-                'no_warnings': True,
-                'simulate': True,
-                'skip_download': True,
-                'socket_timeout': 10,
-            }) as ydl:
-                info = await asyncio.get_event_loop().run_in_executor(
-                    None, lambda: ydl.extract_info(url, download=False)
-                )
-                
-                if not info:
-                    return False
-                    
-                formats = info.get('formats', [])
-                if not formats:
-                    return False
-                    
-                audio_formats = [f for f in formats if f.get('vcodec') == 'none']
-                if not audio_formats:
-                    return False
-                    
-                return True
-                
-        except Exception as e:
-            logger.warning(f"Трек не прошел предварительную проверку: {e}")
+        # Размер проверяет download_and_send_track, метаданные берутся из того же probe_track
+        info = await self.probe_track(url)
+        if not info:
+            return False
+
+        formats = info.get('formats', [])
+        if not formats:
             return False
 
+        audio_formats = [f for f in formats if f.get('vcodec') == 'none']
+        if not audio_formats:
+            return False
+
+        return True
+
+    def _download_to(self, ydl_opts: dict, url: str, tmpdir: str, probe_info: dict = None, cancel_event=None):
+        """Скачивает в tmpdir по метаданным probe_track; если ссылки на поток уже
+        не работают - обычным extract_info по URL (вызывать в пуле потоков).
+        cancel_event останавливает передачу с DownloadCancelled."""
+        if probe_info:
+            try:
+                result = ydl_pool.process_ie_result(
+                    ydl_opts, probe_info, cancel_event=cancel_event, paths={'home': tmpdir}
+                )
+                if os.listdir(tmpdir):
+                    return result
+            except DownloadCancelled:
+                raise
+            except Exception as e:
+                logger.info(f"Скачивание по сохраненным метаданным не удалось, повторяем по URL: {e}")
+        return ydl_pool.extract_info(ydl_opts, url, download=True, cancel_event=cancel_event, paths={'home': tmpdir})
+
     async def download_and_send_track(self, update: Update, context: ContextTypes.DEFAULT_TYPE, track: dict, status_message=None) -> bool:
         url = track.get('webpage_url') or track.get('url')
         if not url:
@@ -775,24 +971,42 @@ class StableMusicBot:
                 await status_message.edit_text(f"🚫 Этот трек временно недоступен\n🎵 {track.get('title', 'Неизвестный трек')[:30]}")
             return False
 
-        # Предварительная проверка размера
-        file_size_mb, can_download = await self.check_file_size_before_download(url, track)
-        if not can_download:
-            logger.info(f"🚫 Файл слишком большой для скачивания: {file_size_mb:.1f} MB")
+        if await self._send_cached_audio(update, context, track, url, status_message):
+            return True
+
+        # Очереди скачивания переполнены - отказываем сразу, а не после минут ожидания
+        if download_executor.saturated or metadata_executor.saturated:
+            logger.warning(f"⏳ Очередь скачивания переполнена, отклонен: {track.get('title')}")
             if status_message:
-                await status_message.edit_text(
-                    f"❌ Файл слишком большой ({file_size_mb:.1f} MB)\n"
-                    f"🎵 {track.get('title', 'Неизвестный трек')[:30]}\n\n"
-                    f"📏 Максимальный размер: {MAX_FILE_SIZE_MB} MB\n"
-                    f"🔧 Попробуйте найти другую версию"
+                await status_message.edit_text(f"⏳ Бот сейчас перегружен, попробуйте через минуту\n🎵 {track.get('title', 'Неизвестный трек')[:30]}")
+            else:
+                await context.bot.send_message(
+                    chat_id=update.effective_chat.id,
+                    text="⏳ Бот сейчас перегружен, попробуйте через минуту"
                 )
             return False
 
-        if not await self._pre_check_track(url, track):
-            logger.info(f"🚫 Пропускаем проблемный трек: {track.get('title')}")
-            if status_message:
-                await status_message.edit_text(f"🚫 Этот трек временно недоступен\n🎵 {track.get('title', 'Неизвестный трек')[:30]}")
-            return False
+        # Файл из аудиокэша уже проверен при первом скачивании
+        file_size_mb = 0
+        if not (self.audio_cache and self.audio_cache.contains(self._audio_cache_key(track))):
+            # Предварительная проверка размера
+            file_size_mb, can_download = await self.check_file_size_before_download(url, track)
+            if not can_download:
+                logger.info(f"🚫 Файл слишком большой для скачивания: {file_size_mb:.1f} MB")
+                if status_message:
+                    await status_message.edit_text(
+                        f"❌ Файл слишком большой ({file_size_mb:.1f} MB)\n"
+                        f"🎵 {track.get('title', 'Неизвестный трек')[:30]}\n\n"
+                        f"📏 Максимальный размер: {MAX_FILE_SIZE_MB} MB\n"
+                        f"🔧 Попробуйте найти другую версию"
+                    )
+                return False
+
+            if not await self._pre_check_track(url, track):
+                logger.info(f"🚫 Пропускаем проблемный трек: {track.get('title')}")
+                if status_message:
+                    await status_message.edit_text(f"🚫 Этот трек временно недоступен\n🎵 {track.get('title', 'Неизвестный трек')[:30]}")
+                return False
 
         try:
             # Обязательное уведомление о начале скачивания
@@ -828,35 +1042,39 @@ class StableMusicBot:
         if not url:
             return False
 
-        loop = asyncio.get_event_loop()
         tmpdir = tempfile.mkdtemp()
         
         try:
-            ydl_opts = FAST_DOWNLOAD_OPTS.copy()
-            ydl_opts['outtmpl'] = os.path.join(tmpdir, '%(title).80s.%(ext)s')
+            probe_info = self.probe_cache.get(url)
 
-            def download_track():
+            def download_track(cancel_event):
                 try:
-                    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                        result = ydl.extract_info(url, download=True)
-                        files = os.listdir(tmpdir)
-                        return result if files else None
+                    result = self._download_to(POOLED_FAST_DOWNLOAD_OPTS, url, tmpdir, probe_info, cancel_event)
+                    files = os.listdir(tmpdir)
+                    return result if files else None
+                except DownloadCancelled:
+                    logger.info(f"⏹ Скачивание остановлено: {url}")
+                    return None
                 except Exception as e:
                     logger.error(f"Ошибка скачивания {url}: {e}")
                     return None
 
-            # Быстрый ретрай при таймауте
-            try:
-                info = await asyncio.wait_for(
-                    loop.run_in_executor(None, download_track),
-                    timeout=90
-                )
-            except asyncio.TimeoutError:
-                logger.info(f"🔄 Быстрый ретрай для: {track.get('title')}")
-                info = await asyncio.wait_for(
-                    loop.run_in_executor(None, download_track),
-                    timeout=60
-                )
+            cache_key = self._audio_cache_key(track)
+            from_cache = await self._fetch_cached_audio(cache_key, tmpdir)
+            if not from_cache:
+                # Быстрый ретрай при таймауте
+                # По таймауту скачивание действительно останавливается, а не продолжается в фоне
+                try:
+                    info = await download_executor.run_cancellable(download_track, timeout=90)
+                except TaskOverdue:
+                    # Прежнее скачивание еще пишет в tmpdir - повтор был бы вторым скачиванием
+                    raise
+                except asyncio.TimeoutError:
+                    logger.info(f"🔄 Быстрый ретрай для: {track.get('title')}")
+                    # Недокачанный файл (nopart) yt-dlp принял бы за готовый
+                    shutil.rmtree(tmpdir, ignore_errors=True)
+                    os.makedirs(tmpdir, exist_ok=True)
+                    info = await download_executor.run_cancellable(download_track, timeout=60)
 
             files = os.listdir(tmpdir)
             if not files:
@@ -887,6 +1105,9 @@ class StableMusicBot:
                     )
                 return False
 
+            if not from_cache:
+                await self._store_cached_audio(cache_key, fpath)
+
             if status_message:
                 await status_message.edit_text(f"📤 Отправляем...\n🎵 {track.get('title', 'Неизвестный трек')[:30]}")
 
@@ -899,9 +1120,16 @@ class StableMusicBot:
             
             return False
 
+        except TaskOverdue as e:
+            logger.error(f"Скачивание не остановилось после таймаута, повтор пропущен: {e}")
+            return False
         except asyncio.TimeoutError:
             logger.error(f"Таймаут при скачивании: {track.get('title', 'Unknown')}")
             return await self.download_large_track(update, context, track, status_message)
+        except ExecutorBusy as e:
+            # Перегрузка бота - не повод заносить трек в черный список
+            logger.warning(f"Скачивание не принято: {e}")
+            return False
         except Exception as e:
             logger.exception(f'Ошибка быстрого скачивания: {e}')
             self.track_blacklist.add(url)
@@ -914,27 +1142,27 @@ class StableMusicBot:
         if not url:
             return False
 
-        loop = asyncio.get_event_loop()
         tmpdir = tempfile.mkdtemp()
         
         try:
-            ydl_opts = LARGE_FILE_OPTS.copy()
-            ydl_opts['outtmpl'] = os.path.join(tmpdir, '%(title).80s.%(ext)s')
+            probe_info = self.probe_cache.get(url)
 
-            def download_track():
+            def download_track(cancel_event):
                 try:
-                    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                        result = ydl.extract_info(url, download=True)
-                        files = os.listdir(tmpdir)
-                        return result if files else None
+                    result = self._download_to(POOLED_LARGE_FILE_OPTS, url, tmpdir, probe_info, cancel_event)
+                    files = os.listdir(tmpdir)
+                    return result if files else None
+                except DownloadCancelled:
+                    logger.info(f"⏹ Скачивание остановлено: {url}")
+                    return None
                 except Exception as e:
                     logger.error(f"Ошибка скачивания {url}: {e}")
                     return None
 
-            info = await asyncio.wait_for(
-                loop.run_in_executor(None, download_track),
-                timeout=240
-            )
+            cache_key = self._audio_cache_key(track)
+            from_cache = await self._fetch_cached_audio(cache_key, tmpdir)
+            if not from_cache:
+                info = await download_executor.run_cancellable(download_track, timeout=240)
 
             files = os.listdir(tmpdir)
             if not files:
@@ -965,6 +1193,9 @@ class StableMusicBot:
                     )
                 return False
 
+            if not from_cache:
+                await self._store_cached_audio(cache_key, fpath)
+
             if status_message:
                 await status_message.edit_text(f"📤 Отправляем...\n🎵 {track.get('title', 'Неизвестный трек')[:30]}")
 
@@ -980,6 +1211,9 @@ class StableMusicBot:
         except asyncio.TimeoutError:
             logger.error(f"Таймаут при скачивании большого файла: {track.get('title', 'Unknown')}")
             return False
+        except ExecutorBusy as e:
+            logger.warning(f"Скачивание не принято: {e}")
+            return False
         except Exception as e:
             logger.exception(f'Ошибка скачивания большого файла: {e}')
             self.track_blacklist.add(url)
@@ -989,44 +1223,72 @@ class StableMusicBot:
 
     # ==================== УСКОРЕННЫЙ ПОИСК НА SOUNDCLOUD ====================
 
-    async def search_soundcloud(self, query: str, album_only: bool = False, user_id: str = None):
-        # Проверяем кэш популярных запросов
-        if query in POPULAR_QUERIES_CACHE:
-            cache_data = POPULAR_QUERIES_CACHE[query]
-            if datetime.now().timestamp() - cache_data['timestamp'] < POPULAR_CACHE_TTL:
+    async def search_soundcloud(self, query: str, album_only: bool = False, user_id: str = None,
+                                track_stats: bool = True):
+        # Все кэши ищем по каноническому ключу, а не по сырому тексту запроса.
+        # track_stats=False - служебные запросы (прогрев), не влияющие на статистику
+        cache_key = normalize_query(query)
+
+        # Проверяем кэш популярных запросов: устаревшая запись отдается сразу
+        # и обновляется в фоне
+        cache_data = POPULAR_QUERIES_CACHE.get(cache_key)
+        if cache_data:
+            age = datetime.now().timestamp() - cache_data['timestamp']
+            if age < POPULAR_CACHE_MAX_STALE:
+                if age >= POPULAR_CACHE_TTL:
+                    self.refresher.trigger(
+                        ('popular', cache_key), lambda: self._refresh_popular_query(query, cache_key)
+                    )
                 logger.info(f"✅ Используем предзагруженный кэш для: '{query}'")
+                if track_stats:
+                    self.query_stats.record(query, cache_key, hit=True)
                 results = cache_data['results']
                 if user_id:
                     results = self.apply_user_filters(results, user_id)
                 return results
 
-        # Проверяем обычный кэш
-        cache_key = f"{query}_{user_id}"
-        cached_results = self.search_cache.get(cache_key)
+        # Проверяем обычный кэш: в нем лежат результаты без фильтров,
+        # поэтому одна запись обслуживает всех пользователей
+        cached_results = await self.shared_cache.get(cache_key)
+        if track_stats:
+            self.query_stats.record(query, cache_key, hit=bool(cached_results))
         if cached_results:
             logger.info(f"✅ Используем кэш для: '{query}'")
-            return cached_results
+            if user_id:
+                return self.apply_user_filters(cached_results, user_id)
+            return list(cached_results)
 
-        async with self.search_semaphore:
-            ydl_opts = {
-                'format': 'bestaudio/best',
-                'quiet': True,
-                'no_warnings': True,
-                'extract_flat': True,
-                'ignoreerrors': True,
-                'noplaylist': True,
-                'socket_timeout': 12,  # Увеличили таймаут
+        # Одновременные одинаковые запросы ждут один общий поиск
+        results = await self.search_flight.run(
+            cache_key, lambda: self._fetch_soundcloud(query, cache_key)
+        )
+
+        if user_id:
+            results = self.apply_user_filters(results, user_id)
+        else:
+            results = list(results)
+
+        logger.info(f"✅ SoundCloud: {len(results)} отфильтрованных результатов для: '{query}'")
+        return results
+
+    async def _refresh_popular_query(self, query: str, cache_key: str):
+        """Фоновое обновление устаревшей записи POPULAR_QUERIES_CACHE"""
+        results = await self.search_flight.run(
+            cache_key, lambda: self._fetch_soundcloud(query, cache_key)
+        )
+        if results:
+            POPULAR_QUERIES_CACHE[cache_key] = {
+                'results': results[:5],
+                'timestamp': datetime.now().timestamp()
             }
 
+    async def _fetch_soundcloud(self, query: str, cache_key: str) -> list:
+        """Поиск на SoundCloud без фильтров пользователя; результат кладется в кэш"""
+        async with self.search_semaphore:
             results = []
             try:
-                def perform_search():
-                    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                        return ydl.extract_info(f"scsearch30:{query}", download=False)  # Вернули 30 результатов
-
-                loop = asyncio.get_event_loop()
                 info = await asyncio.wait_for(
-                    loop.run_in_executor(None, perform_search),
+                    self.search_backend.search(f"scsearch30:{query}"),  # Вернули 30 результатов
                     timeout=SEARCH_TIMEOUT
                 )
 
@@ -1062,11 +1324,9 @@ class StableMusicBot:
                         'thumbnail': thumbnail
                     })
 
-                if user_id:
-                    results = self.apply_user_filters(results, user_id)
-
-                # Сохраняем в кэш
-                self.search_cache.set(cache_key, results)
+                # Сохраняем в кэш до применения фильтров пользователя
+                await self.shared_cache.set(cache_key, results)
+                self.query_stats.record_fill(query, cache_key)
 
             except asyncio.TimeoutError:
                 logger.warning(f"Таймаут поиска для запроса: {query}")
@@ -1075,7 +1335,6 @@ class StableMusicBot:
                 logger.warning(f'Ошибка поиска SoundCloud: {e}')
                 return []
 
-            logger.info(f"✅ SoundCloud: {len(results)} отфильтрованных результатов для: '{query}'")
             return results
 
     # ==================== ОСНОВНЫЕ КОМАНДЫ ====================
@@ -1085,7 +1344,7 @@ class StableMusicBot:
         self.ensure_user(user.id)
 
         await self.show_main_menu(update, context)
-        save_data()
+        save_data(user.id)
 
     async def search_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text('🎵 Введите название песни или исполнителя:')
@@ -1146,13 +1405,13 @@ class StableMusicBot:
                 stats = user_data.get('_user_stats', {}).get(str(user.id), {})
                 stats['downloads'] = stats.get('downloads', 0) + 1
                 stats['searches'] = stats.get('searches', 0) + 1
-                save_data()
+                save_data(user.id)
 
                 user_entry = user_data[str(user.id)]
                 download_history = user_entry.get('download_history', [])
                 download_history.append(random_track)
                 user_entry['download_history'] = download_history[-50:]
-                save_data()
+                save_data(user.id)
 
                 keyboard = [
                     [InlineKeyboardButton('🎲 Еще случайный трек', callback_data='random_track')],
@@ -1232,11 +1491,12 @@ class StableMusicBot:
                 await update.message.reply_text('❌ По вашему запросу ничего не найдено.')
                 return
 
-            user_entry['search_results'] = results
-            user_entry['search_query'] = text
-            user_entry['current_page'] = 0
-            user_entry['total_pages'] = (len(results) + RESULTS_PER_PAGE - 1) // RESULTS_PER_PAGE
-            save_data()
+            session = sessions.get(user.id)
+            session['search_results'] = results
+            session['search_query'] = text
+            session['current_page'] = 0
+            session['total_pages'] = (len(results) + RESULTS_PER_PAGE - 1) // RESULTS_PER_PAGE
+            save_data(user.id)
 
             await self.show_results_page(update, context, user.id, 0)
         except Exception as e:
@@ -1244,10 +1504,10 @@ class StableMusicBot:
             await update.message.reply_text('❌ Ошибка при поиске.')
 
     async def show_results_page(self, update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, page: int):
-        user_entry = user_data.get(str(user_id), {})
-        results = user_entry.get('search_results', [])
-        total_pages = user_entry.get('total_pages', 0)
-        query = user_entry.get('search_query', '')
+        session = sessions.get(user_id)
+        results = session.get('search_results', [])
+        total_pages = session.get('total_pages', 0)
+        query = session.get('search_query', '')
 
         if page < 0 or page >= max(1, total_pages):
             page = 0
@@ -1296,15 +1556,13 @@ class StableMusicBot:
         except Exception as e:
             logger.warning(f'Ошибка отображения страницы результатов: {e}')
 
-        user_data[str(user_id)]['current_page'] = page
-        save_data()
+        sessions.get(user_id)['current_page'] = page
 
     async def download_by_index(self, update: Update, context: ContextTypes.DEFAULT_TYPE, index: int, return_page: int = 0):
         query = update.callback_query
         user = update.effective_user
 
-        user_entry = user_data.get(str(user.id), {})
-        results = user_entry.get('search_results', [])
+        results = sessions.get(user.id).get('search_results', [])
         if index < 0 or index >= len(results):
             await query.edit_message_text('❌ Трек не найден')
             return
@@ -1321,13 +1579,13 @@ class StableMusicBot:
         if success:
             stats = user_data.get('_user_stats', {}).get(str(user.id), {})
             stats['downloads'] = stats.get('downloads', 0) + 1
-            save_data()
+            save_data(user.id)
 
             user_entry = user_data[str(user.id)]
             download_history = user_entry.get('download_history', [])
             download_history.append(track)
             user_entry['download_history'] = download_history[-50:]
-            save_data()
+            save_data(user.id)
 
             await self.show_results_page(update, context, user.id, return_page)
 
@@ -1506,7 +1764,7 @@ class StableMusicBot:
         self.ensure_user(user.id)
 
         user_data[str(user.id)]['filters']['duration'] = key
-        save_data()
+        save_data(user.id)
 
         filter_name = DURATION_FILTERS.get(key, 'Без фильтра')
         await update.callback_query.answer(f'Фильтр установлен: {filter_name}')
@@ -1518,7 +1776,7 @@ class StableMusicBot:
 
         current = user_data[str(user.id)]['filters'].get('music_only', False)
         user_data[str(user.id)]['filters']['music_only'] = not current
-        save_data()
+        save_data(user.id)
 
         status = "ВКЛЮЧЕН" if not current else "ВЫКЛЮЧЕН"
         await update.callback_query.answer(f'Фильтр "Только музыка" {status}')
@@ -1620,10 +1878,10 @@ class StableMusicBot:
                 )
                 return
 
-            user_data[str(user.id)]['current_recommendations'] = recommendations
-            user_data[str(user.id)]['recommendations_page'] = 0
-            user_data[str(user.id)]['recommendations_total_pages'] = (len(recommendations) + RESULTS_PER_PAGE - 1) // RESULTS_PER_PAGE
-            save_data()
+            session = sessions.get(user.id)
+            session['current_recommendations'] = recommendations
+            session['recommendations_page'] = 0
+            session['recommendations_total_pages'] = (len(recommendations) + RESULTS_PER_PAGE - 1) // RESULTS_PER_PAGE
 
             await self.show_recommendations_page(update, context, 0, status_msg)
 
@@ -1641,8 +1899,9 @@ class StableMusicBot:
         user = update.effective_user
         self.ensure_user(user.id)
 
-        recommendations = user_data[str(user.id)].get('current_recommendations', [])
-        total_pages = user_data[str(user.id)].get('recommendations_total_pages', 0)
+        session = sessions.get(user.id)
+        recommendations = session.get('current_recommendations', [])
+        total_pages = session.get('recommendations_total_pages', 0)
 
         if page < 0 or page >= max(1, total_pages):
             page = 0
@@ -1704,12 +1963,11 @@ class StableMusicBot:
         except Exception as e:
             logger.warning(f'Ошибка отображения страницы рекомендаций: {e}')
 
-        user_data[str(user.id)]['recommendations_page'] = page
-        save_data()
+        sessions.get(user.id)['recommendations_page'] = page
 
     async def download_from_recommendations(self, update: Update, context: ContextTypes.DEFAULT_TYPE, index: int):
         user = update.effective_user
-        recommendations = user_data[str(user.id)].get('current_recommendations', [])
+        recommendations = sessions.get(user.id).get('current_recommendations', [])
 
         if index < 0 or index >= len(recommendations):
             await update.callback_query.edit_message_text('❌ Трек не найден')
@@ -1728,27 +1986,40 @@ class StableMusicBot:
 
     # ==================== ЧАРТЫ ====================
 
-    async def update_charts_cache(self, user_id: str = None):
-        now = datetime.now()
-        last_update = charts_cache.get('last_update')
+    async def update_charts_cache(self):
+        """Отдает чарты без ожидания: устаревшие пересобираются в фоне.
 
-        if last_update:
+        Ждать приходится только при полностью пустом кэше (первый запуск)"""
+        last_update = charts_cache.get('last_update')
+        if last_update and charts_cache.get('data'):
             last_update_date = datetime.strptime(last_update, '%Y-%m-%d %H:%M:%S')
-            if now - last_update_date < timedelta(hours=6):
-                return
+            if datetime.now() - last_update_date >= CHARTS_CACHE_TTL:
+                self.refresher.trigger('charts', self._rebuild_charts_cache)
+            return
 
+        await asyncio.shield(self.refresher.trigger('charts', self._rebuild_charts_cache))
+
+    async def _rebuild_charts_cache(self):
         logger.info("🔄 Обновление кэша чартов...")
+        now = datetime.now()
 
+        # Чарты общие для всех, фильтры пользователя применяются при показе
         charts_data = {}
         for query in POPULAR_SEARCHES[:4]:
             try:
-                results = await self.search_soundcloud(query, user_id=user_id)
+                # Служебный поиск - не учитывается в статистике и приоритете прогрева
+                results = await self.search_soundcloud(query, track_stats=False)
                 if results:
                     charts_data[query] = results[:8]
                 await asyncio.sleep(0.5)
             except Exception as e:
                 logger.warning(f"Ошибка обновления чарта для {query}: {e}")
 
+        if not charts_data:
+            # Оставляем прежние чарты, следующий показ попробует еще раз
+            logger.warning("Не удалось обновить кэш чартов")
+            return
+
         charts_cache['data'] = charts_data
         charts_cache['last_update'] = now.strftime('%Y-%m-%d %H:%M:%S')
         save_charts_cache()
@@ -1767,25 +2038,26 @@ class StableMusicBot:
             return
 
         try:
-            await self.update_charts_cache(user_id=str(user.id))
+            await self.update_charts_cache()
 
             charts_data = charts_cache.get('data', {})
 
-            if not charts_data:
-                await status_msg.edit_text("❌ Чарты временно недоступны. Попробуйте позже.")
-                return
-
             all_tracks = []
             for query, tracks in charts_data.items():
                 all_tracks.extend(tracks)
+            all_tracks = self.apply_user_filters(all_tracks, str(user.id))
+
+            if not all_tracks:
+                await status_msg.edit_text("❌ Чарты временно недоступны. Попробуйте позже.")
+                return
 
             random.shuffle(all_tracks)
             top_tracks = all_tracks[:25]
 
-            user_data[str(user.id)]['current_charts'] = top_tracks
-            user_data[str(user.id)]['charts_page'] = 0
-            user_data[str(user.id)]['charts_total_pages'] = (len(top_tracks) + RESULTS_PER_PAGE - 1) // RESULTS_PER_PAGE
-            save_data()
+            session = sessions.get(user.id)
+            session['current_charts'] = top_tracks
+            session['charts_page'] = 0
+            session['charts_total_pages'] = (len(top_tracks) + RESULTS_PER_PAGE - 1) // RESULTS_PER_PAGE
 
             await self.show_charts_page(update, context, 0, status_msg)
 
@@ -1797,8 +2069,9 @@ class StableMusicBot:
         user = update.effective_user
         self.ensure_user(user.id)
 
-        charts = user_data[str(user.id)].get('current_charts', [])
-        total_pages = user_data[str(user.id)].get('charts_total_pages', 0)
+        session = sessions.get(user.id)
+        charts = session.get('current_charts', [])
+        total_pages = session.get('charts_total_pages', 0)
 
         if page < 0 or page >= max(1, total_pages):
             page = 0
@@ -1851,13 +2124,13 @@ class StableMusicBot:
         except Exception as e:
             logger.warning(f'Ошибка отображения страницы чартов: {e}')
 
-        user_data[str(user.id)]['charts_page'] = page
-        save_data()
+        sessions.get(user.id)['charts_page'] = page
 
     async def download_from_charts(self, update: Update, context: ContextTypes.DEFAULT_TYPE, index: int):
         user = update.effective_user
-        charts = user_data[str(user.id)].get('current_charts', [])
-        current_page = user_data[str(user.id)].get('charts_page', 0)
+        session = sessions.get(user.id)
+        charts = session.get('current_charts', [])
+        current_page = session.get('charts_page', 0)
 
         if index < 0 or index >= len(charts):
             await update.callback_query.edit_message_text('❌ Трек не найден')
@@ -1933,14 +2206,14 @@ class StableMusicBot:
             random.shuffle(all_tracks)
             playlist_tracks = all_tracks[:25]
 
-            user_data[str(user.id)]['current_playlist'] = {
+            session = sessions.get(user.id)
+            session['current_playlist'] = {
                 'tracks': playlist_tracks,
                 'name': playlist['name'],
                 'description': playlist['description']
             }
-            user_data[str(user.id)]['playlist_page'] = 0
-            user_data[str(user.id)]['playlist_total_pages'] = (len(playlist_tracks) + RESULTS_PER_PAGE - 1) // RESULTS_PER_PAGE
-            save_data()
+            session['playlist_page'] = 0
+            session['playlist_total_pages'] = (len(playlist_tracks) + RESULTS_PER_PAGE - 1) // RESULTS_PER_PAGE
 
             await self.show_playlist_page(update, context, 0, status_msg)
 
@@ -1952,12 +2225,12 @@ class StableMusicBot:
         user = update.effective_user
         self.ensure_user(user.id)
 
-        playlist_data = user_data[str(user.id)].get('current_playlist', {})
+        playlist_data = sessions.get(user.id).get('current_playlist', {})
         tracks = playlist_data.get('tracks', [])
         playlist_name = playlist_data.get('name', 'Плейлист')
         playlist_description = playlist_data.get('description', '')
 
-        total_pages = user_data[str(user.id)].get('playlist_total_pages', 0)
+        total_pages = sessions.get(user.id).get('playlist_total_pages', 0)
 
         if page < 0 or page >= max(1, total_pages):
             page = 0
@@ -2010,14 +2283,13 @@ class StableMusicBot:
         except Exception as e:
             logger.warning(f'Ошибка отображения страницы плейлиста: {e}')
 
-        user_data[str(user.id)]['playlist_page'] = page
-        save_data()
+        sessions.get(user.id)['playlist_page'] = page
 
     async def download_from_playlist(self, update: Update, context: ContextTypes.DEFAULT_TYPE, index: int):
         user = update.effective_user
-        playlist = user_data[str(user.id)].get('current_playlist', {})
+        playlist = sessions.get(user.id).get('current_playlist', {})
         tracks = playlist.get('tracks', [])
-        current_page = user_data[str(user.id)].get('playlist_page', 0)
+        current_page = sessions.get(user.id).get('playlist_page', 0)
 
         if index < 0 or index >= len(tracks):
             await update.callback_query.edit_message_text('❌ Трек не найден')
@@ -2043,13 +2315,13 @@ class StableMusicBot:
         if success:
             stats = user_data.get('_user_stats', {}).get(str(user.id), {})
             stats['downloads'] = stats.get('downloads', 0) + 1
-            save_data()
+            save_data(user.id)
 
             user_entry = user_data[str(user.id)]
             download_history = user_entry.get('download_history', [])
             download_history.append(track)
             user_entry['download_history'] = download_history[-50:]
-            save_data()
+            save_data(user.id)
 
             if source == 'recommendations':
                 await self.show_recommendations_page(update, context, 0)
@@ -2063,6 +2335,7 @@ class StableMusicBot:
 
         app = Application.builder().token(BOT_TOKEN).build()
 
+        app.add_handler(TypeHandler(Update, preload_user_data), group=-1)
         app.add_handler(CommandHandler('start', self.start))
         app.add_handler(CommandHandler('search', self.search_command))
         app.add_handler(CommandHandler('charts', self.charts_command))
@@ -2077,6 +2350,17 @@ class StableMusicBot:
         app.add_handler(CallbackQueryHandler(self.handle_callback))
 
         async def set_commands(application):
+            if os.environ.get('REDIS_URL'):
+                await redis_client.connect()
+
+            for opts in (FAST_INFO_OPTS, POOLED_FAST_DOWNLOAD_OPTS):
+                metadata_executor.submit(ydl_pool.prewarm, opts, YDL_POOL_PREWARM)
+
+            self._warmup_task = asyncio.create_task(self.preload_popular_queries())
+            # Чарты собираются заранее, чтобы первый /charts не ждал поиска
+            self._charts_task = asyncio.create_task(self.update_charts_cache())
+            self._query_counts_task = asyncio.create_task(self.save_query_counts_periodically())
+
             commands = [
                 ('start', '🚀 Запустить бота'),
                 ('search', '🔍 Поиск музыки'),
@@ -2092,8 +2376,15 @@ class StableMusicBot:
 
         app.post_init = set_commands
 
+        if HEALTH_PORT:
+            HealthServer(self, port=int(HEALTH_PORT)).start()
+
         print('✅ Ускоренный бот запущен! Оптимизированы поиск и скачивание.')
-        app.run_polling()
+        try:
+            app.run_polling()
+        finally:
+            flush_data()
+            self.save_query_counts()
 
 if __name__ == '__main__':
     bot = StableMusicBot()
@@ -12,6 +12,11 @@ from datetime import datetime, timedelta
 from pathlib import Path
 import concurrent.futures
 
+from user_store import WriteBehindSaver
+from user_repository import LazyUserData, create_user_repository
+from session_store import SessionStore, SESSION_KEYS
+from executors import search_executor, metadata_executor, download_executor, disk_executor
+
 # ==================== CONFIG ====================
 BOT_TOKEN = os.environ.get('BOT_TOKEN')
 ADMIN_IDS = os.environ.get('ADMIN_IDS', '').split(',')
@@ -32,6 +37,15 @@ else:
 RESULTS_PER_PAGE = 8
 DATA_FILE = Path('user_data.json')
 CHARTS_FILE = Path('charts_cache.json')
+# Окно, в котором изменения пользователей копятся перед записью на диск
+USER_SAVE_DELAY = float(os.environ.get('USER_SAVE_DELAY', 2))
+# Пользователи хранятся в SQLite, либо в Postgres при заданном DATABASE_URL
+USER_DB_FILE = Path(os.environ.get('USER_DB_FILE', 'user_data.db'))
+DATABASE_URL = os.environ.get('DATABASE_URL')
+# Сколько пользователей держать в памяти одновременно
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 2000))
+# Сколько секунд хранить результаты поиска и страницы неактивного пользователя
+SESSION_TTL = int(os.environ.get('SESSION_TTL', 3600))
 MAX_FILE_SIZE_MB = 50  # Максимальный размер для скачивания
 
 # ОГРАНИЧЕНИЯ ДЛЯ СТАБИЛЬНОСТИ
@@ -134,7 +148,7 @@ POPULAR_SEARCHES = [
 try:
     from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
     from telegram.ext import (
-        Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, 
+        Application, CommandHandler, MessageHandler, CallbackQueryHandler, TypeHandler, filters, 
         ContextTypes
     )
     import yt_dlp
@@ -167,20 +181,16 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # ==================== USER DATA STORAGE ====================
+user_repository = create_user_repository(DATABASE_URL, USER_DB_FILE, legacy_file=DATA_FILE)
+user_saver = WriteBehindSaver(user_repository, delay=USER_SAVE_DELAY)
+sessions = SessionStore(ttl=SESSION_TTL)
 user_data = {}
 charts_cache = {}
 
 def load_data():
     global user_data, charts_cache
-    if DATA_FILE.exists():
-        try:
-            with open(DATA_FILE, 'r', encoding='utf-8') as f:
-                user_data = json.load(f)
-        except Exception as e:
-            logger.warning(f"Не удалось загрузить {DATA_FILE}: {e}")
-            user_data = {}
-    else:
-        user_data = {}
+    # Пользователи подгружаются из репозитория при первом обращении
+    user_data = LazyUserData(user_repository, max_cached=USER_CACHE_SIZE, saver=user_saver)
 
     if CHARTS_FILE.exists():
         try:
@@ -192,10 +202,25 @@ def load_data():
     else:
         charts_cache = {}
 
-def save_data():
+def save_data(*user_ids):
+    """Помечает изменения user_data для отложенной записи в журнал.
+
+    С user_ids проверяются только записи этих пользователей,
+    без аргументов - весь user_data."""
     try:
-        with open(DATA_FILE, 'w', encoding='utf-8') as f:
-            json.dump(user_data, f, ensure_ascii=False, indent=2)
+        user_saver.mark_dirty(user_data, user_ids or None)
+    except Exception as e:
+        logger.error(f"Ошибка сохранения данных: {e}")
+
+async def preload_user_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Подгружает запись пользователя до обработчиков, чтобы они не читали базу в event loop"""
+    if update.effective_user and isinstance(user_data, LazyUserData):
+        await user_data.preload_user(str(update.effective_user.id))
+
+def flush_data():
+    """Дописывает все отложенные изменения (при остановке бота)"""
+    try:
+        user_saver.flush()
     except Exception as e:
         logger.error(f"Ошибка сохранения данных: {e}")
 
@@ -227,16 +252,16 @@ async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await require_admin(update, context):
         return
 
-    user_count = len([k for k in user_data.keys() if not k.startswith('_')])
-    total_downloads = sum(stats.get('downloads', 0) for stats in user_data.get('_user_stats', {}).values())
-    total_searches = sum(stats.get('searches', 0) for stats in user_data.get('_user_stats', {}).values())
+    user_count = await disk_executor.run(user_repository.count_users)
+    totals = await disk_executor.run(user_repository.stats_totals)
+    total_downloads = totals['downloads']
+    total_searches = totals['searches']
 
     text = f"""📊 <b>Админ статистика</b>
 
 👥 Пользователей: {user_count}
 📥 Всего скачиваний: {total_downloads}
 🔍 Всего поисков: {total_searches}
-💾 Размер user_data: {len(str(user_data))} символов
 📈 Кэш чартов: {len(charts_cache.get('data', {}))} запросов
 🔧 Админов: {len(ADMIN_IDS)}"""
 
@@ -250,26 +275,30 @@ async def admin_cleanup(update: Update, context: ContextTypes.DEFAULT_TYPE):
     cleared_users = 0
     current_time = datetime.now()
 
-    for user_id in list(user_data.keys()):
-        if user_id.startswith('_') or user_id in ADMIN_IDS:
+    # Список пользователей и их статистика читаются из базы в пуле disk, а не в event loop
+    user_ids = await user_data.all_keys()
+    all_stats = await user_data['_user_stats'].load_all()
+
+    for user_id in user_ids:
+        if user_id in ADMIN_IDS:
             continue
 
-        user_stats = user_data.get('_user_stats', {}).get(user_id, {})
+        user_stats = all_stats.get(user_id, {})
         last_search = user_stats.get('last_search')
 
         if last_search:
             try:
                 last_active = datetime.strptime(last_search, '%d.%m.%Y %H:%M')
                 if (current_time - last_active).days > 30:
-                    del user_data[user_id]
-                    if user_id in user_data.get('_user_stats', {}):
-                        del user_data['_user_stats'][user_id]
+                    user_data.discard(user_id)
+                    if user_id in all_stats:
+                        user_data['_user_stats'].discard(user_id)
                     cleared_users += 1
             except ValueError:
-                del user_data[user_id]
+                user_data.discard(user_id)
                 cleared_users += 1
         else:
-            del user_data[user_id]
+            user_data.discard(user_id)
             cleared_users += 1
 
     save_data()
@@ -277,7 +306,7 @@ async def admin_cleanup(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         f"✅ Очистка завершена!\n"
         f"🗑 Удалено неактивных пользователей: {cleared_users}\n"
-        f"👥 Осталось пользователей: {len([k for k in user_data.keys() if not k.startswith('_')])}"
+        f"👥 Осталось пользователей: {len(user_ids) - cleared_users}"
     )
 
 async def admin_files(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -286,14 +315,14 @@ async def admin_files(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     try:
-        user_data_size = os.path.getsize('user_data.json') if os.path.exists('user_data.json') else 0
+        user_data_size = os.path.getsize(USER_DB_FILE) if USER_DB_FILE.exists() else 0
         charts_cache_size = os.path.getsize('charts_cache.json') if os.path.exists('charts_cache.json') else 0
 
         text = f"""📁 <b>Информация о файлах</b>
 
-user_data.json: {user_data_size / 1024:.1f} KB
+{USER_DB_FILE.name}: {user_data_size / 1024:.1f} KB
 charts_cache.json: {charts_cache_size / 1024:.1f} KB
-Всего пользователей: {len(user_data)}"""
+Всего пользователей: {await disk_executor.run(user_repository.count_users)}"""
 
         await update.message.reply_text(text, parse_mode='HTML')
 
@@ -338,21 +367,20 @@ class StableMusicBot:
         if str(user_id) not in user_data:
             user_data[str(user_id)] = {
                 'filters': {'duration': 'no_filter', 'music_only': False},
-                'search_results': [],
-                'search_query': '',
-                'current_page': 0,
-                'total_pages': 0,
                 'favorites': [],
                 'search_history': [],
                 'download_history': [],
                 'download_queue': [],
-                'random_track_result': [],
                 'achievements': {},
                 'preferences': {
                     'favorite_genres': [],
                     'disliked_genres': []
                 }
             }
+        else:
+            # Временные данные теперь живут в sessions и не сохраняются на диск
+            for key in SESSION_KEYS:
+                user_data[str(user_id)].pop(key, None)
         if '_user_stats' not in user_data:
             user_data['_user_stats'] = {}
         if str(user_id) not in user_data['_user_stats']:
@@ -666,9 +694,7 @@ class StableMusicBot:
         """Проверяет размер файла до скачивания"""
         try:
             with yt_dlp.YoutubeDL(FAST_INFO_OPTS) as ydl:
-                info = await asyncio.get_event_loop().run_in_executor(
-                    None, lambda: ydl.extract_info(url, download=False)
-                )
+                info = await metadata_executor.run(lambda: ydl.extract_info(url, download=False))
 
                 file_size = 0
                 if info and 'filesize' in info and info['filesize']:
@@ -733,7 +759,6 @@ class StableMusicBot:
         if not url:
             return False
 
-        loop = asyncio.get_event_loop()
         tmpdir = tempfile.mkdtemp()
         
         try:
@@ -755,7 +780,7 @@ class StableMusicBot:
                     return None
 
             info = await asyncio.wait_for(
-                loop.run_in_executor(None, download_track),
+                download_executor.run(download_track),
                 timeout=DOWNLOAD_TIMEOUT - 30
             )
 
@@ -859,7 +884,7 @@ class StableMusicBot:
     async def download_from_recommendations(self, update: Update, context: ContextTypes.DEFAULT_TYPE, index: int):
         """Скачивание трека из рекомендаций с возвратом к списку"""
         user = update.effective_user
-        recommendations = user_data[str(user.id)].get('current_recommendations', [])
+        recommendations = sessions.get(user.id).get('current_recommendations', [])
 
         if index < 0 or index >= len(recommendations):
             await update.callback_query.edit_message_text('❌ Трек не найден')
@@ -871,8 +896,9 @@ class StableMusicBot:
     async def download_from_charts(self, update: Update, context: ContextTypes.DEFAULT_TYPE, index: int):
         """Скачивание трека из чартов с возвратом к списку"""
         user = update.effective_user
-        charts = user_data[str(user.id)].get('current_charts', [])
-        current_page = user_data[str(user.id)].get('charts_page', 0)
+        session = sessions.get(user.id)
+        charts = session.get('current_charts', [])
+        current_page = session.get('charts_page', 0)
 
         if index < 0 or index >= len(charts):
             await update.callback_query.edit_message_text('❌ Трек не найден')
@@ -884,9 +910,9 @@ class StableMusicBot:
     async def download_from_playlist(self, update: Update, context: ContextTypes.DEFAULT_TYPE, index: int):
         """Скачивание трека из плейлиста с возвратом к списку"""
         user = update.effective_user
-        playlist = user_data[str(user.id)].get('current_playlist', {})
+        playlist = sessions.get(user.id).get('current_playlist', {})
         tracks = playlist.get('tracks', [])
-        current_page = user_data[str(user.id)].get('playlist_page', 0)
+        current_page = sessions.get(user.id).get('playlist_page', 0)
 
         if index < 0 or index >= len(tracks):
             await update.callback_query.edit_message_text('❌ Трек не найден')
@@ -905,13 +931,13 @@ class StableMusicBot:
         if success:
             stats = user_data.get('_user_stats', {}).get(str(user.id), {})
             stats['downloads'] = stats.get('downloads', 0) + 1
-            save_data()
+            save_data(user.id)
 
             user_entry = user_data[str(user.id)]
             download_history = user_entry.get('download_history', [])
             download_history.append(track)
             user_entry['download_history'] = download_history[-50:]
-            save_data()
+            save_data(user.id)
 
             # Возвращаемся к исходному списку
             if source == 'recommendations':
@@ -1020,10 +1046,10 @@ class StableMusicBot:
                 )
                 return
 
-            user_data[str(user.id)]['current_recommendations'] = recommendations
-            user_data[str(user.id)]['recommendations_page'] = 0
-            user_data[str(user.id)]['recommendations_total_pages'] = (len(recommendations) + RESULTS_PER_PAGE - 1) // RESULTS_PER_PAGE
-            save_data()
+            session = sessions.get(user.id)
+            session['current_recommendations'] = recommendations
+            session['recommendations_page'] = 0
+            session['recommendations_total_pages'] = (len(recommendations) + RESULTS_PER_PAGE - 1) // RESULTS_PER_PAGE
 
             await self.show_recommendations_page(update, context, 0, status_msg)
 
@@ -1042,8 +1068,9 @@ class StableMusicBot:
         user = update.effective_user
         self.ensure_user(user.id)
 
-        recommendations = user_data[str(user.id)].get('current_recommendations', [])
-        total_pages = user_data[str(user.id)].get('recommendations_total_pages', 0)
+        session = sessions.get(user.id)
+        recommendations = session.get('current_recommendations', [])
+        total_pages = session.get('recommendations_total_pages', 0)
 
         if page < 0 or page >= max(1, total_pages):
             page = 0
@@ -1105,8 +1132,7 @@ class StableMusicBot:
         except Exception as e:
             logger.warning(f'Ошибка отображения страницы рекомендаций: {e}')
 
-        user_data[str(user.id)]['recommendations_page'] = page
-        save_data()
+        sessions.get(user.id)['recommendations_page'] = page
 
     # ==================== ЧАРТЫ ====================
 
@@ -1163,10 +1189,10 @@ class StableMusicBot:
             random.shuffle(all_tracks)
             top_tracks = all_tracks[:20]
 
-            user_data[str(user.id)]['current_charts'] = top_tracks
-            user_data[str(user.id)]['charts_page'] = 0
-            user_data[str(user.id)]['charts_total_pages'] = (len(top_tracks) + RESULTS_PER_PAGE - 1) // RESULTS_PER_PAGE
-            save_data()
+            session = sessions.get(user.id)
+            session['current_charts'] = top_tracks
+            session['charts_page'] = 0
+            session['charts_total_pages'] = (len(top_tracks) + RESULTS_PER_PAGE - 1) // RESULTS_PER_PAGE
 
             await self.show_charts_page(update, context, 0, status_msg)
 
@@ -1179,8 +1205,9 @@ class StableMusicBot:
         user = update.effective_user
         self.ensure_user(user.id)
 
-        charts = user_data[str(user.id)].get('current_charts', [])
-        total_pages = user_data[str(user.id)].get('charts_total_pages', 0)
+        session = sessions.get(user.id)
+        charts = session.get('current_charts', [])
+        total_pages = session.get('charts_total_pages', 0)
 
         if page < 0 or page >= max(1, total_pages):
             page = 0
@@ -1233,8 +1260,7 @@ class StableMusicBot:
         except Exception as e:
             logger.warning(f'Ошибка отображения страницы чартов: {e}')
 
-        user_data[str(user.id)]['charts_page'] = page
-        save_data()
+        sessions.get(user.id)['charts_page'] = page
 
     # ==================== НАСТРОЕНИЕ (бывшие плейлисты) ====================
 
@@ -1291,14 +1317,14 @@ class StableMusicBot:
             random.shuffle(all_tracks)
             playlist_tracks = all_tracks[:20]
 
-            user_data[str(user.id)]['current_playlist'] = {
+            session = sessions.get(user.id)
+            session['current_playlist'] = {
                 'tracks': playlist_tracks,
                 'name': playlist['name'],
                 'description': playlist['description']
             }
-            user_data[str(user.id)]['playlist_page'] = 0
-            user_data[str(user.id)]['playlist_total_pages'] = (len(playlist_tracks) + RESULTS_PER_PAGE - 1) // RESULTS_PER_PAGE
-            save_data()
+            session['playlist_page'] = 0
+            session['playlist_total_pages'] = (len(playlist_tracks) + RESULTS_PER_PAGE - 1) // RESULTS_PER_PAGE
 
             await self.show_playlist_page(update, context, 0, status_msg)
 
@@ -1311,12 +1337,12 @@ class StableMusicBot:
         user = update.effective_user
         self.ensure_user(user.id)
 
-        playlist_data = user_data[str(user.id)].get('current_playlist', {})
+        playlist_data = sessions.get(user.id).get('current_playlist', {})
         tracks = playlist_data.get('tracks', [])
         playlist_name = playlist_data.get('name', 'Плейлист')
         playlist_description = playlist_data.get('description', '')
 
-        total_pages = user_data[str(user.id)].get('playlist_total_pages', 0)
+        total_pages = sessions.get(user.id).get('playlist_total_pages', 0)
 
         if page < 0 or page >= max(1, total_pages):
             page = 0
@@ -1369,8 +1395,7 @@ class StableMusicBot:
         except Exception as e:
             logger.warning(f'Ошибка отображения страницы плейлиста: {e}')
 
-        user_data[str(user.id)]['playlist_page'] = page
-        save_data()
+        sessions.get(user.id)['playlist_page'] = page
 
     # ==================== ОСНОВНЫЕ КОМАНДЫ ====================
 
@@ -1407,7 +1432,7 @@ class StableMusicBot:
                 reply_markup=InlineKeyboardMarkup(keyboard),
                 parse_mode='HTML'
             )
-        save_data()
+        save_data(user.id)
 
     async def search_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /search"""
@@ -1475,13 +1500,13 @@ class StableMusicBot:
                 stats = user_data.get('_user_stats', {}).get(str(user.id), {})
                 stats['downloads'] = stats.get('downloads', 0) + 1
                 stats['searches'] = stats.get('searches', 0) + 1
-                save_data()
+                save_data(user.id)
 
                 user_entry = user_data[str(user.id)]
                 download_history = user_entry.get('download_history', [])
                 download_history.append(random_track)
                 user_entry['download_history'] = download_history[-50:]
-                save_data()
+                save_data(user.id)
 
                 keyboard = [
                     [InlineKeyboardButton('🎲 Еще случайный трек', callback_data='random_track')],
@@ -1582,7 +1607,6 @@ class StableMusicBot:
         if not url:
             return False
 
-        loop = asyncio.get_event_loop()
         tmpdir = tempfile.mkdtemp()
         
         try:
@@ -1598,7 +1622,7 @@ class StableMusicBot:
                     return None
 
             info = await asyncio.wait_for(
-                loop.run_in_executor(None, download_track),
+                download_executor.run(download_track),
                 timeout=DOWNLOAD_TIMEOUT - 30
             )
 
@@ -1798,9 +1822,8 @@ class StableMusicBot:
                     with yt_dlp.YoutubeDL(ydl_opts) as ydl:
                         return ydl.extract_info(f"scsearch10:{query}", download=False)
 
-                loop = asyncio.get_event_loop()
                 info = await asyncio.wait_for(
-                    loop.run_in_executor(None, perform_search),
+                    search_executor.run(perform_search),
                     timeout=SEARCH_TIMEOUT
                 )
 
@@ -1879,10 +1902,10 @@ class StableMusicBot:
         return filtered
 
     async def show_results_page(self, update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, page: int):
-        user_entry = user_data.get(str(user_id), {})
-        results = user_entry.get('search_results', [])
-        total_pages = user_entry.get('total_pages', 0)
-        query = user_entry.get('search_query', '')
+        session = sessions.get(user_id)
+        results = session.get('search_results', [])
+        total_pages = session.get('total_pages', 0)
+        query = session.get('search_query', '')
         filters = user_data.get(str(user_id), {}).get('filters', {})
 
         if page < 0 or page >= max(1, total_pages):
@@ -1933,8 +1956,7 @@ class StableMusicBot:
         except Exception as e:
             logger.warning(f'Ошибка отображения страницы результатов: {e}')
 
-        user_data[str(user_id)]['current_page'] = page
-        save_data()
+        sessions.get(user_id)['current_page'] = page
 
     async def handle_text(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         text = (update.message.text or '').strip()
@@ -1988,11 +2010,12 @@ class StableMusicBot:
                 )
                 return
 
-            user_entry['search_results'] = filtered
-            user_entry['search_query'] = query_text
-            user_entry['current_page'] = 0
-            user_entry['total_pages'] = (len(filtered) + RESULTS_PER_PAGE - 1) // RESULTS_PER_PAGE
-            save_data()
+            session = sessions.get(user.id)
+            session['search_results'] = filtered
+            session['search_query'] = query_text
+            session['current_page'] = 0
+            session['total_pages'] = (len(filtered) + RESULTS_PER_PAGE - 1) // RESULTS_PER_PAGE
+            save_data(user.id)
 
             await self.send_smart_notification(
                 update, context, 'search_results',
@@ -2092,7 +2115,7 @@ class StableMusicBot:
         self.ensure_user(user.id)
 
         user_data[str(user.id)]['filters']['duration'] = key
-        save_data()
+        save_data(user.id)
 
         filter_name = DURATION_FILTERS.get(key, 'Без фильтра')
         await update.callback_query.answer(f'Фильтр установлен: {filter_name}')
@@ -2104,7 +2127,7 @@ class StableMusicBot:
 
         current = user_data[str(user.id)]['filters'].get('music_only', False)
         user_data[str(user.id)]['filters']['music_only'] = not current
-        save_data()
+        save_data(user.id)
 
         status = "ВКЛЮЧЕН" if not current else "ВЫКЛЮЧЕН"
         await update.callback_query.answer(f'Фильтр "Только музыка" {status}')
@@ -2116,8 +2139,7 @@ class StableMusicBot:
         query = update.callback_query
         user = update.effective_user
 
-        user_entry = user_data.get(str(user.id), {})
-        results = user_entry.get('search_results', [])
+        results = sessions.get(user.id).get('search_results', [])
         if index < 0 or index >= len(results):
             await query.edit_message_text('❌ Трек не найден')
             return
@@ -2133,13 +2155,13 @@ class StableMusicBot:
         if success:
             stats = user_data.get('_user_stats', {}).get(str(user.id), {})
             stats['downloads'] = stats.get('downloads', 0) + 1
-            save_data()
+            save_data(user.id)
 
             user_entry = user_data[str(user.id)]
             download_history = user_entry.get('download_history', [])
             download_history.append(track)
             user_entry['download_history'] = download_history[-50:]
-            save_data()
+            save_data(user.id)
 
             # ВОЗВРАЩАЕМСЯ К ТОЙ ЖЕ СТРАНИЦЕ РЕЗУЛЬТАТОВ
             await self.show_results_page(update, context, user.id, return_page)
@@ -2153,6 +2175,7 @@ class StableMusicBot:
 
         app = Application.builder().token(BOT_TOKEN).build()
 
+        app.add_handler(TypeHandler(Update, preload_user_data), group=-1)
         app.add_handler(CommandHandler('start', self.start))
         app.add_handler(CommandHandler('search', self.search_command))
         app.add_handler(CommandHandler('random', self.random_track))
@@ -2177,7 +2200,10 @@ class StableMusicBot:
         app.post_init = set_commands
 
         print('✅ Бот запущен и готов к работе!')
-        app.run_polling()
+        try:
+            app.run_polling()
+        finally:
+            flush_data()
 
 if __name__ == '__main__':
     bot = StableMusicBot()
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+import re
+import unicodedata
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Iterable
+
+# Слова-паразиты из запросов вида "найди мне трек ..." (как в extract_search_query)
+STOP_WORDS = frozenset({
+    'найди', 'найти', 'пожалуйста', 'мне', 'трек', 'песню', 'музыку', 'плз', 'plz',
+})
+
+CYRILLIC_TO_LATIN = {
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'e',
+    'ж': 'zh', 'з': 'z', 'и': 'i', 'й': 'i', 'к': 'k', 'л': 'l', 'м': 'm',
+    'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r', 'с': 's', 'т': 't', 'у': 'u',
+    'ф': 'f', 'х': 'h', 'ц': 'c', 'ч': 'ch', 'ш': 'sh', 'щ': 'sch', 'ъ': '',
+    'ы': 'y', 'ь': '', 'э': 'e', 'ю': 'yu', 'я': 'ya',
+    'і': 'i', 'ї': 'i', 'є': 'e', 'ґ': 'g',
+}
+_TRANSLIT_TABLE = str.maketrans(CYRILLIC_TO_LATIN)
+_PUNCTUATION_RE = re.compile(r"[^\w\s]+|_")
+# "&" - союз, а не пунктуация: "R&B" и "drum & bass" не должны терять его
+_AMPERSAND_RE = re.compile(r"\s*&\s*")
+
+# Разные написания одного жанра (уже без пунктуации и транслитерированные) -> одно.
+# Склеиваются только эти фразы: общий ''.join путал "a bc" и "ab c"
+QUERY_ALIASES = {
+    'lo fi': 'lofi',
+    'hip hop': 'hiphop',
+    'drum and bass': 'dnb',
+    'drum bass': 'dnb',
+    'drum n bass': 'dnb',
+    'd n b': 'dnb',
+    'r n b': 'rnb',
+    'r and b': 'rnb',
+    'k pop': 'kpop',
+    'synth pop': 'synthpop',
+    'chill out': 'chillout',
+}
+_ALIAS_RE = re.compile(
+    r'\b(' + '|'.join(re.escape(alias) for alias in sorted(QUERY_ALIASES, key=len, reverse=True)) + r')\b'
+)
+
+
+@lru_cache(maxsize=4096)
+def normalize_query(query: str) -> str:
+    """Канонический ключ кэша для поискового запроса.
+
+    "Lo Fi Beats", "lo-fi  beats " и "lofi beats" дают один и тот же ключ:
+    регистр, пунктуация и лишние пробелы не учитываются, кириллица
+    транслитерируется, стоп-слова отбрасываются, "&" читается как "and",
+    написания из QUERY_ALIASES сводятся к одному. Границы слов сохраняются
+    одним пробелом, поэтому "a bc" и "ab c" остаются разными ключами.
+
+    "R&B", "r&b" и "RnB" -> "rnb"; "Drum & Bass" и "drum and bass" -> "dnb"."""
+    text = unicodedata.normalize('NFKC', query or '').casefold()
+    text = _AMPERSAND_RE.sub(' and ', text)
+    text = _PUNCTUATION_RE.sub(' ', text)
+    words = [word for word in text.split() if word not in STOP_WORDS]
+    if not words:
+        words = text.split()
+    key = ' '.join(words).translate(_TRANSLIT_TABLE)
+    return _ALIAS_RE.sub(lambda match: QUERY_ALIASES[match.group(1)], key)
+
+
+class QueryNormalizationStats:
+    """Считает, сколько попаданий в кэш дала нормализация запросов.
+
+    Попадание засчитывается нормализации, только если запись кэша заполнил
+    другой сырой запрос (record_fill): без нормализации это был бы промах.
+    Если заполнивший запрос неизвестен (запись из Redis или с диска), попадание
+    нормализации не засчитывается.
+    Счетчики по ключам копятся для сохранения (take_pending) и
+    восстанавливаются после рестарта (restore)."""
+
+    def __init__(self, max_tracked: int = 10000):
+        self.max_tracked = max_tracked
+        self._seen_raw = OrderedDict()
+        self._seen_keys = OrderedDict()
+        # ключ кэша -> сырой запрос, результатами которого заполнена запись
+        self._fillers = OrderedDict()
+        self._pending = {}
+        self.lookups = 0
+        self.hits = 0
+        self.hits_from_normalization = 0
+
+    def record(self, raw_query: str, key: str, hit: bool):
+        self.lookups += 1
+        self._remember(self._seen_raw, raw_query)
+        self._count_key(key, raw_query)
+        if hit:
+            self.hits += 1
+            filler = self._fillers.get(key)
+            if filler is not None and filler != raw_query:
+                self.hits_from_normalization += 1
+
+    def record_fill(self, raw_query: str, key: str):
+        """Запоминает сырой запрос, по которому заполнена запись кэша key"""
+        self._remember(self._fillers, key, raw_query)
+
+    def _remember(self, seen: OrderedDict, key: str, value=None):
+        seen[key] = value
+        seen.move_to_end(key)
+        if len(seen) > self.max_tracked:
+            seen.popitem(last=False)
+
+    def _count_key(self, key: str, raw_query: str):
+        """Считает обращения к ключу и запоминает последний сырой запрос для него"""
+        count = self._seen_keys.pop(key, (0, None))[0]
+        self._seen_keys[key] = (count + 1, raw_query)
+        if len(self._seen_keys) > self.max_tracked:
+            self._seen_keys.popitem(last=False)
+        pending = self._pending.get(key, (0, None))[0]
+        self._pending[key] = (pending + 1, raw_query)
+
+    def take_pending(self) -> dict:
+        """Забирает счетчики, накопленные с прошлого сохранения: {ключ: (сколько, сырой запрос)}"""
+        pending, self._pending = self._pending, {}
+        return pending
+
+    def restore(self, rows: Iterable):
+        """Добавляет сохраненные счетчики [(ключ, счетчик, сырой запрос)]"""
+        for key, count, raw_query in rows:
+            current, last_raw = self._seen_keys.get(key, (0, None))
+            self._seen_keys[key] = (current + count, last_raw or raw_query)
+            # Восстановленные ключи вытесняются первыми, если не встретятся снова
+            self._seen_keys.move_to_end(key, last=False)
+        while len(self._seen_keys) > self.max_tracked:
+            self._seen_keys.popitem(last=False)
+
+    def count(self, key: str) -> int:
+        return self._seen_keys.get(key, (0, None))[0]
+
+    def top_queries(self, limit: int = 20) -> list:
+        """Самые частые запросы (по одному сырому тексту на ключ)"""
+        top = sorted(self._seen_keys.values(), key=lambda item: item[0], reverse=True)
+        return [raw for _, raw in top[:limit]]
+
+    def stats(self) -> dict:
+        return {
+            'lookups': self.lookups,
+            'hits': self.hits,
+            'hits_from_normalization': self.hits_from_normalization,
+            'hit_rate': round(self.hits / self.lookups, 3) if self.lookups else 0.0,
+            'hit_rate_without_normalization': round(
+                (self.hits - self.hits_from_normalization) / self.lookups, 3
+            ) if self.lookups else 0.0,
+            'distinct_raw_queries': len(self._seen_raw),
+            'distinct_keys': len(self._seen_keys),
+        }
@@ -1,17 +1,142 @@
 import redis.asyncio as redis
+import asyncio
 import json
 import os
+import time
 from typing import Optional, Any
 
+
+class InMemoryRedis:
+    """Минимальная замена redis.asyncio.Redis в памяти процесса.
+
+    Поддерживает только команды, которые использует RedisClient (get, set,
+    setex, incr, expire, delete, ping, pipeline), с истечением ключей.
+    Включается REDIS_URL=memory:// - для бенчмарка и локальной проверки
+    TwoTierCache без сервера Redis; между процессами данные не общие."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self._data = {}
+        self._expires = {}
+
+    async def _roundtrip(self):
+        # Имитация сетевой задержки до Redis
+        await asyncio.sleep(self.latency)
+
+    def _alive(self, key: str) -> bool:
+        expires_at = self._expires.get(key)
+        if expires_at is not None and expires_at <= time.monotonic():
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+        return key in self._data
+
+    def _get(self, key: str):
+        return self._data[key] if self._alive(key) else None
+
+    def _set(self, key: str, value, ex: int = None):
+        self._data[key] = str(value)
+        if ex:
+            self._expires[key] = time.monotonic() + ex
+        else:
+            self._expires.pop(key, None)
+        return True
+
+    def _incr(self, key: str) -> int:
+        value = int(self._get(key) or 0) + 1
+        self._data[key] = str(value)
+        return value
+
+    def _expire(self, key: str, seconds: int) -> bool:
+        if not self._alive(key):
+            return False
+        self._expires[key] = time.monotonic() + seconds
+        return True
+
+    def _delete(self, *keys) -> int:
+        removed = 0
+        for key in keys:
+            if self._alive(key):
+                removed += 1
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+        return removed
+
+    async def ping(self) -> bool:
+        await self._roundtrip()
+        return True
+
+    async def get(self, key: str):
+        await self._roundtrip()
+        return self._get(key)
+
+    async def set(self, key: str, value, ex: int = None):
+        await self._roundtrip()
+        return self._set(key, value, ex)
+
+    async def setex(self, key: str, seconds: int, value):
+        await self._roundtrip()
+        return self._set(key, value, seconds)
+
+    async def incr(self, key: str) -> int:
+        await self._roundtrip()
+        return self._incr(key)
+
+    async def expire(self, key: str, seconds: int) -> bool:
+        await self._roundtrip()
+        return self._expire(key, seconds)
+
+    async def delete(self, *keys) -> int:
+        await self._roundtrip()
+        return self._delete(*keys)
+
+    def pipeline(self):
+        return _InMemoryPipeline(self)
+
+
+class _InMemoryPipeline:
+    """Копит команды и выполняет их за один "запрос", как pipeline redis-py"""
+
+    def __init__(self, redis_stub: InMemoryRedis):
+        self._redis = redis_stub
+        self._commands = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._commands.clear()
+
+    def __getattr__(self, name: str):
+        command = getattr(self._redis, f'_{name}')
+
+        def queue(*args, **kwargs):
+            self._commands.append((command, args, kwargs))
+            return self
+        return queue
+
+    async def execute(self) -> list:
+        await self._redis._roundtrip()
+        commands, self._commands = self._commands, []
+        return [command(*args, **kwargs) for command, args, kwargs in commands]
+
+
 class RedisClient:
-    def __init__(self):
+    def __init__(self, client: Optional[redis.Redis] = None):
+        """client - готовый клиент (например fakeredis.aioredis.FakeRedis в тестах)"""
         self.redis_url = os.environ.get('REDIS_URL', 'redis://localhost:6379')
-        self.redis: Optional[redis.Redis] = None
+        self.redis: Optional[redis.Redis] = client
+    
+    @property
+    def enabled(self) -> bool:
+        return self.redis is not None
         
     async def connect(self):
         """Подключается к Redis"""
         try:
-            self.redis = redis.from_url(self.redis_url, decode_responses=True)
+            if self.redis_url.startswith('memory://'):
+                self.redis = InMemoryRedis()
+            else:
+                self.redis = redis.from_url(self.redis_url, decode_responses=True)
             await self.redis.ping()
             print("✅ Redis подключен")
         except Exception as e:
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+import re
+import asyncio
+import hashlib
+import random
+from abc import ABC, abstractmethod
+from typing import Optional
+
+from executors import search_executor
+from ydl_pool import ydl_pool
+
+SEARCH_OPTS = {
+    'format': 'bestaudio/best',
+    'quiet': True,
+    'no_warnings': True,
+    'extract_flat': True,
+    'ignoreerrors': True,
+    'noplaylist': True,
+    'socket_timeout': 12,
+}
+
+_SEARCH_QUERY_RE = re.compile(r'^scsearch(\d*):(.*)$', re.DOTALL)
+
+
+class SearchBackend(ABC):
+    """Источник результатов поиска SoundCloud.
+
+    search принимает запрос yt-dlp вида "scsearchN:текст" и возвращает
+    словарь в формате extract_info ({'entries': [...]}) или None."""
+
+    name = 'base'
+
+    @abstractmethod
+    async def search(self, search_query: str) -> Optional[dict]:
+        ...
+
+
+class YtDlpSearchBackend(SearchBackend):
+    """Настоящий поиск через yt-dlp в пуле потоков поиска на переиспользуемых экземплярах YoutubeDL"""
+
+    name = 'ytdlp'
+
+    def __init__(self, ydl_opts: dict = None):
+        self.ydl_opts = dict(ydl_opts or SEARCH_OPTS)
+
+    async def search(self, search_query: str) -> Optional[dict]:
+        return await search_executor.run(ydl_pool.extract_info, self.ydl_opts, search_query)
+
+
+class FakeSearchBackend(SearchBackend):
+    """Детерминированный локальный SoundCloud для тестов и бенчмарков без сети.
+
+    Результаты зависят только от текста запроса и seed, задержки и ошибки -
+    от seed и порядка вызовов, поэтому прогоны воспроизводимы.
+    latency/jitter в секундах, error_rate - доля запросов, падающих с исключением."""
+
+    name = 'fake'
+
+    def __init__(self, latency: float = 0.05, jitter: float = 0.0, error_rate: float = 0.0,
+                 seed: int = 0, default_count: int = 10):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.seed = seed
+        self.default_count = default_count
+        self.calls = 0
+        self.errors = 0
+        self._faults = random.Random(seed)
+
+    def _rng(self, search_query: str) -> random.Random:
+        digest = hashlib.sha256(f"{self.seed}:{search_query}".encode('utf-8')).digest()
+        return random.Random(int.from_bytes(digest[:8], 'big'))
+
+    async def search(self, search_query: str) -> Optional[dict]:
+        self.calls += 1
+        match = _SEARCH_QUERY_RE.match(search_query)
+        count, text = (int(match.group(1) or 1), match.group(2)) if match else (self.default_count, search_query)
+        delay = self.latency + self._faults.uniform(0, self.jitter)
+        fail = self._faults.random() < self.error_rate
+
+        await asyncio.sleep(delay)
+        if fail:
+            self.errors += 1
+            raise RuntimeError(f"Fake SoundCloud error for '{search_query}'")
+
+        rng = self._rng(search_query)
+        return {'_type': 'playlist', 'entries': [self._entry(text, i, rng) for i in range(count)]}
+
+    @staticmethod
+    def _entry(text: str, index: int, rng: random.Random) -> dict:
+        slug = re.sub(r'\W+', '-', text.strip().lower()).strip('-') or 'track'
+        artist = f"fake artist {rng.randint(1, 50)}"
+        return {
+            'id': f"{slug}-{index}",
+            'title': f"{text.strip()} part {index + 1}",
+            'webpage_url': f"https://soundcloud.com/{artist.replace(' ', '-')}/{slug}-{index}",
+            'url': f"https://soundcloud.com/{artist.replace(' ', '-')}/{slug}-{index}",
+            'duration': rng.randint(90, 900),
+            'uploader': artist,
+            'thumbnail': None,
+        }
+
+
+def create_search_backend(name: str = 'ytdlp', ydl_opts: dict = None, **fake_options) -> SearchBackend:
+    """ytdlp - настоящий SoundCloud, fake - локальная имитация (SEARCH_BACKEND=fake)"""
+    if name == 'fake':
+        return FakeSearchBackend(**fake_options)
+    return YtDlpSearchBackend(ydl_opts)
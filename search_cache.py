@@ -0,0 +1,347 @@
+# -*- coding: utf-8 -*-
+import json
+import time
+import asyncio
+import sqlite3
+import logging
+import threading
+from pathlib import Path
+from collections import OrderedDict
+from typing import Any, Optional, Callable, Awaitable
+
+from executors import disk_executor
+
+logger = logging.getLogger(__name__)
+
+DISK_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS search_cache (
+    key TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_search_cache_expires_at ON search_cache (expires_at);
+CREATE TABLE IF NOT EXISTS query_counts (
+    key TEXT PRIMARY KEY,
+    query TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    last_seen REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_query_counts_count ON query_counts (count);
+"""
+
+
+class SearchCache:
+    """LRU-кэш результатов поиска с TTL и ограничением по объему в байтах.
+
+    get/set/вытеснение работают за O(1): порядок OrderedDict совпадает
+    с порядком последнего обращения, самые старые записи лежат в начале."""
+
+    def __init__(self, max_bytes: int = 32 * 1024 * 1024, ttl: float = 600):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        data, expires_at, _ = entry
+        if time.monotonic() >= expires_at:
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return data
+
+    def set(self, key: str, data: Any, ttl: float = None):
+        size = self._sizeof(data)
+        if size > self.max_bytes:
+            return
+
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (data, time.monotonic() + (ttl or self.ttl), size)
+        self.current_bytes += size
+
+        while self.current_bytes > self.max_bytes:
+            _, (_, _, old_size) = self._entries.popitem(last=False)
+            self.current_bytes -= old_size
+            self.evictions += 1
+
+    def _remove(self, key: str):
+        _, _, size = self._entries.pop(key)
+        self.current_bytes -= size
+
+    @staticmethod
+    def _sizeof(data: Any) -> int:
+        """Размер записи в байтах по ее JSON-представлению"""
+        try:
+            return len(json.dumps(data, ensure_ascii=False).encode('utf-8'))
+        except (TypeError, ValueError):
+            return len(str(data).encode('utf-8'))
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'bytes': self.current_bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key: str):
+        return key in self._entries
+
+
+class DiskSearchCache:
+    """Результаты поиска в SQLite: переживают перезапуск и редеплой бота.
+
+    Записи читаются по одной при промахе кэша в памяти, целиком файл не загружается.
+    Время жизни считается по часам системы, поэтому не сбрасывается при рестарте."""
+
+    def __init__(self, db_file: Path, ttl: float = 6 * 3600, purge_every: int = 500):
+        self.db_file = Path(db_file)
+        self.ttl = ttl
+        self.purge_every = purge_every
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.db_file), check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(DISK_CACHE_SCHEMA)
+
+    def get(self, key: str) -> Optional[tuple]:
+        """Возвращает (данные, оставшееся время жизни) или None"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data, expires_at FROM search_cache WHERE key = ?", (key,)
+            ).fetchone()
+
+        remaining = row[1] - time.time() if row else 0
+        if remaining <= 0:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return json.loads(row[0]), remaining
+
+    def set(self, key: str, data: Any, ttl: float = None):
+        payload = json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO search_cache (key, data, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET data = excluded.data, expires_at = excluded.expires_at",
+                (key, payload, time.time() + (ttl or self.ttl))
+            )
+            self._writes += 1
+            if self._writes % self.purge_every == 0:
+                self._conn.execute("DELETE FROM search_cache WHERE expires_at <= ?", (time.time(),))
+
+    def add_query_counts(self, counts: dict):
+        """Прибавляет счетчики запросов {ключ: (сколько раз, последний сырой запрос)}"""
+        if not counts:
+            return
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO query_counts (key, query, count, last_seen) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET query = excluded.query, "
+                "count = count + excluded.count, last_seen = excluded.last_seen",
+                [(key, query, count, now) for key, (count, query) in counts.items()]
+            )
+
+    def top_queries(self, limit: int = 100) -> list:
+        """Самые частые запросы за все время: [(ключ, счетчик, сырой запрос)]"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT key, count, query FROM query_counts ORDER BY count DESC LIMIT ?", (limit,)
+            ).fetchall()
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM search_cache").fetchone()[0]
+        return {
+            'entries': entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'file_bytes': self.db_file.stat().st_size if self.db_file.exists() else 0,
+        }
+
+
+class TwoTierCache:
+    """Двухуровневый кэш поиска: L1 - SearchCache процесса, L2 - Redis, общий для реплик.
+
+    Промах L1 проверяется на диске (если задан disk), затем в Redis;
+    найденное копируется в L1. Без Redis и диска работает как обычный SearchCache."""
+
+    def __init__(self, local: SearchCache, redis_client=None, prefix: str = 'search:',
+                 disk: DiskSearchCache = None):
+        self.local = local
+        self.redis_client = redis_client
+        self.prefix = prefix
+        self.disk = disk
+        self.l2_hits = 0
+        self.l2_misses = 0
+
+    @property
+    def l2_enabled(self) -> bool:
+        return bool(self.redis_client and self.redis_client.enabled)
+
+    async def get(self, key: str) -> Optional[Any]:
+        data = self.local.get(key)
+        if data:
+            return data
+
+        if self.disk is not None:
+            try:
+                found = await disk_executor.run(self.disk.get, key)
+            except Exception as e:
+                logger.warning(f"Ошибка чтения кэша поиска с диска: {e}")
+                found = None
+            if found:
+                data, remaining = found
+                self.local.set(key, data, min(remaining, self.local.ttl))
+                return data
+
+        if not self.l2_enabled:
+            return None
+
+        data = await self.redis_client.cache_get(self.prefix + key)
+        if data:
+            self.l2_hits += 1
+            self.local.set(key, data)
+        else:
+            self.l2_misses += 1
+        return data
+
+    async def set(self, key: str, data: Any, ttl: float = None):
+        self.local.set(key, data, ttl)
+        if self.disk is not None:
+            try:
+                await disk_executor.run(self.disk.set, key, data)
+            except Exception as e:
+                logger.warning(f"Ошибка записи кэша поиска на диск: {e}")
+        if self.l2_enabled:
+            await self.redis_client.cache_set(self.prefix + key, data, expire=int(ttl or self.local.ttl))
+
+    def stats(self) -> dict:
+        return {
+            'disk': self.disk.stats() if self.disk is not None else None,
+            'l2_enabled': self.l2_enabled,
+            'l2_hits': self.l2_hits,
+            'l2_misses': self.l2_misses,
+        }
+
+
+class SingleFlight:
+    """Объединяет одновременные одинаковые запросы.
+
+    Для ключа выполняется только один вызов, остальные вызывающие
+    ждут его результат (или получают то же исключение). Если отменили
+    того, кто выполнял вызов, ожидающие не получают его CancelledError:
+    первый из них запускает вызов заново, остальные ждут уже его."""
+
+    def __init__(self):
+        self._inflight = {}
+        self.calls = 0
+        self.shared = 0
+        self.restarted = 0
+
+    async def run(self, key: str, func: Callable[[], Awaitable[Any]]) -> Any:
+        future = self._inflight.get(key)
+        while future is not None:
+            self.shared += 1
+            try:
+                # shield: отмена одного ожидающего не должна отменять общий поиск
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    # Отменили самого ожидающего
+                    raise
+            self.restarted += 1
+            future = self._inflight.get(key)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        self.calls += 1
+        try:
+            result = await func()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Помечаем исключение полученным, если других ожидающих нет
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            self._inflight.pop(key, None)
+
+    def stats(self) -> dict:
+        return {
+            'in_flight': len(self._inflight),
+            'calls': self.calls,
+            'shared': self.shared,
+            'restarted': self.restarted,
+        }
+
+
+class BackgroundRefresher:
+    """Обновление устаревших данных в фоне (stale-while-revalidate).
+
+    Пока задача для ключа выполняется, повторные trigger возвращают ее же,
+    так что одно устаревшее значение обновляется только один раз."""
+
+    def __init__(self):
+        self._tasks = {}
+        self.started = 0
+        self.failed = 0
+
+    def trigger(self, key, func: Callable[[], Awaitable[Any]]) -> asyncio.Task:
+        task = self._tasks.get(key)
+        if task is not None and not task.done():
+            return task
+
+        task = asyncio.get_running_loop().create_task(func())
+        self._tasks[key] = task
+        self.started += 1
+        task.add_done_callback(lambda done: self._finish(key, done))
+        return task
+
+    def _finish(self, key, task: asyncio.Task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            self.failed += 1
+            logger.warning(f"Ошибка фонового обновления {key}: {task.exception()}")
+
+    def stats(self) -> dict:
+        return {
+            'in_flight': len(self._tasks),
+            'started': self.started,
+            'failed': self.failed,
+        }
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+import time
+from collections import OrderedDict
+
+# Временные поля, которые раньше хранились в user_data и сохранялись на диск
+SESSION_KEYS = (
+    'search_results', 'search_query', 'current_page', 'total_pages',
+    'current_recommendations', 'recommendations_page', 'recommendations_total_pages',
+    'current_charts', 'charts_page', 'charts_total_pages',
+    'current_playlist', 'playlist_page', 'playlist_total_pages',
+    'random_track_result',
+)
+
+
+class SessionStore:
+    """Временное состояние пользователей (результаты поиска, страницы) в памяти.
+
+    На диск не сохраняется; сессии, к которым не обращались дольше ttl
+    секунд, вытесняются при следующих обращениях к хранилищу."""
+
+    def __init__(self, ttl: float = 3600, max_sessions: int = 10000):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()
+
+    def get(self, user_id) -> dict:
+        """Возвращает сессию пользователя, создавая пустую при необходимости"""
+        key = str(user_id)
+        now = time.monotonic()
+        entry = self._sessions.pop(key, None)
+        session = entry[0] if entry and now - entry[1] < self.ttl else {}
+        # Переставляем в конец: порядок словаря = порядок последнего обращения
+        self._sessions[key] = (session, now)
+        self._evict(now)
+        return session
+
+    def _evict(self, now: float):
+        while self._sessions:
+            _, (_, touched) = next(iter(self._sessions.items()))
+            if now - touched < self.ttl and len(self._sessions) <= self.max_sessions:
+                break
+            self._sessions.popitem(last=False)
+
+    def __len__(self):
+        return len(self._sessions)
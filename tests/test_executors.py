@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import threading
+
+import pytest
+
+from executors import BoundedExecutor, ExecutorBusy, TaskOverdue
+
+
+def test_run_cancellable_returns_result():
+    executor = BoundedExecutor('test', 1, 1)
+
+    def work(value, cancel_event):
+        assert isinstance(cancel_event, threading.Event)
+        return value * 2
+
+    assert asyncio.run(executor.run_cancellable(work, 21, timeout=1)) == 42
+    assert executor.stats()['completed'] == 1
+    assert executor.cancelled == 0
+
+
+def test_run_cancellable_stops_cooperative_task():
+    executor = BoundedExecutor('test', 1, 1)
+    stopped = threading.Event()
+
+    def work(cancel_event):
+        cancel_event.wait(5)
+        stopped.set()
+        raise RuntimeError('cancelled')
+
+    with pytest.raises(asyncio.TimeoutError) as error:
+        asyncio.run(executor.run_cancellable(work, timeout=0.05, grace=2))
+
+    assert not isinstance(error.value, TaskOverdue)
+    # К моменту таймаута задача уже остановилась и освободила поток
+    assert stopped.is_set()
+    assert executor.cancelled == 1
+    assert executor.cancel_overdue == 0
+    assert executor.stats()['active'] == 0
+
+
+def test_run_cancellable_reports_overdue_task():
+    executor = BoundedExecutor('test', 1, 1)
+    release = threading.Event()
+
+    def work(cancel_event):
+        # Не смотрит на cancel_event
+        release.wait(5)
+
+    try:
+        with pytest.raises(TaskOverdue):
+            asyncio.run(executor.run_cancellable(work, timeout=0.05, grace=0.05))
+        assert executor.cancel_overdue == 1
+    finally:
+        release.set()
+
+
+def test_run_cancellable_drops_queued_task():
+    executor = BoundedExecutor('test', 1, 1)
+    release = threading.Event()
+    started = []
+
+    def blocker():
+        release.wait(5)
+
+    def work(cancel_event):
+        started.append(1)
+
+    async def main():
+        busy = executor.submit(blocker)
+        try:
+            with pytest.raises(asyncio.TimeoutError):
+                await executor.run_cancellable(work, timeout=0.05, grace=0.05)
+        finally:
+            release.set()
+        await asyncio.wrap_future(busy)
+
+    asyncio.run(main())
+    assert not started
+    assert executor.cancel_overdue == 0
+    assert executor.pending == 0
+
+
+def test_submit_rejects_when_saturated():
+    executor = BoundedExecutor('test', 1, 1)
+    release = threading.Event()
+    try:
+        executor.submit(release.wait, 5)
+        executor.submit(release.wait, 5)
+        with pytest.raises(ExecutorBusy):
+            executor.submit(release.wait, 5)
+        assert executor.rejected == 1
+    finally:
+        release.set()
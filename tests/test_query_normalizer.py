@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from query_normalizer import QueryNormalizationStats, normalize_query
+
+
+@pytest.mark.parametrize('query', ['Lo Fi Beats', 'lo-fi  beats ', 'lofi beats', 'LO_FI beats!'])
+def test_spellings_share_key(query):
+    assert normalize_query(query) == 'lofi beats'
+
+
+@pytest.mark.parametrize('query', ['R&B', 'r&b', 'r & b', 'RnB', 'r n b', 'r and b'])
+def test_rnb_aliases(query):
+    assert normalize_query(query) == 'rnb'
+
+
+@pytest.mark.parametrize('query', ['Drum & Bass', 'drum and bass', 'drum n bass', 'DnB'])
+def test_dnb_aliases(query):
+    assert normalize_query(query) == 'dnb'
+
+
+def test_word_boundaries_kept():
+    assert normalize_query('a bc') != normalize_query('ab c')
+
+
+def test_alias_only_whole_words():
+    assert normalize_query('halo fin') == 'halo fin'
+
+
+def test_stop_words_dropped():
+    assert normalize_query('найди мне трек Numb пожалуйста') == 'numb'
+
+
+def test_only_stop_words_kept():
+    assert normalize_query('трек') == 'trek'
+
+
+def test_cyrillic_transliterated():
+    assert normalize_query('Кино Группа крови') == 'kino gruppa krovi'
+    assert normalize_query('Ёлка') == normalize_query('елка')
+
+
+def test_empty_query():
+    assert normalize_query('') == ''
+    assert normalize_query(None) == ''
+
+
+def test_hit_from_other_spelling_counts_as_normalization():
+    stats = QueryNormalizationStats()
+    key = normalize_query('lo fi')
+    stats.record('lo fi', key, hit=False)
+    stats.record_fill('lo fi', key)
+    stats.record('Lo-Fi', key, hit=True)
+
+    assert stats.hits == 1
+    assert stats.hits_from_normalization == 1
+
+
+def test_repeat_of_same_query_not_credited():
+    stats = QueryNormalizationStats()
+    key = normalize_query('lo fi')
+    stats.record_fill('lo fi', key)
+    stats.record('lo fi', key, hit=True)
+
+    assert stats.hits == 1
+    assert stats.hits_from_normalization == 0
+
+
+def test_hit_without_known_filler_not_credited():
+    # Запись пришла из Redis или с диска - кто ее заполнил, неизвестно
+    stats = QueryNormalizationStats()
+    stats.record('Lo-Fi', 'lofi', hit=True)
+
+    assert stats.hits_from_normalization == 0
+    assert stats.stats()['hit_rate_without_normalization'] == 1.0
+
+
+def test_refill_replaces_filler():
+    stats = QueryNormalizationStats()
+    stats.record_fill('Lo-Fi', 'lofi')
+    stats.record_fill('lo fi', 'lofi')
+    stats.record('lo fi', 'lofi', hit=True)
+
+    assert stats.hits_from_normalization == 0
+
+
+def test_tracked_keys_bounded():
+    stats = QueryNormalizationStats(max_tracked=2)
+    for query in ('a', 'b', 'c'):
+        stats.record(query, query, hit=False)
+        stats.record_fill(query, query)
+
+    assert stats.stats()['distinct_keys'] == 2
+    assert stats.count('a') == 0
+    assert stats.count('c') == 1
+
+
+def test_pending_and_restore():
+    stats = QueryNormalizationStats()
+    stats.record('Lo-Fi', 'lofi', hit=False)
+    stats.record('lo fi', 'lofi', hit=True)
+
+    assert stats.take_pending() == {'lofi': (2, 'lo fi')}
+    assert stats.take_pending() == {}
+
+    restored = QueryNormalizationStats()
+    restored.restore([('lofi', 5, 'lofi'), ('dnb', 2, 'dnb')])
+    restored.record('Lo Fi', 'lofi', hit=False)
+    assert restored.count('lofi') == 6
+    assert restored.top_queries(1) == ['Lo Fi']
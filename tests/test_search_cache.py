@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+import asyncio
+
+import pytest
+
+import search_cache
+from search_cache import SearchCache, SingleFlight
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(search_cache.time, 'monotonic', fake)
+    return fake
+
+
+def entry(size: int) -> str:
+    # JSON-строка занимает size байт вместе с кавычками
+    return 'x' * (size - 2)
+
+
+def test_set_get_counts_bytes():
+    cache = SearchCache(max_bytes=100)
+    cache.set('a', entry(30))
+
+    assert cache.get('a') == entry(30)
+    assert cache.current_bytes == 30
+    assert cache.get('b') is None
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+
+def test_byte_budget_evicts_oldest():
+    cache = SearchCache(max_bytes=100)
+    cache.set('a', entry(40))
+    cache.set('b', entry(40))
+    cache.set('c', entry(40))
+
+    assert 'a' not in cache
+    assert 'b' in cache and 'c' in cache
+    assert cache.current_bytes == 80
+    assert cache.evictions == 1
+
+
+def test_get_refreshes_lru_order():
+    cache = SearchCache(max_bytes=100)
+    cache.set('a', entry(40))
+    cache.set('b', entry(40))
+    cache.get('a')
+    cache.set('c', entry(40))
+
+    assert 'a' in cache
+    assert 'b' not in cache
+
+
+def test_overwrite_replaces_size():
+    cache = SearchCache(max_bytes=100)
+    cache.set('a', entry(60))
+    cache.set('a', entry(20))
+
+    assert cache.current_bytes == 20
+    assert len(cache) == 1
+    assert cache.evictions == 0
+
+
+def test_entry_larger_than_budget_not_stored():
+    cache = SearchCache(max_bytes=100)
+    cache.set('a', entry(40))
+    cache.set('huge', entry(101))
+
+    assert 'huge' not in cache
+    assert 'a' in cache
+    assert cache.current_bytes == 40
+
+
+def test_multibyte_size_in_bytes():
+    cache = SearchCache(max_bytes=100)
+    cache.set('a', 'я' * 10)
+
+    assert cache.current_bytes == 22
+
+
+def test_ttl_expires_entry(clock):
+    cache = SearchCache(max_bytes=100, ttl=10)
+    cache.set('a', entry(40))
+
+    clock.now += 9.9
+    assert cache.get('a') == entry(40)
+
+    clock.now += 0.1
+    assert cache.get('a') is None
+    assert 'a' not in cache
+    assert cache.current_bytes == 0
+    assert cache.expirations == 1
+
+
+def test_per_entry_ttl(clock):
+    cache = SearchCache(max_bytes=100, ttl=10)
+    cache.set('short', entry(10), ttl=1)
+    cache.set('long', entry(10))
+
+    clock.now += 5
+    assert cache.get('short') is None
+    assert cache.get('long') == entry(10)
+
+
+def test_single_flight_shares_call():
+    calls = []
+
+    async def search():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return ['track']
+
+    async def main():
+        flight = SingleFlight()
+        results = await asyncio.gather(*(flight.run('q', search) for _ in range(5)))
+        return flight, results
+
+    flight, results = asyncio.run(main())
+    assert results == [['track']] * 5
+    assert len(calls) == 1
+    assert flight.stats() == {'in_flight': 0, 'calls': 1, 'shared': 4, 'restarted': 0}
+
+
+def test_single_flight_different_keys_run_separately():
+    async def main():
+        flight = SingleFlight()
+
+        async def search(value):
+            await asyncio.sleep(0.01)
+            return value
+
+        results = await asyncio.gather(flight.run('a', lambda: search('a')), flight.run('b', lambda: search('b')))
+        return flight, results
+
+    flight, results = asyncio.run(main())
+    assert results == ['a', 'b']
+    assert flight.calls == 2
+
+
+def test_single_flight_propagates_exception():
+    async def search():
+        await asyncio.sleep(0.01)
+        raise ValueError('boom')
+
+    async def main():
+        flight = SingleFlight()
+        results = await asyncio.gather(*(flight.run('q', search) for _ in range(3)), return_exceptions=True)
+        return flight, results
+
+    flight, results = asyncio.run(main())
+    assert all(isinstance(result, ValueError) for result in results)
+    assert flight.calls == 1
+    assert flight.stats()['in_flight'] == 0
+
+
+def test_single_flight_restarts_after_leader_cancelled():
+    calls = []
+
+    async def search():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return len(calls)
+
+    async def main():
+        flight = SingleFlight()
+        leader = asyncio.create_task(flight.run('q', search))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(flight.run('q', search))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        result = await follower
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return flight, result
+
+    flight, result = asyncio.run(main())
+    assert result == 2
+    assert flight.restarted == 1
+    assert flight.calls == 2
+
+
+def test_single_flight_follower_cancel_keeps_call():
+    async def search():
+        await asyncio.sleep(0.05)
+        return 'track'
+
+    async def main():
+        flight = SingleFlight()
+        leader = asyncio.create_task(flight.run('q', search))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(flight.run('q', search))
+        await asyncio.sleep(0.01)
+        follower.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await follower
+        return flight, await leader
+
+    flight, result = asyncio.run(main())
+    assert result == 'track'
+    assert flight.calls == 1
+    assert flight.restarted == 0
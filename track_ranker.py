@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+import re
+import json
+import math
+from pathlib import Path
+from collections import OrderedDict
+from typing import Optional
+
+_TOKEN_RE = re.compile(r"\w+")
+
+# Веса подобраны так, чтобы повторять эвристики _fallback_selection и
+# _calculate_quality_metrics, плюс совпадение с запросом и история скачиваний
+DEFAULT_WEIGHTS = {
+    'bias': -1.5,
+    'query_overlap': 2.5,
+    'exact_phrase': 1.0,
+    'official': 0.8,
+    'original': 0.5,
+    'cover_or_remix': -0.6,
+    'live': -0.4,
+    'duration_fit': 0.8,
+    'artist_known': 0.3,
+    'url_outcome': 1.5,
+    'artist_outcome': 0.5,
+}
+
+
+class LinearTrackRanker:
+    """Локальная оценка треков без сети: логистическая модель над признаками
+    названия, длительности, исполнителя и прошлых скачиваний.
+
+    Веса можно заменить (например, обученные офлайн) через from_file.
+    margin задается в логитах: у сигмоиды разница между хорошими треками
+    около 1.0 сжимается до сотых."""
+
+    def __init__(self, weights: dict = None, margin: float = 0.5, min_score: float = 0.6,
+                 max_outcomes: int = 20000):
+        self.weights = dict(DEFAULT_WEIGHTS, **(weights or {}))
+        self.margin = margin
+        self.min_score = min_score
+        self.max_outcomes = max_outcomes
+        # ключ -> [успешных скачиваний, всего попыток]
+        self._outcomes = OrderedDict()
+        self.decided = 0
+        self.escalated = 0
+
+    @classmethod
+    def from_file(cls, path: Path, **kwargs) -> 'LinearTrackRanker':
+        with open(path, 'r', encoding='utf-8') as f:
+            return cls(weights=json.load(f), **kwargs)
+
+    @staticmethod
+    def _tokens(text: str) -> list:
+        return _TOKEN_RE.findall((text or '').casefold())
+
+    def features(self, track: dict, query: str) -> dict:
+        title = (track.get('original_title') or track.get('title') or '').casefold()
+        artist = (track.get('artist') or '').casefold()
+        query_tokens = set(self._tokens(query))
+        track_tokens = set(self._tokens(title)) | set(self._tokens(artist))
+        duration = track.get('duration') or 0
+
+        if 120 <= duration <= 600:
+            duration_fit = 1.0
+        elif 60 <= duration <= 1200:
+            duration_fit = 0.5
+        else:
+            duration_fit = 0.0
+
+        return {
+            'bias': 1.0,
+            'query_overlap': len(query_tokens & track_tokens) / len(query_tokens) if query_tokens else 0.0,
+            'exact_phrase': float(bool(query_tokens) and ' '.join(self._tokens(query)) in ' '.join(self._tokens(title))),
+            'official': float('official' in title),
+            'original': float('original' in title),
+            'cover_or_remix': float('cover' in title or 'remix' in title),
+            'live': float('live' in title),
+            'duration_fit': duration_fit,
+            'artist_known': float(len(artist) > 3 and artist not in ('unknown', 'неизвестно', 'soundcloud',
+                                                                     'неизвестный исполнитель')),
+            'url_outcome': self._outcome_rate(('url', track.get('webpage_url'))),
+            'artist_outcome': self._outcome_rate(('artist', artist)),
+        }
+
+    def logit(self, track: dict, query: str) -> float:
+        return sum(self.weights.get(name, 0.0) * value for name, value in self.features(track, query).items())
+
+    def score(self, track: dict, query: str) -> float:
+        return 1 / (1 + math.exp(-self.logit(track, query)))
+
+    def rank(self, tracks: list, query: str) -> list:
+        """[(оценка 0-1, трек)] по убыванию оценки; при равенстве - исходный порядок"""
+        scored = [(self.score(track, query), -i, track) for i, track in enumerate(tracks)]
+        scored.sort(key=lambda item: item[:2], reverse=True)
+        return [(score, track) for score, _, track in scored]
+
+    def is_confident(self, ranked: list) -> bool:
+        """Лидер уверенно лучше остальных - ИИ не нужен"""
+        if not ranked:
+            return True
+        top = ranked[0][0]
+        confident = top >= self.min_score
+        if confident and len(ranked) > 1:
+            confident = self._to_logit(top) - self._to_logit(ranked[1][0]) >= self.margin
+        if confident:
+            self.decided += 1
+        else:
+            self.escalated += 1
+        return confident
+
+    @staticmethod
+    def _to_logit(score: float) -> float:
+        score = min(max(score, 1e-6), 1 - 1e-6)
+        return math.log(score / (1 - score))
+
+    # ---------- история скачиваний ----------
+
+    def record_outcome(self, track: dict, success: bool):
+        for key in (('url', track.get('webpage_url')), ('artist', (track.get('artist') or '').casefold())):
+            if not key[1]:
+                continue
+            counts = self._outcomes.pop(key, [0, 0])
+            counts[0] += int(success)
+            counts[1] += 1
+            self._outcomes[key] = counts
+            if len(self._outcomes) > self.max_outcomes:
+                self._outcomes.popitem(last=False)
+
+    def _outcome_rate(self, key: tuple) -> float:
+        """Доля удачных скачиваний со сглаживанием, от -0.5 до 0.5; без истории - 0"""
+        counts: Optional[list] = self._outcomes.get(key) if key[1] else None
+        if not counts:
+            return 0.0
+        successes, total = counts
+        return (successes + 1) / (total + 2) - 0.5
+
+    def stats(self) -> dict:
+        decisions = self.decided + self.escalated
+        return {
+            'decided_locally': self.decided,
+            'escalated': self.escalated,
+            'local_rate': round(self.decided / decisions, 3) if decisions else 0.0,
+            'tracked_outcomes': len(self._outcomes),
+        }
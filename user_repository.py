@@ -0,0 +1,473 @@
+# -*- coding: utf-8 -*-
+import json
+import time
+import asyncio
+import logging
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, Iterable
+
+from executors import ExecutorBusy, disk_executor
+from user_store import ChangeTracker, STATS_KEY, legacy_files, load_legacy_user_data
+
+logger = logging.getLogger(__name__)
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS user_stats (
+    user_id TEXT PRIMARY KEY,
+    searches INTEGER NOT NULL DEFAULT 0,
+    downloads INTEGER NOT NULL DEFAULT 0,
+    last_active REAL NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_user_stats_last_active ON user_stats (last_active);
+"""
+
+POSTGRES_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    data JSONB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS user_stats (
+    user_id TEXT PRIMARY KEY,
+    searches INTEGER NOT NULL DEFAULT 0,
+    downloads INTEGER NOT NULL DEFAULT 0,
+    last_active DOUBLE PRECISION NOT NULL,
+    data JSONB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_user_stats_last_active ON user_stats (last_active);
+"""
+
+TABLES = {'u': 'users', 's': 'user_stats'}
+
+
+class UserRepository(ChangeTracker, ABC):
+    """Базовый репозиторий пользователей: записи user_data читаются и пишутся построчно"""
+
+    # Удаления идут напрямую через LazyUserData, а не через сравнение снимков
+    track_deletions = False
+
+    @abstractmethod
+    def load(self, kind: str, user_id: str) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    def ids(self, kind: str) -> list:
+        ...
+
+    @abstractmethod
+    def load_all(self, kind: str) -> dict:
+        """Все записи вида одним запросом (для админ-команд, вызывать вне event loop)"""
+
+    @abstractmethod
+    def delete(self, kind: str, user_id: str):
+        ...
+
+    @abstractmethod
+    def stats_totals(self) -> dict:
+        ...
+
+    @abstractmethod
+    def _write(self, users: list, stats: list, deletes: list):
+        ...
+
+    def count_users(self) -> int:
+        return len(self.ids('u'))
+
+    def remember(self, rkey: tuple, value):
+        """Запоминает хэш загруженной записи, чтобы не переписывать ее без изменений"""
+        self._digests[rkey] = self._digest(self._dump(value))
+
+    def forget(self, rkey: tuple):
+        self._digests.pop(rkey, None)
+
+    def release(self, rkey: tuple, value) -> Optional[str]:
+        """Забывает запись, вытесняемую из памяти; возвращает json, если ее нужно дописать"""
+        payload = self._dump(value)
+        changed = self._digests.get(rkey) != self._digest(payload)
+        self.forget(rkey)
+        return payload if changed else None
+
+    def append(self, changes: list):
+        """Раскладывает изменения по таблицам и записывает их одной транзакцией"""
+        if not changes:
+            return
+        now = time.time()
+        users, stats, deletes = [], [], []
+        for (kind, user_id), payload in changes:
+            if payload is None:
+                deletes.append((kind, user_id))
+            elif kind == 's':
+                values = json.loads(payload)
+                stats.append((
+                    user_id,
+                    int(values.get('searches') or 0),
+                    int(values.get('downloads') or 0),
+                    now,
+                    payload,
+                ))
+            else:
+                users.append((user_id, payload))
+        self._write(users, stats, deletes)
+
+    @staticmethod
+    def _records(data: dict, user_ids: Optional[Iterable] = None):
+        # Только записи, загруженные в память; остальные в базе уже актуальны
+        stats = dict.get(data, STATS_KEY) or {}
+        if user_ids is None:
+            keys = set(dict.keys(data)) | set(dict.keys(stats))
+            keys.discard(STATS_KEY)
+        else:
+            keys = {str(uid) for uid in user_ids}
+
+        for uid in keys:
+            if dict.__contains__(data, uid):
+                yield ('u', uid), dict.__getitem__(data, uid)
+            if dict.__contains__(stats, uid):
+                yield ('s', uid), dict.__getitem__(stats, uid)
+
+    def import_legacy(self, legacy_file: Path):
+        """Однократно переносит пользователей из user_data.json и его журнала"""
+        if not any(path.exists() for path in legacy_files(legacy_file)):
+            return
+        if self.count_users():
+            return
+        try:
+            data = load_legacy_user_data(legacy_file)
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать {legacy_file} для переноса: {e}")
+            return
+        changes = [(rkey, self._dump(value)) for rkey, value in ChangeTracker._records(data)]
+        self.append(changes)
+        logger.info(f"✅ Перенесено {len(changes)} записей из {legacy_file}")
+
+
+class SQLiteUserRepository(UserRepository):
+    """Пользователи в локальной SQLite базе (по умолчанию)"""
+
+    def __init__(self, db_file: Path, legacy_file: Path = None):
+        super().__init__()
+        self.db_file = Path(db_file)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.db_file), check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(SQLITE_SCHEMA)
+        if legacy_file:
+            self.import_legacy(legacy_file)
+
+    def load(self, kind: str, user_id: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT data FROM {TABLES[kind]} WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def ids(self, kind: str) -> list:
+        with self._lock:
+            return [row[0] for row in self._conn.execute(f"SELECT user_id FROM {TABLES[kind]}")]
+
+    def load_all(self, kind: str) -> dict:
+        with self._lock:
+            rows = self._conn.execute(f"SELECT user_id, data FROM {TABLES[kind]}").fetchall()
+        return {user_id: json.loads(data) for user_id, data in rows}
+
+    def count_users(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def stats_totals(self) -> dict:
+        with self._lock:
+            searches, downloads = self._conn.execute(
+                "SELECT COALESCE(SUM(searches), 0), COALESCE(SUM(downloads), 0) FROM user_stats"
+            ).fetchone()
+        return {'searches': searches, 'downloads': downloads}
+
+    def delete(self, kind: str, user_id: str):
+        self._write([], [], [(kind, user_id)])
+
+    def _write(self, users: list, stats: list, deletes: list):
+        with self._lock, self._conn:
+            if users:
+                self._conn.executemany(
+                    "INSERT INTO users (user_id, data) VALUES (?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data",
+                    users
+                )
+            if stats:
+                self._conn.executemany(
+                    "INSERT INTO user_stats (user_id, searches, downloads, last_active, data) "
+                    "VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET searches = excluded.searches, "
+                    "downloads = excluded.downloads, last_active = excluded.last_active, data = excluded.data",
+                    stats
+                )
+            for kind, user_id in deletes:
+                self._conn.execute(f"DELETE FROM {TABLES[kind]} WHERE user_id = ?", (user_id,))
+
+
+class PostgresUserRepository(UserRepository):
+    """Пользователи в Postgres через asyncpg (включается переменной DATABASE_URL).
+
+    Запросы выполняются в собственном event loop в отдельном потоке, чтобы
+    интерфейс оставался синхронным, как у SQLite."""
+
+    def __init__(self, dsn: str, legacy_file: Path = None):
+        super().__init__()
+        import asyncpg
+
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, daemon=True, name='postgres-users').start()
+        self._pool = self._run(asyncpg.create_pool(dsn, min_size=1, max_size=4))
+        self._run(self._pool.execute(POSTGRES_SCHEMA))
+        if legacy_file:
+            self.import_legacy(legacy_file)
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def load(self, kind: str, user_id: str) -> Optional[dict]:
+        data = self._run(self._pool.fetchval(
+            f"SELECT data::text FROM {TABLES[kind]} WHERE user_id = $1", user_id
+        ))
+        return json.loads(data) if data else None
+
+    def ids(self, kind: str) -> list:
+        rows = self._run(self._pool.fetch(f"SELECT user_id FROM {TABLES[kind]}"))
+        return [row['user_id'] for row in rows]
+
+    def load_all(self, kind: str) -> dict:
+        rows = self._run(self._pool.fetch(f"SELECT user_id, data::text AS data FROM {TABLES[kind]}"))
+        return {row['user_id']: json.loads(row['data']) for row in rows}
+
+    def count_users(self) -> int:
+        return self._run(self._pool.fetchval("SELECT COUNT(*) FROM users"))
+
+    def stats_totals(self) -> dict:
+        row = self._run(self._pool.fetchrow(
+            "SELECT COALESCE(SUM(searches), 0) AS searches, COALESCE(SUM(downloads), 0) AS downloads FROM user_stats"
+        ))
+        return {'searches': row['searches'], 'downloads': row['downloads']}
+
+    def delete(self, kind: str, user_id: str):
+        self._write([], [], [(kind, user_id)])
+
+    def _write(self, users: list, stats: list, deletes: list):
+        self._run(self._write_async(users, stats, deletes))
+
+    async def _write_async(self, users: list, stats: list, deletes: list):
+        async with self._pool.acquire() as conn:
+            async with conn.transaction():
+                if users:
+                    await conn.executemany(
+                        "INSERT INTO users (user_id, data) VALUES ($1, $2::jsonb) "
+                        "ON CONFLICT (user_id) DO UPDATE SET data = EXCLUDED.data",
+                        users
+                    )
+                if stats:
+                    await conn.executemany(
+                        "INSERT INTO user_stats (user_id, searches, downloads, last_active, data) "
+                        "VALUES ($1, $2, $3, $4, $5::jsonb) "
+                        "ON CONFLICT (user_id) DO UPDATE SET searches = EXCLUDED.searches, "
+                        "downloads = EXCLUDED.downloads, last_active = EXCLUDED.last_active, data = EXCLUDED.data",
+                        stats
+                    )
+                for kind, user_id in deletes:
+                    await conn.execute(f"DELETE FROM {TABLES[kind]} WHERE user_id = $1", user_id)
+
+
+def create_user_repository(database_url: str = None, db_file: Path = None, legacy_file: Path = None) -> UserRepository:
+    """Postgres, если задан DATABASE_URL, иначе SQLite"""
+    if database_url:
+        try:
+            repository = PostgresUserRepository(database_url, legacy_file=legacy_file)
+            logger.info("✅ Пользователи хранятся в Postgres")
+            return repository
+        except Exception as e:
+            logger.error(f"Не удалось подключиться к Postgres, используем SQLite: {e}")
+    return SQLiteUserRepository(db_file or Path('user_data.db'), legacy_file=legacy_file)
+
+
+class LazyRecords(dict):
+    """Записи одного вида с ленивой загрузкой из репозитория и LRU-вытеснением.
+
+    В памяти держится около max_cached записей. Вытесняются только записи,
+    к которым не обращались дольше min_idle секунд и которые не ждут
+    отложенного сохранения, - обработчики, держащие ссылку на запись между
+    await, продолжают менять тот же объект. Запись вытесненной записи идет
+    в потоке WriteBehindSaver; пока она не завершилась, повторное обращение
+    возвращает тот же объект, а не устаревшую версию из базы."""
+
+    def __init__(self, repository: UserRepository, kind: str, max_cached: int = 2000,
+                 saver=None, min_idle: float = 600.0):
+        super().__init__()
+        self.repository = repository
+        self.kind = kind
+        self.max_cached = max_cached
+        self.saver = saver
+        self.min_idle = min_idle
+        # ключ -> время последнего обращения, от давних к недавним
+        self._lru = OrderedDict()
+        # Вытесненные записи, которые еще пишутся: ключ -> (объект, метка записи)
+        self._evicting = {}
+        self._lock = threading.Lock()
+
+    def _load(self, key) -> bool:
+        if not isinstance(key, str):
+            return False
+        if dict.__contains__(self, key):
+            self._touch(key)
+            return True
+        if key.startswith('_'):
+            return False
+        with self._lock:
+            pending = self._evicting.get(key)
+        if pending is not None:
+            # Хэш не запоминаем - при следующем сохранении запись допишется целиком
+            dict.__setitem__(self, key, pending[0])
+            self._touch(key)
+            return True
+        value = self.repository.load(self.kind, key)
+        if value is None:
+            return False
+        self._insert(key, value)
+        return True
+
+    def _insert(self, key: str, value):
+        self.repository.remember((self.kind, key), value)
+        dict.__setitem__(self, key, value)
+        self._touch(key)
+
+    async def preload(self, key: str):
+        """Загружает запись в пуле disk, чтобы обработчик не читал базу в event loop"""
+        if key.startswith('_') or dict.__contains__(self, key) or key in self._evicting:
+            return
+        try:
+            value = await disk_executor.run(self.repository.load, self.kind, key)
+        except ExecutorBusy:
+            # Пул занят - запись загрузится синхронно при первом обращении
+            return
+        if value is not None and not dict.__contains__(self, key) and key not in self._evicting:
+            self._insert(key, value)
+
+    def _touch(self, key: str):
+        if key.startswith('_'):
+            return
+        self._lru[key] = time.monotonic()
+        self._lru.move_to_end(key)
+        if len(self._lru) > self.max_cached:
+            self._evict()
+
+    def _evict(self):
+        excess = len(self._lru) - self.max_cached
+        idle_before = time.monotonic() - self.min_idle
+        victims = []
+        for key, touched in self._lru.items():
+            if len(victims) >= excess or touched > idle_before:
+                break
+            if self.saver is not None and self.saver.is_dirty(key):
+                continue
+            victims.append(key)
+        for key in victims:
+            del self._lru[key]
+            self._release(key, dict.pop(self, key))
+
+    def _release(self, key: str, value):
+        rkey = (self.kind, key)
+        payload = self.repository.release(rkey, value)
+        if payload is None:
+            return
+        token = object()
+        with self._lock:
+            self._evicting[key] = (value, token)
+
+        def write():
+            self.repository.append([(rkey, payload)])
+            with self._lock:
+                # Снимаем только свою запись: объект могли вернуть и вытеснить снова
+                if self._evicting.get(key, (None, None))[1] is token:
+                    del self._evicting[key]
+
+        if self.saver is not None:
+            self.saver.submit(write)
+        else:
+            write()
+
+    def __contains__(self, key):
+        return self._load(key)
+
+    def __getitem__(self, key):
+        if not self._load(key):
+            raise KeyError(key)
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        return dict.__getitem__(self, key) if self._load(key) else default
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self._touch(key)
+
+    def __delitem__(self, key):
+        existed = self._load(key)
+        self.discard(key)
+        if not existed:
+            raise KeyError(key)
+
+    def discard(self, key: str):
+        """Удаляет запись из памяти и базы, не загружая ее"""
+        dict.pop(self, key, None)
+        self._lru.pop(key, None)
+        with self._lock:
+            self._evicting.pop(key, None)
+        if self.saver is not None:
+            # В том же потоке, что и записи, - удаление не обгонит вытеснение
+            self.saver.submit(self.repository.delete, self.kind, key)
+        else:
+            self.repository.delete(self.kind, key)
+        self.repository.forget((self.kind, key))
+
+    async def all_keys(self) -> list:
+        """Ключи всех записей: из базы (в пуле disk) и еще не сохраненные из памяти"""
+        stored = await disk_executor.run(self.repository.ids, self.kind)
+        cached = [key for key in dict.keys(self) if not key.startswith('_')]
+        return cached + [key for key in stored if not dict.__contains__(self, key)]
+
+    async def load_all(self) -> dict:
+        """Все записи: из базы (в пуле disk), поверх - загруженные в память, они новее"""
+        records = await disk_executor.run(self.repository.load_all, self.kind)
+        with self._lock:
+            records.update((key, value) for key, (value, _) in self._evicting.items())
+        records.update((key, value) for key, value in dict.items(self) if not key.startswith('_'))
+        return records
+
+    def keys(self):
+        cached = [k for k in dict.keys(self)]
+        stored = self.repository.ids(self.kind)
+        return cached + [k for k in stored if not dict.__contains__(self, k)]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+
+class LazyUserData(LazyRecords):
+    """user_data, в котором пользователи и их _user_stats подгружаются по требованию"""
+
+    def __init__(self, repository: UserRepository, max_cached: int = 2000, saver=None):
+        super().__init__(repository, 'u', max_cached, saver=saver)
+        dict.__setitem__(self, STATS_KEY, LazyRecords(repository, 's', max_cached, saver=saver))
+
+    async def preload_user(self, user_id: str):
+        """Заранее подгружает запись пользователя и его статистику вне event loop"""
+        await self.preload(user_id)
+        await dict.__getitem__(self, STATS_KEY).preload(user_id)
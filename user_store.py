@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+import json
+import asyncio
+import hashlib
+import logging
+import concurrent.futures
+from pathlib import Path
+from typing import Optional, Iterable
+
+logger = logging.getLogger(__name__)
+
+STATS_KEY = '_user_stats'
+_MISSING = object()
+
+
+class ChangeTracker:
+    """Отслеживает изменения записей user_data по хэшам их JSON-представления"""
+
+    # Удалять записи, пропавшие из user_data при полной проверке
+    track_deletions = True
+
+    def __init__(self):
+        self._digests = {}
+
+    def collect_changes(self, data: dict, user_ids: Optional[Iterable] = None) -> list:
+        """Возвращает изменившиеся записи [(ключ записи, json или None при удалении)].
+
+        Сериализация идет в вызывающем потоке, к диску не обращается."""
+        changes = []
+        seen = set()
+
+        for rkey, value in self._records(data, user_ids):
+            seen.add(rkey)
+            if value is _MISSING:
+                if self._digests.pop(rkey, None) is not None:
+                    changes.append((rkey, None))
+                continue
+
+            payload = self._dump(value)
+            digest = self._digest(payload)
+            if self._digests.get(rkey) != digest:
+                self._digests[rkey] = digest
+                changes.append((rkey, payload))
+
+        if user_ids is None and self.track_deletions:
+            for rkey in [k for k in self._digests if k not in seen]:
+                del self._digests[rkey]
+                changes.append((rkey, None))
+
+        return changes
+
+    @staticmethod
+    def _records(data: dict, user_ids: Optional[Iterable] = None):
+        if user_ids is None:
+            for key, value in data.items():
+                if key == STATS_KEY and isinstance(value, dict):
+                    for uid, stats in value.items():
+                        yield ('s', uid), stats
+                else:
+                    yield ('u', key), value
+            return
+
+        stats = data.get(STATS_KEY, {})
+        for uid in user_ids:
+            uid = str(uid)
+            yield ('u', uid), data.get(uid, _MISSING)
+            yield ('s', uid), stats.get(uid, _MISSING)
+
+    @staticmethod
+    def _dump(value) -> str:
+        return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+    @staticmethod
+    def _digest(payload: str) -> bytes:
+        return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).digest()
+
+
+# Прежнее хранилище - снапшот user_data.json и журнал изменений с фоновым уплотнением -
+# заменено репозиторием пользователей (user_repository.py). От него остался только
+# загрузчик для однократного переноса старых файлов в репозиторий.
+def legacy_files(data_file: Path) -> list:
+    """Снапшот user_data.json и журналы, которые писали прежние версии бота"""
+    data_file = Path(data_file)
+    return [data_file, Path(f"{data_file}.log.compacting"), Path(f"{data_file}.log")]
+
+
+def load_legacy_user_data(data_file: Path) -> Optional[dict]:
+    """Читает user_data.json и проигрывает поверх него журнал изменений.
+
+    Нужен только для однократного переноса в репозиторий; None - если файлов нет."""
+    snapshot, *journals = legacy_files(data_file)
+    if not any(path.exists() for path in (snapshot, *journals)):
+        return None
+
+    data = {}
+    if snapshot.exists():
+        with open(snapshot, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    for path in journals:
+        if path.exists():
+            _replay(path, data)
+    return data
+
+
+def _replay(path: Path, data: dict):
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Оборванная последняя строка после аварийного завершения
+                logger.warning(f"Пропущена поврежденная запись журнала {path}")
+                continue
+            target = data.setdefault(STATS_KEY, {}) if record['t'] == 's' else data
+            if record.get('d'):
+                target.pop(record['k'], None)
+            else:
+                target[record['k']] = record['v']
+
+
+class WriteBehindSaver:
+    """Отложенное сохранение: копит изменившихся пользователей и пишет их пачкой вне event loop"""
+
+    def __init__(self, store: ChangeTracker, delay: float = 2.0):
+        self.store = store
+        self.delay = delay
+        self._dirty = set()
+        self._full = False
+        self._data = None
+        self._handle = None
+        # Один поток - записи в журнал не переставляются местами
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='user-save')
+
+    def mark_dirty(self, data: dict, user_ids: Optional[Iterable] = None):
+        """Помечает пользователей измененными; без user_ids - весь user_data"""
+        self._data = data
+        if user_ids:
+            self._dirty.update(str(uid) for uid in user_ids)
+        else:
+            self._full = True
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Вне event loop (загрузка, остановка) пишем сразу
+            self.flush()
+            return
+
+        if self._handle is None:
+            self._handle = loop.call_later(self.delay, self._flush_in_background)
+
+    def is_dirty(self, user_id: str) -> bool:
+        """Есть ли у пользователя изменения, еще не отданные на запись"""
+        return self._full or user_id in self._dirty
+
+    def submit(self, func, *args) -> concurrent.futures.Future:
+        """Выполняет запись в потоке сохранения, по порядку с остальными записями"""
+        future = self._executor.submit(func, *args)
+        future.add_done_callback(self._log_write_error)
+        return future
+
+    def _take_changes(self) -> list:
+        if self._data is None:
+            return []
+        user_ids = None if self._full else list(self._dirty)
+        self._dirty.clear()
+        self._full = False
+        if user_ids == []:
+            return []
+        return self.store.collect_changes(self._data, user_ids)
+
+    def _flush_in_background(self):
+        self._handle = None
+        try:
+            lines = self._take_changes()
+        except Exception as e:
+            logger.error(f"Ошибка подготовки данных к сохранению: {e}")
+            return
+        if lines:
+            self.submit(self.store.append, lines)
+
+    @staticmethod
+    def _log_write_error(future: concurrent.futures.Future):
+        if future.exception():
+            logger.error(f"Ошибка сохранения данных: {future.exception()}")
+
+    def flush(self):
+        """Синхронно дописывает все накопленные изменения (вызывается при остановке)"""
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        # Дожидаемся уже отправленных в поток записей, чтобы сохранить порядок
+        self._executor.submit(lambda: None).result()
+        self.store.append(self._take_changes())
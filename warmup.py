@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+import time
+import asyncio
+import logging
+from typing import Callable, Awaitable, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class WarmupScheduler:
+    """Прогрев кэша поиска: запросы идут параллельно, но не больше concurrency
+    одновременно и не чаще rate запусков в секунду.
+
+    Следующий запрос выбирается в момент освобождения слота по priority,
+    поэтому запросы, которые пользователи задают во время прогрева, поднимаются вверх."""
+
+    def __init__(self, concurrency: int = 4, rate: float = 2.0):
+        self.concurrency = max(1, concurrency)
+        self.rate = rate
+        self.state = 'idle'
+        self.total = 0
+        self.done = 0
+        self.warmed = 0
+        self.failed = 0
+        self.in_progress = 0
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self._next_start = 0.0
+        self._rate_lock = asyncio.Lock()
+
+    async def run(self, queries: Iterable[str], fetch: Callable[[str], Awaitable[bool]],
+                  priority: Callable[[str], float] = None):
+        """Прогревает queries; fetch возвращает True, если запрос попал в кэш"""
+        pending = list(queries)
+        self.state = 'running'
+        self.total = len(pending)
+        self.done = self.warmed = self.failed = 0
+        self.started_at = time.time()
+        self.finished_at = None
+
+        async def worker():
+            while pending:
+                if priority:
+                    # Стабильный выбор: при равном приоритете сохраняется исходный порядок
+                    index = max(range(len(pending)), key=lambda i: (priority(pending[i]), -i))
+                else:
+                    index = 0
+                query = pending.pop(index)
+
+                await self._wait_rate()
+                self.in_progress += 1
+                try:
+                    if await fetch(query):
+                        self.warmed += 1
+                except Exception as e:
+                    self.failed += 1
+                    logger.warning(f"Ошибка прогрева '{query}': {e}")
+                finally:
+                    self.in_progress -= 1
+                    self.done += 1
+
+        try:
+            await asyncio.gather(*(worker() for _ in range(min(self.concurrency, len(pending)))))
+            self.state = 'done'
+        except asyncio.CancelledError:
+            self.state = 'cancelled'
+            raise
+        finally:
+            self.finished_at = time.time()
+
+    async def _wait_rate(self):
+        if not self.rate:
+            return
+        async with self._rate_lock:
+            loop = asyncio.get_running_loop()
+            now = loop.time()
+            start_at = max(now, self._next_start)
+            self._next_start = start_at + 1 / self.rate
+            if start_at > now:
+                await asyncio.sleep(start_at - now)
+
+    def stats(self) -> dict:
+        end = self.finished_at or time.time()
+        return {
+            'state': self.state,
+            'total': self.total,
+            'done': self.done,
+            'warmed': self.warmed,
+            'failed': self.failed,
+            'in_progress': self.in_progress,
+            'progress': round(self.done / self.total, 3) if self.total else 0.0,
+            'elapsed_seconds': round(end - self.started_at, 2) if self.started_at else 0.0,
+            'concurrency': self.concurrency,
+            'rate_per_second': self.rate,
+        }
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+import copy
+import json
+import threading
+from contextlib import contextmanager
+
+import yt_dlp
+
+
+class DownloadCancelled(yt_dlp.utils.DownloadCancelled):
+    msg = 'Скачивание остановлено по таймауту'
+
+
+def _cancel_hook(cancel_event: threading.Event):
+    # progress hook вызывается на каждый блок данных - исключение из него
+    # прерывает передачу в потоке yt-dlp
+    def hook(status):
+        if cancel_event.is_set():
+            raise DownloadCancelled()
+    return hook
+
+
+class YoutubeDLPool:
+    """Пул готовых yt_dlp.YoutubeDL, по отдельной очереди на каждый набор опций.
+
+    Создание YoutubeDL заново инициализирует экстракторы и HTTP-клиент;
+    экземпляры из пула переиспользуются. Экземпляр выдается одному потоку
+    за раз, параметры вызова (например paths с временной папкой) задаются
+    через overrides и откатываются при возврате в пул. Если передан cancel_event,
+    скачивание прерывается с DownloadCancelled, как только событие установлено."""
+
+    def __init__(self, max_idle_per_profile: int = 8):
+        self.max_idle_per_profile = max_idle_per_profile
+        self._idle = {}
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+
+    @staticmethod
+    def _profile_key(opts: dict) -> str:
+        return json.dumps(opts, sort_keys=True, default=repr)
+
+    def _acquire(self, key: str, opts: dict):
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                self.reused += 1
+                return idle.pop()
+            self.created += 1
+        # yt_dlp.YoutubeDL берется в момент вызова, чтобы его можно было подменить
+        return yt_dlp.YoutubeDL(dict(opts))
+
+    def _release(self, key: str, ydl):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle_per_profile:
+                idle.append(ydl)
+                return
+            self.discarded += 1
+        ydl.close()
+
+    @contextmanager
+    def checkout(self, opts: dict, cancel_event: threading.Event = None, **overrides):
+        """Выдает YoutubeDL для opts; overrides временно меняют его params"""
+        key = self._profile_key(opts)
+        ydl = self._acquire(key, opts)
+        saved = {name: ydl.params.get(name, _ABSENT) for name in overrides}
+        ydl.params.update(overrides)
+        hook = None
+        if cancel_event is not None:
+            hook = _cancel_hook(cancel_event)
+            ydl.add_progress_hook(hook)
+        healthy = False
+        try:
+            yield ydl
+            healthy = True
+        finally:
+            if hook is not None:
+                ydl._progress_hooks.remove(hook)
+            for name, value in saved.items():
+                if value is _ABSENT:
+                    ydl.params.pop(name, None)
+                else:
+                    ydl.params[name] = value
+            if healthy:
+                self._release(key, ydl)
+            else:
+                # После исключения состояние экземпляра не гарантируется
+                with self._lock:
+                    self.discarded += 1
+                ydl.close()
+
+    def extract_info(self, opts: dict, url: str, download: bool = False, **overrides):
+        """extract_info на экземпляре из пула (вызывать в пуле потоков)"""
+        with self.checkout(opts, **overrides) as ydl:
+            return ydl.extract_info(url, download=download)
+
+    def probe(self, opts: dict, url: str, **overrides):
+        """Метаданные трека с выбранным форматом, очищенные для кэширования и process_ie_result"""
+        with self.checkout(opts, **overrides) as ydl:
+            info = ydl.extract_info(url, download=False)
+            return ydl.sanitize_info(info, remove_private_keys=True)
+
+    def process_ie_result(self, opts: dict, info: dict, download: bool = True, **overrides):
+        """Скачивание по готовому info dict без повторного extract_info.
+
+        yt-dlp дополняет переданный словарь, поэтому обрабатывается копия."""
+        with self.checkout(opts, **overrides) as ydl:
+            return ydl.process_ie_result(copy.deepcopy(info), download=download)
+
+    def prewarm(self, opts: dict, count: int = 1):
+        """Заранее создает экземпляры для профиля, чтобы первые запросы не платили за инициализацию"""
+        key = self._profile_key(opts)
+        for _ in range(count):
+            self._release(key, yt_dlp.YoutubeDL(dict(opts)))
+            with self._lock:
+                self.created += 1
+
+    def clear(self):
+        """Закрывает все свободные экземпляры (следующие вызовы создадут новые)"""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for instances in idle.values():
+            for ydl in instances:
+                ydl.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'profiles': len(self._idle),
+                'idle': sum(len(idle) for idle in self._idle.values()),
+                'created': self.created,
+                'reused': self.reused,
+                'discarded': self.discarded,
+            }
+
+
+_ABSENT = object()
+
+ydl_pool = YoutubeDLPool()